@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Benchmark of the decoding of large Prometheus query responses.
+
+Generates a vector response of the requested number of series, like the
+result of `up` or of a per-container CPU query, and measures the time the
+keeper needs to get the value of a query from its body: fully decoded as
+before and through the fast path, for scalar, label list and vector
+queries. Scalar queries read the first series only and vector queries scan
+their label columns from the text, the label list queries need the whole
+decoded result. The results are saved as JSON together with
+the git commit.
+
+  python benchmarks/bench_prometheus_decode.py --series 10000
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import argparse
+import platform
+import statistics
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+from bench_session import git_revision
+from fake_services import KUBECONFIG
+
+def generate_response(series, labels=6):
+  now = time.time()
+  result = [ dict(metric=dict({ 'label{0}'.format(j): 'value-{0}-{1}'.format(i, j) for j in range(labels) },
+                              __name__='container_cpu_usage_seconds_total',
+                              instance='10.0.{0}.{1}:9100'.format(*divmod(i, 250)),
+                              pod='pod-{0}'.format(i)),
+                  value=[now, str(round(random.uniform(0, 100), 6))])
+             for i in range(series) ]
+  return json.dumps(dict(status='success', data=dict(resultType='vector', result=result))).encode()
+
+def measure(func, repeat):
+  times = []
+  for i in range(repeat):
+    start = time.perf_counter()
+    func()
+    times.append(time.perf_counter() - start)
+  return dict(median_ms=statistics.median(times)*1000, min_ms=min(times)*1000)
+
+def run(args):
+  # The keeper modules read the kubeconfig when imported
+  with tempfile.NamedTemporaryFile('w', suffix='.kubeconfig', delete=False) as f:
+    f.write(KUBECONFIG.format('http://127.0.0.1:1'))
+  os.environ['KUBECONFIG'] = f.name
+  try:
+    import handle_prometheus as prom
+  finally:
+    os.unlink(f.name)
+  content = generate_response(args.series, args.labels)
+  queries = dict(scalar='up', labels=['up', 'pod'], vector=dict(query='up', labels=['pod', 'instance']))
+  results = dict()
+  for mode, query in queries.items():
+    full = measure(lambda: prom.extract_value_from_prometheus_response(query, json.loads(content)), args.repeat)
+    # A new RawResponse each time, the decoded forms are cached within one
+    fast = measure(lambda: prom.extract_value_from_prometheus_response(query, prom.RawResponse(content)), args.repeat)
+    results[mode] = dict(full=full, fast=fast, speedup=full['median_ms']/fast['median_ms'])
+  # Formatting of the response for the debug log, now skipped unless it is enabled
+  decoded = json.loads(content)
+  results['debug_format'] = measure(lambda: '{0}'.format(decoded), args.repeat)
+  return dict(benchmark='prometheus_decode',
+              git=git_revision(),
+              timestamp=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              python=platform.python_version(),
+              platform=platform.platform(),
+              parameters=vars(args),
+              response_bytes=len(content),
+              results=results)
+
+def save(result, output):
+  if output is None:
+    directory = os.path.join(HERE, 'results')
+    os.makedirs(directory, exist_ok=True)
+    output = os.path.join(directory, 'prometheus-decode-{0}-{1}.json'.format(
+      (result['git']['commit'] or 'unknown')[:10], time.strftime('%Y%m%d-%H%M%S')))
+  with open(output, 'w') as f:
+    json.dump(result, f, indent=2, sort_keys=True)
+  return output
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the decoding of large Prometheus responses')
+  parser.add_argument('--series', type=int, default=10000)
+  parser.add_argument('--labels', type=int, default=6, help='extra labels per series')
+  parser.add_argument('--repeat', type=int, default=20)
+  parser.add_argument('--output', help='result file, by default under benchmarks/results')
+  args = parser.parse_args()
+  result = run(args)
+  print('{0} series, {1} bytes'.format(args.series, result['response_bytes']))
+  for mode in ('scalar', 'labels', 'vector'):
+    stats = result['results'][mode]
+    print('{0:<7} full {1:9.3f} ms  fast {2:9.3f} ms  x{3:.1f}'
+          .format(mode, stats['full']['median_ms'], stats['fast']['median_ms'], stats['speedup']))
+  print('debug log formatting of the response: {0:.3f} ms'.format(result['results']['debug_format']['median_ms']))
+  print('Saved to {0}'.format(save(result, args.output)))
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""Benchmark of the policy keeper sessions against local fake services.
+
+Starts fake Prometheus, Occopus, optimizer and Kubernetes servers, generates
+a policy of the requested size and measures prepare_session() and
+perform_one_session(): latency, throughput, CPU time of the keeper and of the
+evaluator workers, and peak RSS. The results are saved as JSON together with
+the git commit, so that runs on different commits can be compared.
+
+  python benchmarks/bench_session.py --services 20 --queries 40 --sessions 50
+  python benchmarks/bench_session.py --compare benchmarks/results/<previous>.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import statistics
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+from fake_services import FakeServices
+from policy_generator import generate_policy, policy_yaml
+
+PROMETHEUS_CONFIG = 'global:\n  scrape_interval: 15s\nscrape_configs: []\n'
+
+def git_revision():
+  try:
+    commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                     stderr=subprocess.DEVNULL).decode().strip()
+    dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                    cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip() != ''
+    return dict(commit=commit, dirty=dirty)
+  except (OSError, subprocess.CalledProcessError):
+    return dict(commit=None, dirty=None)
+
+def cpu_seconds():
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  return usage.ru_utime + usage.ru_stime
+
+def process_cpu_seconds(pid):
+  """ CPU time of a live process from /proc, None where it is not available. """
+  try:
+    with open('/proc/{0}/stat'.format(pid)) as f:
+      fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+  except (OSError, IndexError, ValueError):
+    return None
+
+def evaluator_cpu_seconds(evaluator):
+  if evaluator.pool is None:
+    return 0.0
+  values = [ process_cpu_seconds(x.process.pid) for x in evaluator.pool.workers ]
+  return None if None in values else sum(values)
+
+def latency_stats(latencies):
+  ordered = sorted(latencies)
+  return dict(count=len(ordered),
+              mean_ms=statistics.mean(ordered)*1000,
+              median_ms=statistics.median(ordered)*1000,
+              p95_ms=ordered[min(int(len(ordered)*0.95), len(ordered)-1)]*1000,
+              min_ms=ordered[0]*1000,
+              max_ms=ordered[-1]*1000)
+
+def setup_fakes(args, policy, workdir):
+  fakes = FakeServices(args.latency, args.series).start()
+  for node in policy['scaling']['nodes']:
+    fakes.occopus.targets[node['name']] = 1
+    for i in range(args.node_instances):
+      fakes.kubernetes.add_node('{0}-{1}'.format(node['name'], i), node['name'])
+  for service in policy['scaling']['services']:
+    fakes.kubernetes.add_deployment(service['name'], 1)
+  os.environ['KUBECONFIG'] = fakes.write_kubeconfig(os.path.join(workdir, 'kubeconfig'))
+  return fakes
+
+def keeper_config(args, fakes, workdir):
+  from ruamel import yaml
+  with open(os.path.join(ROOT, 'configs', 'config.yaml')) as f:
+    config = yaml.safe_load(f)
+  prometheus_config = os.path.join(workdir, 'prometheus.yml')
+  with open(prometheus_config, 'w') as f:
+    f.write(PROMETHEUS_CONFIG)
+  rules_directory = os.path.join(workdir, 'rules')
+  os.mkdir(rules_directory)
+  config.update(prometheus_endpoint=fakes.prometheus.url,
+                occopus_endpoint=fakes.occopus.url,
+                occopus_infra_name='bench',
+                optimizer_endpoint=fakes.optimizer.url,
+                k8s_endpoint=fakes.kubernetes.url,
+                prometheus_config_template=os.path.join(workdir, 'prometheus.tpl'),
+                prometheus_config_target=prometheus_config,
+                prometheus_rules_directory=rules_directory,
+                session_engine=args.engine,
+                session_budget=args.budget,
+                prometheus_query_batching=args.batching)
+  config.setdefault('docker_node_unreachable_timeout', 120)
+  return config
+
+def run(args):
+  policy = generate_policy(args.nodes, args.services, args.queries, args.complexity,
+                           args.alerts, args.optimizer)
+  document = policy_yaml(policy).encode()
+  workdir = tempfile.mkdtemp(prefix='pk-bench-')
+  fakes = setup_fakes(args, policy, workdir)
+  # The keeper modules read the kubeconfig when imported
+  import pk_config
+  import evaluator
+  import policy_keeper
+  pk_config.config(keeper_config(args, fakes, workdir))
+  policy_keeper.log = logging.getLogger('pk')
+  evaluator.init_logging()
+  evaluator.init_queue_reading()
+  try:
+    prepare = []
+    for i in range(args.prepare_runs):
+      start = time.perf_counter()
+      prepared = policy_keeper.prepare_session(document)
+      prepare.append(time.perf_counter() - start)
+    for i in range(args.warmup):
+      policy_keeper.perform_one_session(prepared)
+    cpu, evaluator_cpu = cpu_seconds(), evaluator_cpu_seconds(evaluator)
+    latencies = []
+    wall = time.perf_counter()
+    for i in range(args.sessions):
+      start = time.perf_counter()
+      policy_keeper.perform_one_session(prepared)
+      latencies.append(time.perf_counter() - start)
+    wall = time.perf_counter() - wall
+    cpu = cpu_seconds() - cpu
+    workers_cpu = evaluator_cpu_seconds(evaluator)
+    workers_cpu = workers_cpu - evaluator_cpu if None not in (workers_cpu, evaluator_cpu) else None
+    workers_rss = max([ x.maxrss for x in evaluator.pool.workers ] or [0]) if evaluator.pool else 0
+  finally:
+    evaluator.stop_queue_reading()
+    evaluator.stop_pool()
+    fakes.stop()
+    shutil.rmtree(workdir, ignore_errors=True)
+  session = latency_stats(latencies)
+  session.update(throughput_per_s=args.sessions / wall,
+                 cpu_seconds=cpu,
+                 cpu_ms_per_session=cpu / args.sessions * 1000,
+                 evaluator_cpu_seconds=workers_cpu)
+  return dict(benchmark='session',
+              git=git_revision(),
+              timestamp=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              python=platform.python_version(),
+              platform=platform.platform(),
+              parameters=vars(args),
+              prepare=latency_stats(prepare),
+              session=session,
+              memory=dict(peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                          evaluator_peak_rss_kb=workers_rss),
+              requests=fakes.requests())
+
+def compare(result, previous):
+  print('Compared to {0} ({1}):'.format(previous['git']['commit'], previous['timestamp']))
+  for section, key in [('prepare','median_ms'), ('session','median_ms'), ('session','p95_ms'),
+                       ('session','throughput_per_s'), ('session','cpu_ms_per_session'),
+                       ('memory','peak_rss_kb')]:
+    old, new = previous.get(section,dict()).get(key), result[section][key]
+    if old:
+      print('  {0}.{1:<20} {2:12.3f} -> {3:12.3f}  ({4:+.1f}%)'
+            .format(section, key, old, new, (new-old)/old*100))
+
+def save(result, output):
+  if output is None:
+    directory = os.path.join(HERE, 'results')
+    os.makedirs(directory, exist_ok=True)
+    output = os.path.join(directory, 'session-{0}-{1}.json'.format(
+      (result['git']['commit'] or 'unknown')[:10], time.strftime('%Y%m%d-%H%M%S')))
+  with open(output, 'w') as f:
+    json.dump(result, f, indent=2, sort_keys=True)
+  return output
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark policy keeper sessions against fake services')
+  parser.add_argument('--nodes', type=int, default=1)
+  parser.add_argument('--services', type=int, default=5)
+  parser.add_argument('--queries', type=int, default=10)
+  parser.add_argument('--complexity', type=int, default=10, help='smoothing steps per scaling rule')
+  parser.add_argument('--alerts', type=int, default=0)
+  parser.add_argument('--optimizer', action='store_true', help='use the optimizer in the node rules')
+  parser.add_argument('--node-instances', type=int, default=2, help='Kubernetes nodes per policy node')
+  parser.add_argument('--sessions', type=int, default=20)
+  parser.add_argument('--warmup', type=int, default=2)
+  parser.add_argument('--prepare-runs', type=int, default=3)
+  parser.add_argument('--engine', choices=['sync','async'], default='sync')
+  parser.add_argument('--budget', type=float, default=None, help='session time budget in seconds')
+  parser.add_argument('--latency', type=float, default=0.0, help='added latency of the fakes in seconds')
+  parser.add_argument('--series', type=int, default=1, help='series in each Prometheus response')
+  parser.add_argument('--batching', action='store_true', help='combine the Prometheus queries into batches')
+  parser.add_argument('--log-level', default='ERROR')
+  parser.add_argument('--output', help='result file, by default under benchmarks/results')
+  parser.add_argument('--compare', help='previous result file to compare with')
+  args = parser.parse_args()
+  logging.basicConfig(level=getattr(logging, args.log_level.upper()),
+                      format='%(asctime)s %(name)s %(message)s')
+  result = run(args)
+  print('prepare_session:     median {median_ms:8.2f} ms  p95 {p95_ms:8.2f} ms'.format(**result['prepare']))
+  print('perform_one_session: median {median_ms:8.2f} ms  p95 {p95_ms:8.2f} ms  '
+        '{throughput_per_s:7.2f} sessions/s  cpu {cpu_ms_per_session:7.2f} ms/session'.format(**result['session']))
+  print('peak rss: keeper {peak_rss_kb} kB, evaluator {evaluator_peak_rss_kb} kB'.format(**result['memory']))
+  print('Saved to {0}'.format(save(result, args.output)))
+  if args.compare:
+    with open(args.compare) as f:
+      compare(result, json.load(f))
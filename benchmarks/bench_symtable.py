@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Micro-benchmark of building the evaluator symbol table.
+
+Compares creating a new numpy-backed symbol table and interpreter for
+every evaluation against layering the input variables over the base
+symbol table prebuilt once per worker. Both variants run in-process so
+that only the evaluation itself is measured.
+
+  python benchmarks/bench_symtable.py --iterations 500
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import tracemalloc
+from asteval import Interpreter, make_symbol_table
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import evaluator
+
+RULE = """
+if ITEMS > 0:
+  m_container_count = ceil(AET/(REMAININGTIME/ITEMS))
+"""
+INPUTS = dict(ITEMS=120.0, AET=30, REMAININGTIME=600.0, m_container_count=1)
+OUTPUTS = ['m_container_count']
+
+def evaluate_per_call_symtable(eval_code, input_variables, output_variables):
+  sym = make_symbol_table(time=time, use_numpy=True, range=range, **input_variables)
+  aeval = Interpreter(symtable=sym, use_numpy=True, no_try=True, no_functiondef=True,
+                      no_listcomp=True, no_assert=True, no_delete=True, no_raise=True)
+  aeval(eval_code)
+  return {x: sym[x] for x in sym if x in output_variables}
+
+def evaluate_prebuilt_symtable(eval_code, input_variables, output_variables):
+  return evaluator.evaluate_in_worker(eval_code, input_variables, output_variables)[0]
+
+def measure(func, iterations):
+  func(RULE, INPUTS, OUTPUTS)
+  latencies = []
+  for x in range(iterations):
+    start = time.perf_counter()
+    func(RULE, INPUTS, OUTPUTS)
+    latencies.append(time.perf_counter() - start)
+  tracemalloc.start()
+  before = tracemalloc.take_snapshot()
+  func(RULE, INPUTS, OUTPUTS)
+  after = tracemalloc.take_snapshot()
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  allocated = sum(x.size_diff for x in after.compare_to(before, 'filename') if x.size_diff > 0)
+  blocks = sum(x.count_diff for x in after.compare_to(before, 'filename') if x.count_diff > 0)
+  return dict(mean_ms=statistics.mean(latencies)*1000,
+              median_ms=statistics.median(latencies)*1000,
+              p95_ms=sorted(latencies)[int(len(latencies)*0.95)]*1000,
+              peak_kb=peak/1024.0,
+              retained_kb=allocated/1024.0,
+              retained_blocks=blocks)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark evaluator symbol table handling')
+  parser.add_argument('--iterations', type=int, default=200)
+  args = parser.parse_args()
+  for name, func in [('per-call symtable', evaluate_per_call_symtable),
+                     ('prebuilt symtable', evaluate_prebuilt_symtable)]:
+    result = measure(func, args.iterations)
+    print('{0:<18} mean {mean_ms:8.3f} ms  median {median_ms:8.3f} ms  p95 {p95_ms:8.3f} ms  '
+          'peak {peak_kb:9.1f} kB  retained {retained_kb:8.1f} kB in {retained_blocks} blocks'
+          .format(name, **result))
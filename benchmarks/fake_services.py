@@ -0,0 +1,249 @@
+"""Local stand-ins of the services the policy keeper talks to.
+
+Each fake is a threaded HTTP server on an ephemeral port answering just
+enough of the API for the keeper: Prometheus instant queries, the Occopus
+infrastructure and scaling calls, the optimizer init/sample/advice calls and
+the Kubernetes node and deployment calls made through pykube. A fixed
+latency can be added to every response to emulate slow dependencies.
+"""
+import re
+import json
+import time
+import random
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+KUBECONFIG = """apiVersion: v1
+kind: Config
+clusters:
+- cluster:
+    server: {0}
+  name: bench
+contexts:
+- context:
+    cluster: bench
+    user: bench
+  name: bench
+current-context: bench
+users:
+- name: bench
+  user: {{}}
+"""
+
+class FakeHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *args):
+    pass
+
+  def send(self, obj, code=200):
+    body = json.dumps(obj).encode()
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def read_body(self):
+    length = int(self.headers.get('Content-Length') or 0)
+    return self.rfile.read(length) if length else b''
+
+  def dispatch(self, method):
+    url = urllib.parse.urlparse(self.path)
+    query = urllib.parse.parse_qs(url.query)
+    body = self.read_body()
+    fake = self.server.fake
+    fake.count(method, url.path)
+    if fake.latency:
+      time.sleep(fake.latency)
+    fake.handle(self, method, url.path, query, body)
+
+  def do_GET(self):
+    self.dispatch('GET')
+
+  def do_POST(self):
+    self.dispatch('POST')
+
+  def do_PATCH(self):
+    self.dispatch('PATCH')
+
+  def do_PUT(self):
+    self.dispatch('PUT')
+
+class FakeService(object):
+  """ Base of the fakes: runs the server and counts the requests. """
+  def __init__(self, latency=0.0):
+    self.latency = latency
+    self.requests = dict()
+    self.lock = threading.Lock()
+    self.server = None
+
+  def count(self, method, path):
+    with self.lock:
+      self.requests[method] = self.requests.get(method, 0) + 1
+
+  def start(self):
+    self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeHandler)
+    self.server.daemon_threads = True
+    self.server.fake = self
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    return self
+
+  def stop(self):
+    if self.server is not None:
+      self.server.shutdown()
+      self.server.server_close()
+
+  @property
+  def url(self):
+    return 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+
+  def handle(self, handler, method, path, query, body):
+    handler.send(dict(), 404)
+
+BATCH_PART_RE = re.compile(r'"pk_batch", "(\d+)", "", ""\)')
+
+class FakePrometheus(FakeService):
+  """ Answers every instant query with a vector of random samples.
+
+  A batch of queries combined by the keeper gets the samples of each part,
+  tagged with the label of the part.
+  """
+  def __init__(self, latency=0.0, series=1):
+    super(FakePrometheus, self).__init__(latency)
+    self.series = series
+
+  def samples(self, now, labels=dict()):
+    return [ dict(metric=dict(labels, instance='instance{0}'.format(i)),
+                  value=[now, str(round(random.uniform(0, 100), 3))])
+             for i in range(self.series) ]
+
+  def handle(self, handler, method, path, query, body):
+    if path == '/-/reload':
+      return handler.send(dict())
+    if path != '/api/v1/query':
+      return handler.send(dict(status='error'), 404)
+    if method == 'POST':
+      query = urllib.parse.parse_qs(body.decode())
+    now = time.time()
+    parts = BATCH_PART_RE.findall(query.get('query', [''])[0])
+    if parts:
+      result = [ x for part in parts for x in self.samples(now, dict(pk_batch=part)) ]
+    else:
+      result = self.samples(now)
+    handler.send(dict(status='success', data=dict(resultType='vector', result=result)))
+
+class FakeOccopus(FakeService):
+  """ Keeps the target node count of each node of the infrastructures. """
+  def __init__(self, latency=0.0):
+    super(FakeOccopus, self).__init__(latency)
+    self.targets = dict()
+
+  def handle(self, handler, method, path, query, body):
+    parts = path.strip('/').split('/')
+    if len(parts) == 2 and parts[0] == 'infrastructures':
+      return handler.send({ name: dict(scaling=dict(target=target))
+                            for name, target in self.targets.items() })
+    if len(parts) == 5 and parts[2] == 'scaleto':
+      self.targets[parts[3]] = int(parts[4])
+      return handler.send(dict(infraid=parts[1]))
+    if len(parts) == 5 and parts[2] == 'scaledown':
+      self.targets[parts[3]] = max(self.targets.get(parts[3], 1) - 1, 0)
+      return handler.send(dict(infraid=parts[1]))
+    handler.send(dict(), 404)
+
+class FakeOptimizer(FakeService):
+  """ Accepts init and samples, always advises the current number of VMs. """
+  def handle(self, handler, method, path, query, body):
+    if path.endswith('/init') or path.endswith('/sample'):
+      return handler.send(dict(status='OK'))
+    if path.endswith('/advice'):
+      return handler.send(dict(valid=True, phase='production', vmnumber=1,
+                               confident=1.0, errmsg=None))
+    handler.send(dict(), 404)
+
+class FakeKubernetes(FakeService):
+  """ Serves the nodes and the deployments, and applies the scale patches. """
+  def __init__(self, latency=0.0):
+    super(FakeKubernetes, self).__init__(latency)
+    self.nodes = dict()
+    self.deployments = dict()
+    self.version = 1
+
+  def add_node(self, name, node_type):
+    self.nodes[name] = dict(
+      metadata=dict(name=name, labels={'micado.eu/node_type': node_type},
+                    resourceVersion=str(self.version)),
+      spec=dict(),
+      status=dict(conditions=[dict(type='Ready', status='True')],
+                  addresses=[dict(type='InternalIP', address='10.0.{0}.{1}'.format(*divmod(len(self.nodes), 250)))]))
+
+  def add_deployment(self, name, replicas, namespace='default'):
+    self.deployments[name] = dict(apiVersion='apps/v1', kind='Deployment',
+      metadata=dict(name=name, namespace=namespace, resourceVersion=str(self.version)),
+      spec=dict(replicas=replicas))
+
+  def watch(self, handler, query):
+    handler.send_response(200)
+    handler.send_header('Content-Type', 'application/json')
+    handler.send_header('Transfer-Encoding', 'chunked')
+    handler.end_headers()
+    time.sleep(min(float(query.get('timeoutSeconds', ['5'])[0]), 5))
+    handler.wfile.write(b'0\r\n\r\n')
+    handler.wfile.flush()
+
+  def handle(self, handler, method, path, query, body):
+    parts = path.strip('/').split('/')
+    if path == '/api/v1/nodes':
+      if query.get('watch'):
+        return self.watch(handler, query)
+      return handler.send(dict(kind='NodeList', metadata=dict(resourceVersion=str(self.version)),
+                               items=list(self.nodes.values())))
+    if path.endswith('/deployments'):
+      namespace = parts[4] if 'namespaces' in parts else None
+      items = [ x for x in self.deployments.values()
+                if namespace in (None, x['metadata']['namespace']) ]
+      selector = query.get('fieldSelector')
+      if selector:
+        name = selector[0].split('=')[-1]
+        items = [ x for x in items if x['metadata']['name'] == name ]
+      return handler.send(dict(kind='DeploymentList', metadata=dict(resourceVersion=str(self.version)),
+                               items=items))
+    if 'deployments' in parts:
+      name = parts[parts.index('deployments')+1]
+      deployment = self.deployments.get(name)
+      if deployment is None:
+        return handler.send(dict(kind='Status', code=404), 404)
+      if method in ('PATCH', 'PUT'):
+        self.version += 1
+        deployment['spec'].update(json.loads(body or b'{}').get('spec', dict()))
+        deployment['metadata']['resourceVersion'] = str(self.version)
+      return handler.send(deployment)
+    handler.send(dict(kind='Status', code=404), 404)
+
+class FakeServices(object):
+  """ All the fakes of one benchmark run. """
+  def __init__(self, latency=0.0, series=1):
+    self.prometheus = FakePrometheus(latency, series)
+    self.occopus = FakeOccopus(latency)
+    self.optimizer = FakeOptimizer(latency)
+    self.kubernetes = FakeKubernetes(latency)
+    self.all = [self.prometheus, self.occopus, self.optimizer, self.kubernetes]
+
+  def start(self):
+    for fake in self.all:
+      fake.start()
+    return self
+
+  def stop(self):
+    for fake in self.all:
+      fake.stop()
+
+  def write_kubeconfig(self, path):
+    with open(path, 'w') as f:
+      f.write(KUBECONFIG.format(self.kubernetes.url))
+    return path
+
+  def requests(self):
+    return { type(x).__name__[4:].lower(): dict(x.requests) for x in self.all }
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Generator of synthetic scaling policies for the benchmarks.
+
+The policy has the given number of nodes, services, Prometheus queries and
+alerts. Each scaling rule reads a few of the queries, and the complexity
+sets the number of smoothing steps computed by the rule.
+
+  python benchmarks/policy_generator.py --nodes 2 --services 10 --queries 20
+"""
+import sys
+import argparse
+from ruamel import yaml
+from ruamel.yaml.scalarstring import LiteralScalarString
+
+QUERIES_PER_RULE = 3
+
+def rule_queries(index, queries):
+  if not queries:
+    return []
+  return [ 'Q{0}'.format((index*QUERIES_PER_RULE + i) % queries)
+           for i in range(min(QUERIES_PER_RULE, queries)) ]
+
+def scaling_rule(output, index, queries, complexity, minimum, maximum):
+  names = rule_queries(index, queries)
+  lines = [ 'load = ({0}) / {1}'.format(' + '.join(names), len(names)) if names else 'load = 50' ]
+  if complexity > 0:
+    lines += [ 'level = load',
+               'for step in range({0}):'.format(int(complexity)),
+               '  level = level * 0.8 + load * 0.2 + step * 0.001',
+               'load = level' ]
+  lines += [ 'if load > 60:',
+             '  {0} = min({0} + 1, {1})'.format(output, maximum),
+             'elif load < 20:',
+             '  {0} = max({0} - 1, {1})'.format(output, minimum) ]
+  return '\n'.join(lines) + '\n'
+
+def generate_policy(nodes=1, services=5, queries=10, complexity=10, alerts=0,
+                    optimizer=False, stack='bench', dryrun=()):
+  """ Returns the policy as a dict. """
+  constants = dict(LIMIT=60)
+  if dryrun:
+    constants['m_dryrun'] = list(dryrun)
+  data = dict(constants=constants,
+              queries={ 'Q{0}'.format(i): 'avg(rate(bench_metric_{0}[1m]))'.format(i)
+                        for i in range(queries) },
+              alerts=[ dict(alert='ALERT{0}'.format(i), expr='bench_metric_{0} > 100'.format(i),
+                            **{'for': '1m'}) for i in range(alerts) ])
+  if optimizer:
+    constants.update(m_opt_init_training_samples_required=3,
+                     m_opt_init_min_vm_number=1, m_opt_init_max_vm_number=10)
+    data['queries'].update(m_opt_input_LOAD='avg(bench_metric_0)',
+                           m_opt_target_query_LATENCY='avg(bench_latency)',
+                           m_opt_target_minth_LATENCY=1, m_opt_target_maxth_LATENCY=5)
+  scaling = dict(nodes=[], services=[])
+  for i in range(nodes):
+    rule = scaling_rule('m_node_count', i, queries, complexity, 1, 10)
+    if optimizer:
+      rule = 'advice = m_opt_advice()\n' + rule
+    if alerts:
+      rule += 'if ALERT{0}:\n  m_node_count = 10\n'.format(i % alerts)
+    scaling['nodes'].append(dict(name='node{0}'.format(i), min_instances=1, max_instances=10,
+                                 scaling_rule=LiteralScalarString(rule)))
+  for i in range(services):
+    rule = scaling_rule('m_container_count', nodes + i, queries, complexity, 1, 20)
+    if alerts:
+      rule += 'if ALERT{0}:\n  m_container_count = 20\n'.format((nodes + i) % alerts)
+    scaling['services'].append(dict(name='svc{0}'.format(i), min_instances=1, max_instances=20,
+                                    scaling_rule=LiteralScalarString(rule)))
+  return dict(stack=stack, data=data, scaling=scaling)
+
+def policy_yaml(policy):
+  return yaml.round_trip_dump(policy, default_flow_style=False)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Generate a synthetic scaling policy')
+  parser.add_argument('--nodes', type=int, default=1)
+  parser.add_argument('--services', type=int, default=5)
+  parser.add_argument('--queries', type=int, default=10)
+  parser.add_argument('--complexity', type=int, default=10)
+  parser.add_argument('--alerts', type=int, default=0)
+  parser.add_argument('--optimizer', action='store_true')
+  parser.add_argument('--stack', default='bench')
+  args = parser.parse_args()
+  sys.stdout.write(policy_yaml(generate_policy(args.nodes, args.services, args.queries,
+                   args.complexity, args.alerts, args.optimizer, args.stack)))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""Synthetic Prometheus remote write client for the keeper's /api/v1/write.
+
+Pushes random samples of the given metrics, each with a number of series
+labelled instance="instanceN", the way a Prometheus remote_write would. It
+drives the remote write receiver without a real Prometheus.
+
+  python benchmarks/remote_write_pusher.py --url http://localhost:12345 \\
+      --metric queue_length --metric worker_load --series 3 --interval 2
+"""
+import time
+import random
+import struct
+import argparse
+import requests
+
+def varint(value):
+  value &= (1 << 64) - 1
+  out = bytearray()
+  while True:
+    byte = value & 0x7f
+    value >>= 7
+    if value:
+      out.append(byte | 0x80)
+    else:
+      out.append(byte)
+      return bytes(out)
+
+def field(number, wire, payload):
+  key = varint((number << 3) | wire)
+  if wire == 2:
+    return key + varint(len(payload)) + payload
+  return key + payload
+
+def encode_write_request(timeseries):
+  """ Encodes (labels, [(timestamp ms, value)]) pairs as a prometheus.WriteRequest. """
+  message = b''
+  for labels, samples in timeseries:
+    series = b''.join(field(1, 2, field(1, 2, k.encode()) + field(2, 2, v.encode()))
+                      for k, v in sorted(labels.items()))
+    series += b''.join(field(2, 2, field(1, 1, struct.pack('<d', value)) + field(2, 0, varint(timestamp)))
+                       for timestamp, value in samples)
+    message += field(1, 2, series)
+  return message
+
+def snappy_compress(data):
+  """ Snappy block made of literals only: valid, though not compressed. """
+  out = bytearray(varint(len(data)))
+  for pos in range(0, len(data), 65536):
+    chunk = data[pos:pos+65536]
+    out += bytes([62 << 2]) + (len(chunk)-1).to_bytes(3, 'little') + chunk
+  return bytes(out)
+
+def push(url, timeseries):
+  response = requests.post(url.rstrip('/') + '/api/v1/write',
+                           data=snappy_compress(encode_write_request(timeseries)),
+                           headers={'Content-Encoding': 'snappy',
+                                    'Content-Type': 'application/x-protobuf',
+                                    'X-Prometheus-Remote-Write-Version': '0.1.0'})
+  response.raise_for_status()
+  return response
+
+def synthetic_timeseries(metrics, series, low, high):
+  now = int(time.time() * 1000)
+  return [ (dict(__name__=metric, instance='instance{0}'.format(i)), [(now, random.uniform(low, high))])
+           for metric in metrics for i in range(series) ]
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Push synthetic samples to the remote write receiver of the keeper')
+  parser.add_argument('--url', default='http://localhost:12345')
+  parser.add_argument('--metric', action='append', required=True, help='metric name, can be repeated')
+  parser.add_argument('--series', type=int, default=1, help='series per metric')
+  parser.add_argument('--low', type=float, default=0.0)
+  parser.add_argument('--high', type=float, default=100.0)
+  parser.add_argument('--interval', type=float, default=5.0, help='seconds between pushes')
+  parser.add_argument('--count', type=int, default=0, help='number of pushes, 0 for no limit')
+  args = parser.parse_args()
+  pushed = 0
+  while not args.count or pushed < args.count:
+    push(args.url, synthetic_timeseries(args.metric, args.series, args.low, args.high))
+    pushed += 1
+    print('Pushed {0} series ({1})'.format(len(args.metric) * args.series, pushed))
+    if not args.count or pushed < args.count:
+      time.sleep(args.interval)
@@ -1,15 +1,48 @@
+import re
 import sys
+import ast
 import time
+import types
+import hashlib
+import queue
+import resource
+import importlib
+import cProfile
 import multiprocessing
 from multiprocessing.queues import Queue
 import copy
+from collections import ChainMap, OrderedDict
 from asteval import Interpreter, make_symbol_table
 import threading
 import logging
+import pk_config
+import pk_metrics
+import pk_deadline
+import pk_profiler
 
 log = None
 queue_store = None
 queue_thread = None
+pool = None
+interpreter = None
+base_symtable = None
+
+DEFAULT_rule_cache_size = 256
+
+rule_cache_hits = pk_metrics.counter('pk_rule_cache_hits_total',
+  'Scaling rule evaluations served from the compiled rule cache')
+rule_cache_misses = pk_metrics.counter('pk_rule_cache_misses_total',
+  'Scaling rules parsed because they were missing from the compiled rule cache')
+rule_parse_seconds = pk_metrics.counter('pk_rule_parse_seconds_total',
+  'Time spent parsing scaling rules')
+worker_spawn_seconds = pk_metrics.histogram('pk_evaluator_spawn_seconds',
+  'Time to start an evaluator worker process')
+worker_run_seconds = pk_metrics.histogram('pk_evaluator_run_seconds',
+  'Time from sending a scaling rule to an evaluator worker to receiving its result')
+errors_total = pk_metrics.counter('pk_errors_total',
+  'Errors by component', ('component',))
+timeouts_total = pk_metrics.counter('pk_timeouts_total',
+  'Timeouts by component', ('component',))
 
 def init_logging():
   global log, logstream, queue_store
@@ -17,12 +50,17 @@ def init_logging():
  
 def init_queue_reading(): 
   global queue_thread, queue_store
+  if queue_store is not None:
+    return
   queue_store = StdoutQueue()
   queue_thread = threading.Thread(target=text_catcher,args=(queue_store,))
   queue_thread.start()
 
 def stop_queue_reading():
   global queue_thread, queue_store
+  stop_pool()
+  if queue_store is None:
+    return
   queue_store.close()
   queue_store = None
 
@@ -49,76 +87,233 @@ class StdoutQueue(Queue):
 class TimeoutException(Exception):
     """ It took too long to compile and execute. """
 
-class RunnableProcessing(multiprocessing.Process):
-    """ Run a function in a child process.
+class RuleCache(object):
+    """ Parsed scaling rules keyed by the hash of the rule text.
 
-    Pass back any exception received.
+    Holds at most max_rules trees, the least recently used ones are dropped
+    first, so the rules of unloaded policies do not pile up in the keeper
+    and in the long-lived evaluator workers.
     """
-    #def __init__(self, func, q, *args, **kwargs):
-    def __init__(self, func, *args, **kwargs):
-        self.queue = multiprocessing.Queue(maxsize=1)
-        #args = (func, q, ) + args
-        args = (func, ) + args
-        multiprocessing.Process.__init__(self, target=self.run_func,
-            args=args, kwargs=kwargs)
-        
-
-    #def run_func(self, func, q, *args, **kwargs):
-    def run_func(self, func, *args, **kwargs):
+    def __init__(self, max_rules=DEFAULT_rule_cache_size):
+        self.max_rules = max_rules
+        self.lock = threading.Lock()
+        self.trees = OrderedDict()
+
+    def configure(self, max_rules):
+        with self.lock:
+            self.max_rules = max(int(max_rules), 1)
+            self.trim()
+
+    def trim(self):
+        while len(self.trees) > self.max_rules:
+            self.trees.popitem(last=False)
+
+    def compile(self, code):
+        """Returns the AST of the rule, whether it was cached and the parse time.
+
+        A rule failing to parse is cached with its SyntaxError as AST.
+        """
+        key = hashlib.sha1(code.encode()).hexdigest()
+        with self.lock:
+            tree = self.trees.get(key)
+            if tree is not None:
+                self.trees.move_to_end(key)
+                return tree, True, 0.0
+        now = time.time()
         try:
-            #sys.stdout = q
-            #q.write("\n")
-            #result = func(q, *args, **kwargs)
-            result = func(*args, **kwargs)
-            self.queue.put((True, result))
-        except Exception as e:
-            self.queue.put((False, e))
+            tree = ast.parse(code)
+        except SyntaxError as e:
+            tree = e
+        parse_time = time.time() - now
+        with self.lock:
+            self.trees[key] = tree
+            self.trim()
+        return tree, False, parse_time
 
-    def done(self):
-        return self.queue.full()
+rule_cache = RuleCache()
 
-    def result(self):
-        x = self.queue.get()
-        self.queue.close()
-        del self.queue
-        return x
-        
+def account_rule_cache(hit, parse_time):
+  if hit:
+    rule_cache_hits.inc()
+    pk_config.count('rule_cache_hits')
+  else:
+    rule_cache_misses.inc()
+    rule_parse_seconds.inc(parse_time)
+    pk_config.count('rule_cache_misses')
+    pk_config.count('rule_parse_seconds', parse_time)
 
+def compile_rule(code):
+  tree, hit, parse_time = rule_cache.compile(code)
+  account_rule_cache(hit, parse_time)
+  return tree
 
-def timeout(seconds, force_kill=True):
-    """ Timeout decorator using Python multiprocessing.
+IDENTIFIER_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
 
-    Courtesy of http://code.activestate.com/recipes/577853-timeout-decorator-with-multiprocessing/
+def rule_identifiers(code):
+  """ Returns the names used by a rule, taken from its AST.
+
+  If the rule cannot be parsed, every identifier-like token of the text is returned.
+  """
+  tree = compile_rule(code)
+  if isinstance(tree, SyntaxError):
+    return frozenset(IDENTIFIER_RE.findall(code))
+  return frozenset(x.id for x in ast.walk(tree) if isinstance(x, ast.Name))
+
+def rule_cache_stats():
+  """ Returns the rule cache hits, misses and parse time of the current policy. """
+  ctx = pk_config.context()
+  return dict(hits=ctx.counter('rule_cache_hits'),
+              misses=ctx.counter('rule_cache_misses'),
+              parse_time=ctx.counter('rule_parse_seconds'))
+
+class EvaluatorWorker(object):
+    """ A pre-forked child process evaluating scaling rules.
+
+    Jobs are received and results are passed back through a pipe.
     """
-    def wrapper(function):
-        def inner(*args, **kwargs):
-            queue_store.write('==== [{0}] Executing the user defined algorithm starts... ===='
-                              .format(time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())))
-            now = time.time()
-            proc = RunnableProcessing(function, *args, **kwargs)
-            proc.start()
-            proc.join(seconds)
-            if proc.is_alive():
-                if force_kill:
-                    proc.terminate()
-                runtime = time.time() - now
-                raise TimeoutException('timed out after {0} seconds'.format(runtime))
-            assert proc.done()
-            queue_store.write('==== [{0}] Executing the user defined algorithm finished. ===='
-                              .format(time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())))
-            success, result = proc.result()
-            if success:
-                return result
+    def __init__(self):
+        start = time.time()
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=worker_loop,
+            args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        worker_spawn_seconds.observe(time.time()-start)
+        self.evaluations = 0
+        self.maxrss = 0
+
+    def run(self, seconds, *args):
+        self.conn.send(args)
+        if not self.conn.poll(seconds):
+            raise TimeoutException('timed out after {0} seconds'.format(seconds))
+        success, result, self.maxrss = self.conn.recv()
+        self.evaluations += 1
+        return success, result
+
+    def stop(self, force=False):
+        try:
+            if not force:
+                self.conn.send(None)
+                self.process.join(1)
+        except Exception:
+            pass
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+
+class ModuleReference(object):
+    """ Picklable placeholder for a module passed as input variable. """
+    def __init__(self, name):
+        self.name = name
+
+
+def pack_variables(variables):
+  return { k: ModuleReference(v.__name__) if isinstance(v, types.ModuleType) else v
+           for k, v in variables.items() }
+
+def unpack_variables(variables):
+  return { k: importlib.import_module(v.name) if isinstance(v, ModuleReference) else v
+           for k, v in variables.items() }
+
+def worker_loop(conn):
+  # The forked worker outlives the session and the policy it was started from
+  pk_deadline.current.set(None)
+  pk_deadline.cancelled.set(None)
+  pk_config.current_context.set(pk_config.default_context)
+  while True:
+    try:
+      job = conn.recv()
+    except EOFError:
+      break
+    if job is None:
+      break
+    func, args = job[0], job[1:]
+    try:
+      result = (True, func(*args))
+    except Exception as e:
+      result = (False, e)
+    conn.send(result + (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,))
+  conn.close()
+
+
+class EvaluatorPool(object):
+    """ Pool of reusable evaluator workers.
+
+    A worker exceeding the timeout is killed and replaced. Workers are
+    recycled after a number of evaluations or when their memory (in kB)
+    grows beyond the limit.
+    """
+    def __init__(self, size=1, seconds=15, max_evaluations=100, max_memory=262144):
+        self.seconds = seconds
+        self.max_evaluations = max_evaluations
+        self.max_memory = max_memory
+        self.idle = queue.Queue()
+        self.workers = [ EvaluatorWorker() for x in range(max(int(size),1)) ]
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def replace(self, worker, force=False):
+        worker.stop(force)
+        newworker = EvaluatorWorker()
+        self.workers[self.workers.index(worker)] = newworker
+        return newworker
+
+    def run(self, func, *args):
+        seconds = pk_deadline.clip(self.seconds)
+        worker = self.idle.get()
+        try:
+            with worker_run_seconds.timer():
+                success, result = worker.run(seconds, func, *args)
+        except (TimeoutException, EOFError, OSError) as e:
+            worker = self.replace(worker, force=True)
+            if isinstance(e, TimeoutException):
+                timeouts_total.inc(component='evaluator')
             else:
-                raise result
-        return inner
-    return wrapper
+                errors_total.inc(component='evaluator')
+            if isinstance(e, TimeoutException) and seconds < self.seconds:
+                pk_deadline.budget_exceeded.inc()
+                raise pk_deadline.DeadlineExceeded('session deadline exceeded during evaluation')
+            raise
+        finally:
+            if worker.evaluations >= self.max_evaluations or \
+               worker.maxrss > self.max_memory:
+                logging.getLogger('pk_usercode').debug('Recycling evaluator worker after {0} evaluations, maxrss {1} kB'
+                          .format(worker.evaluations, worker.maxrss))
+                worker = self.replace(worker)
+            self.idle.put(worker)
+        if success:
+            return result
+        errors_total.inc(component='evaluator')
+        raise result
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+
+
+def init_pool():
+  global pool
+  if pool is None:
+    config = pk_config.config() or dict()
+    rule_cache.configure(config.get('evaluator_rule_cache_size', DEFAULT_rule_cache_size))
+    pool = EvaluatorPool(config.get('evaluator_pool_size', 1),
+                         config.get('evaluator_timeout', 15),
+                         config.get('evaluator_max_evaluations', 100),
+                         config.get('evaluator_max_memory_mb', 256)*1024)
+  return pool
+
+def stop_pool():
+  global pool
+  if pool is not None:
+    pool.close()
+    pool = None
 
 
-@timeout(15)
 def evaluate(eval_code, input_variables={}, output_variables=[]):
-#def evaluate(q, eval_code, input_variables={}, output_variables=[]):
-    """Evaluates a given expression, with the timeout given as decorator.
+    """Evaluates a given expression in a worker of the evaluator pool.
 
     Args:
         eval_code (str): The code to be evaluated.
@@ -129,14 +324,34 @@ def evaluate(eval_code, input_variables={}, output_variables=[]):
         dict: the output variables or empty.
 
     """
-    # FIXME: use_numpy the process blocks infinitely at the return statement
-    import time
-    sym = make_symbol_table(time=time, use_numpy=True, range=range, **input_variables)
-    #print("LOGGER:"+str(log))
-    aeval = Interpreter(
+    queue_store.write('==== [{0}] Executing the user defined algorithm starts... ===='
+                      .format(time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())))
+    if pk_profiler.profiling_evaluations():
+        (result, hit, parse_time), stats, seconds = init_pool().run(profile_in_worker,
+            evaluate_in_worker, eval_code, pack_variables(input_variables), output_variables)
+        pk_profiler.add_evaluation(stats, seconds)
+    else:
+        result, hit, parse_time = init_pool().run(evaluate_in_worker, eval_code,
+                                 pack_variables(input_variables), output_variables)
+    account_rule_cache(hit, parse_time)
+    queue_store.write('==== [{0}] Executing the user defined algorithm finished. ===='
+                      .format(time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())))
+    return result
+
+
+def init_interpreter():
+  """ Creates the interpreter and its base symbol table once per worker.
+
+  Each evaluation layers its input variables and assignments over the
+  base symbol table instead of building a new one.
+  """
+  global interpreter, base_symtable
+  if interpreter is None:
+    base_symtable = make_symbol_table(time=time, use_numpy=True, range=range)
+    interpreter = Interpreter(
         writer = queue_store,
         err_writer = queue_store,
-        symtable = sym,
+        symtable = base_symtable,
         use_numpy = True,
         no_if = False,
         no_for = False,
@@ -150,13 +365,54 @@ def evaluate(eval_code, input_variables={}, output_variables=[]):
         no_delete = True,
         no_raise = True,
         no_print = False)
+  return interpreter
 
 
-    aeval(eval_code)
-    symtable = {x: sym[x] for x in sym if x in output_variables}
+def profile_in_worker(func, *args):
+    """ Runs func under cProfile inside an evaluator worker.
+
+    Returns the result of func, the profile stats and the CPU time spent.
+    """
+    profile = cProfile.Profile()
+    start = time.process_time()
+    result = profile.runcall(func, *args)
+    seconds = time.process_time() - start
+    profile.create_stats()
+    return result, profile.stats, seconds
+
+
+def evaluate_in_worker(eval_code, input_variables={}, output_variables=[]):
+    """Evaluates a given expression, called inside an evaluator worker.
+
+    The AST of the expression is taken from the compiled rule cache.
+
+    Args:
+        eval_code (str): The code to be evaluated.
+        input_variables (dict): dictionary of input variables and their values.
+        output_variables (array): array of names of output variables.
+
+    Returns:
+        tuple: the output variables or empty, whether the AST was cached
+        and the time spent parsing.
+
+    """
+    aeval = init_interpreter()
+    sym = ChainMap(dict(), unpack_variables(input_variables), base_symtable)
+    aeval.symtable = sym
+    aeval.error = []
+    aeval._interrupt = None
+    tree, hit, parse_time = rule_cache.compile(eval_code)
+    if isinstance(tree, SyntaxError):
+        print('Syntax Error: {0}'.format(tree), file=aeval.err_writer)
+    else:
+        try:
+            aeval.run(tree, expr=eval_code, lineno=0)
+        except Exception as e:
+            errmsg = "\n".join(aeval.error[0].get_error()) if aeval.error else str(e)
+            print(errmsg, file=aeval.err_writer)
+    symtable = {x: sym[x] for x in output_variables if x in sym}
 
-    
-    return symtable
+    return symtable, hit, parse_time
 
 
 if __name__ == "__main__":
@@ -1,13 +1,153 @@
+import os
+import json
 import logging
 import pk_config
+import pk_metrics
 import time
+import threading
 
 import pykube
 
 dryrun_id = "k8s"
 MASTER = "node-role.kubernetes.io/master"
+NODE_TYPE = "micado.eu/node_type"
 
-kube = pykube.HTTPClient(pykube.KubeConfig.from_file("/root/.kube/config"))
+kube = pykube.HTTPClient(
+    pykube.KubeConfig.from_file(os.environ.get("KUBECONFIG", "/root/.kube/config"))
+)
+
+
+class NodeInformer:
+    """
+    Local cache of the cluster nodes, kept up to date by a watch stream
+
+    The cache is indexed by node type label, readiness and taints, so that
+    node queries are answered without calling the API server.
+    """
+
+    def __init__(self, config, watch_timeout=300):
+        self.api = pykube.HTTPClient(config, timeout=watch_timeout + 30)
+        self.watch_timeout = watch_timeout
+        self.lock = threading.Lock()
+        self.synced = threading.Event()
+        self.nodes = {}
+        self.by_type = {}
+        self.down = set()
+        self.thread = threading.Thread(
+            target=self.run, name="NodeInformerThread", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        log = logging.getLogger("pk_k8s")
+        while True:
+            try:
+                version = self.relist()
+                while version:
+                    version = self.watch(version)
+            except Exception as e:
+                log.warning("(I) Watching k8s nodes failed, relisting: {0}".format(e))
+                self.synced.clear()
+                time.sleep(5)
+
+    def relist(self):
+        query = pykube.Node.objects(self.api)
+        nodes = {x.name: self.summarize(x.obj) for x in query}
+        with self.lock:
+            self.nodes = {}
+            self.by_type = {}
+            self.down = set()
+            for node in nodes.values():
+                self.store(node)
+        self.synced.set()
+        return query.response["metadata"]["resourceVersion"]
+
+    def watch(self, version):
+        """
+        Apply the events of one watch request, return the version to resume from
+        """
+        params = {"timeoutSeconds": self.watch_timeout}
+        for event in pykube.Node.objects(self.api).watch(since=version, params=params):
+            if event.type == "ERROR":
+                return None
+            node = self.summarize(event.object.obj)
+            with self.lock:
+                self.forget(node["name"])
+                if event.type != "DELETED":
+                    self.store(node)
+            version = event.object.obj["metadata"].get("resourceVersion", version)
+        return version
+
+    @staticmethod
+    def summarize(obj):
+        ready = [
+            x.get("status")
+            for x in obj.get("status", {}).get("conditions", [])
+            if x.get("type") == "Ready"
+        ]
+        addresses = obj.get("status", {}).get("addresses") or [{}]
+        labels = obj["metadata"].get("labels") or {}
+        return {
+            "name": obj["metadata"]["name"],
+            "type": labels.get(NODE_TYPE),
+            "master": MASTER in labels,
+            "tainted": "taints" in obj.get("spec", {}),
+            "ready": ready[0] if ready else None,
+            "addr": addresses[0].get("address"),
+        }
+
+    def store(self, node):
+        self.nodes[node["name"]] = node
+        self.by_type.setdefault(node["type"], set()).add(node["name"])
+        if not node["master"] and node["ready"] == "Unknown":
+            self.down.add(node["name"])
+
+    def forget(self, name):
+        node = self.nodes.pop(name, None)
+        if node:
+            self.by_type.get(node["type"], set()).discard(name)
+            self.down.discard(name)
+
+    def query(self, worker_name, status):
+        with self.lock:
+            if status == "ready":
+                names = self.by_type.get(worker_name, set())
+                nodes = [self.nodes[x] for x in names if not self.nodes[x]["tainted"]]
+            else:
+                nodes = [self.nodes[x] for x in self.down]
+        return [{"ID": x["name"], "Addr": x["addr"]} for x in sorted(nodes, key=lambda x: x["name"])]
+
+
+node_informer = None
+informer_lock = threading.Lock()
+
+
+def get_node_informer():
+    """
+    Return the node informer once it holds a synced cache, None if disabled or not synced
+
+    Only the call starting the informer waits for its initial sync, later
+    calls fall back to the direct queries at once while it is not synced.
+    """
+    global node_informer
+    config = pk_config.config() or {}
+    if not config.get("k8s_node_informer", True):
+        return None
+    started = False
+    with informer_lock:
+        if node_informer is None:
+            node_informer = NodeInformer(
+                kube.config, config.get("k8s_node_informer_watch_timeout", 300)
+            ).start()
+            started = True
+    if started:
+        node_informer.synced.wait(config.get("k8s_node_informer_sync_timeout", 5))
+    if node_informer.synced.is_set():
+        return node_informer
+    return None
 
 
 def query_list_of_nodes(endpoint, worker_name="micado-worker", status="ready"):
@@ -21,6 +161,10 @@ def query_list_of_nodes(endpoint, worker_name="micado-worker", status="ready"):
         list_of_nodes.append(a.copy())
         return list_of_nodes
 
+    informer = get_node_informer()
+    if informer:
+        return informer.query(worker_name, status)
+
     try:
         if status == "ready":
             query = pykube.Node.objects(kube).filter(
@@ -42,7 +186,6 @@ def query_list_of_nodes(endpoint, worker_name="micado-worker", status="ready"):
                     nodes.append(node)
         for n in nodes:
             a = {}
-            n.reload()
             a["ID"] = n.metadata["name"]
             a["Addr"] = n.obj["status"]["addresses"][0]["address"]
             list_of_nodes.append(a.copy())
@@ -52,30 +195,108 @@ def query_list_of_nodes(endpoint, worker_name="micado-worker", status="ready"):
         return dict()
 
 
+deployments_snapshot = {}
+deployments_snapshot_time = 0
+deployments_lock = threading.Lock()
+scale_writes = pk_metrics.counter(
+    "pk_k8s_scale_writes_total", "Scale subresource patches sent to k8s deployments"
+)
+scale_skipped = pk_metrics.counter(
+    "pk_k8s_scale_skipped_total",
+    "K8s deployment scalings skipped as the replica count did not change",
+)
+
+
+def deployment_name(service_name):
+    return "-".join(service_name.split("_")[1:])
+
+
+def refresh_deployments_snapshot(endpoint):
+    """
+    Take a snapshot of all deployments with a single list call
+
+    The snapshot is shared by the policies, a snapshot younger than
+    k8s_deployments_snapshot_max_age seconds is reused.
+    """
+    global deployments_snapshot, deployments_snapshot_time
+    log = logging.getLogger("pk_k8s")
+    if pk_config.dryrun_get(dryrun_id):
+        return
+    max_age = float(pk_config.config().get("k8s_deployments_snapshot_max_age", 1))
+    with deployments_lock:
+        if time.time() - deployments_snapshot_time < max_age:
+            return
+        snapshot = {}
+        try:
+            for deployment in pykube.Deployment.objects(kube):
+                snapshot.setdefault(deployment.name, deployment)
+            deployments_snapshot_time = time.time()
+        except Exception as e:
+            log.warning("(Q) Listing k8s deployments failed: {0}".format(str(e)))
+            deployments_snapshot_time = 0
+        deployments_snapshot = snapshot
+
+
+def get_deployment(name):
+    """
+    Return the deployment from the snapshot, or query it if it is missing
+    """
+    with deployments_lock:
+        if name not in deployments_snapshot:
+            query = pykube.Deployment.objects(kube).filter(
+                field_selector={"metadata.name": name}
+            )
+            deployments_snapshot[name] = [x for x in query][0]
+        return deployments_snapshot[name]
+
+
+def scale_stats():
+    """
+    Return the deployment scale writes and skips of the current policy
+    """
+    ctx = pk_config.context()
+    return {
+        "writes": ctx.counter("k8s_scale_writes"),
+        "skipped": ctx.counter("k8s_scale_skipped"),
+    }
+
+
 def scale_k8s_deploy(endpoint, service_name, replicas):
-    service_name = "-".join(service_name.split("_")[1:])
+    service_name = deployment_name(service_name)
     log = logging.getLogger("pk_k8s")
     log.info("(S)   => m_container_count: {0}".format(replicas))
     if pk_config.dryrun_get(dryrun_id):
         log.info("(S)   DRYRUN enabled. Skipping...")
-        return
+        return False
 
     try:
-        query = pykube.Deployment.objects(kube).filter(
-            field_selector={"metadata.name": service_name}
+        deployment = get_deployment(service_name)
+        if deployment.replicas == replicas:
+            scale_skipped.inc()
+            pk_config.count("k8s_scale_skipped")
+            log.debug("(S)   => replicas unchanged for {0}, skipping".format(service_name))
+            return False
+        response = kube.patch(
+            **deployment.api_kwargs(
+                subresource="scale",
+                headers={"Content-Type": "application/merge-patch+json"},
+                data=json.dumps({"spec": {"replicas": replicas}}),
+            )
         )
-        deployment = [x for x in query][0]
-        deployment.reload()
-        deployment.scale(replicas)
+        kube.raise_for_status(response)
+        scale_writes.inc()
+        pk_config.count("k8s_scale_writes")
+        deployment.obj["spec"]["replicas"] = replicas
     except Exception as e:
         log.warning(
             '(S) Scaling of k8s service "{0}" failed: {1}'.format(service_name, str(e))
         )
-    return
+        raise
+    return True
 
 
 def query_k8s_replicas(endpoint, service_name):
-    service_name = "-".join(service_name.split("_")[1:])
+    service_name = deployment_name(service_name)
     log = logging.getLogger("pk_k8s")
     instance = 1
     if pk_config.dryrun_get(dryrun_id):
@@ -83,11 +304,7 @@ def query_k8s_replicas(endpoint, service_name):
         return instance
 
     try:
-        query = pykube.Deployment.objects(kube).filter(
-            field_selector={"metadata.name": service_name}
-        )
-        deployment = [x for x in query][0]
-        deployment.reload()
+        deployment = get_deployment(service_name)
         instance = deployment.replicas
         log.debug(
             "(I)   => m_container_count for {0}: {1}".format(service_name, instance)
@@ -102,6 +319,17 @@ def query_k8s_replicas(endpoint, service_name):
 
 
 down_nodes_stored = {}
+down_nodes_lock = threading.Lock()
+
+
+def stored_down_nodes():
+    """
+    Return the down nodes seen in the cluster, with the time they were first seen
+
+    The nodes belong to the cluster, not to a policy: the store is shared by
+    the policies and maintained by one of them at a time, under down_nodes_lock.
+    """
+    return down_nodes_stored
 
 
 def remove_node(endpoint, id):
@@ -154,8 +382,10 @@ def down_nodes_maintenance(endpoint, down_nodes_timeout=120):
     if pk_config.dryrun_get(dryrun_id):
         log.info("(M)   DRYRUN enabled. Skipping...")
         return
-    down_nodes_actual = query_list_of_nodes(endpoint, status="down")
-    down_nodes_cleanup_by_list(down_nodes_stored, down_nodes_actual)
-    down_nodes_add_from_list(down_nodes_stored, down_nodes_actual)
-    down_nodes_cleanup_by_timeout(endpoint, down_nodes_stored, down_nodes_timeout)
+    with down_nodes_lock:
+        down_nodes_stored = stored_down_nodes()
+        down_nodes_actual = query_list_of_nodes(endpoint, status="down")
+        down_nodes_cleanup_by_list(down_nodes_stored, down_nodes_actual)
+        down_nodes_add_from_list(down_nodes_stored, down_nodes_actual)
+        down_nodes_cleanup_by_timeout(endpoint, down_nodes_stored, down_nodes_timeout)
     return
@@ -1,10 +1,12 @@
 import logging
-import requests
+import pk_http
 from ruamel import yaml
 import shutil,os
 import pk_config
+import pk_rules
 from pk_helper import *
 import json,time
+import functools
 
 DEFAULT_prestr_init = 'm_opt_init_'
 DEFAULT_prestr_input = 'm_opt_input_'
@@ -13,10 +15,7 @@ DEFAULT_prestr_target_query = 'query_'
 DEFAULT_prestr_target_minth = 'minth_'
 DEFAULT_prestr_target_maxth = 'maxth_'
 
-m_opt_init_params = dict()
-m_opt_variables = list()
 m_opt_dummy_advice = dict(valid='False',phase='training',vmnumber=0,errmsg='Optimizer is disabled! (dryrun)',confident=0)
-m_opt_accessible = True
 dryrun_id = 'optimizer'
 
 """
@@ -83,9 +82,20 @@ m_opt_variables =
 
 """
 
+class OptimizerState(object):
+  """ Optimizer parameters and variables of a policy, see the description above. """
+  def __init__(self):
+    self.init_params = dict()
+    self.variables = list()
+    self.accessible = True
+
+def optimizer_state():
+  return pk_config.context().state('optimizer', OptimizerState)
+
 def reset_variables():
-  m_opt_init_params.update(dict())
-  m_opt_variables[:] = []
+  state = optimizer_state()
+  state.init_params.update(dict())
+  state.variables[:] = []
   return
 
 def varname_if_init(varname):
@@ -111,6 +121,7 @@ def check_if_target(varname):
 
 def insert_target_structure(m_opt_init_params,key,value):
   log=logging.getLogger('pk_optimizer')
+  m_opt_variables = optimizer_state().variables
   config = pk_config.config()
   prestr_target = config.get('optimizer_vars_prefix_target',DEFAULT_prestr_target)
   prestr_target_query = prestr_target+config.get('optimizer_vars_prefix_target_query',DEFAULT_prestr_target_query)
@@ -147,6 +158,8 @@ def collect_init_params_and_variables(policy):
     log.info('(O)   DRYRUN enabled. Skipping...')
     return
   reset_variables()
+  m_opt_init_params = optimizer_state().init_params
+  m_opt_variables = optimizer_state().variables
   m_opt_init_params['constants'] = dict()
   for varname,value in policy.get('data',dict()).get('constants',dict()).items():
     retvarname = varname_if_init(varname)
@@ -165,7 +178,7 @@ def collect_init_params_and_variables(policy):
     if check_if_target(varname):
       insert_target_structure(m_opt_init_params,varname,query)
   for onenode in policy.get('scaling',dict()).get('nodes',[]):
-    if 'm_opt_advice' in onenode.get('scaling_rule',''):
+    if 'm_opt_advice' in pk_rules.node_identifiers(policy,onenode):
       _,omin,omax = limit_instances(None,
                                     onenode.get('min_instances'),
                                     onenode.get('max_instances'))
@@ -176,8 +189,8 @@ def collect_init_params_and_variables(policy):
   return
 
 def calling_rest_api_init():
-  global m_opt_accessible
   log=logging.getLogger('pk_optimizer')
+  state = optimizer_state()
   config = pk_config.config()
   if pk_config.dryrun_get(dryrun_id):
     log.info('(O)   DRYRUN enabled. Skipping...')
@@ -185,10 +198,10 @@ def calling_rest_api_init():
   url = config.get('optimizer_endpoint')+'/init'
   log.debug('(O) Calling optimizer REST API init() method: '+url)
   try:
-    response = requests.post(url, data=yaml.dump(m_opt_init_params))
-    m_opt_accessible = True
+    response = pk_http.post(url, data=yaml.dump(state.init_params))
+    state.accessible = True
   except Exception as e:
-    m_opt_accessible = False
+    state.accessible = False
     log.error('(O) Calling optimizer REST API init() method raised exception: ' + str(e))
     log.info('(O) WARNING: Optimizer is disabled for the current policy.')
     return
@@ -209,7 +222,7 @@ def generate_sample(userqueries=dict(),sysqueries=dict()):
   sample['sample']['input_metrics']=[]
   sample['sample']['target_metrics']=[]
 
-  for var in m_opt_variables:
+  for var in optimizer_state().variables:
     log.debug('(O)  => Scanning {0} ...'.format(var['lname']))
     onesample=dict()
     onesample['name']=var['sname']
@@ -233,21 +246,29 @@ def calling_rest_api_sample(sample=dict()):
   if pk_config.dryrun_get(dryrun_id):
     log.info('(O)   DRYRUN enabled. Skipping...')
     return
-  if not m_opt_accessible:
+  if not optimizer_state().accessible:
     return
   url = config.get('optimizer_endpoint')+'/sample'
   log.debug('(O) Calling optimizer REST API sample() method: '+url)
-  response = requests.post(url, data=yaml.dump(sample))
+  response = pk_http.post(url, data=yaml.dump(sample))
   log.debug('(O) Response: '+str(response))
   return
 
 def calling_rest_api_advice():
+  return advice_function()()
+
+def advice_function():
+  """ Returns the advice call of the current policy, picklable for the evaluator workers. """
+  if pk_config.dryrun_get(dryrun_id) or not optimizer_state().accessible:
+    return functools.partial(fetch_advice,None)
+  config = pk_config.config()
+  return functools.partial(fetch_advice,config.get('optimizer_endpoint')+'/advice')
+
+def fetch_advice(url):
   log=logging.getLogger('pk_optimizer')
-  if pk_config.dryrun_get(dryrun_id) or not m_opt_accessible:
+  if url is None:
     return m_opt_dummy_advice
-  config = pk_config.config()
-  url = config.get('optimizer_endpoint')+'/advice'
   log.debug('(O) Calling optimizer REST API advice() method: '+url)
-  response = requests.get(url).json()
+  response = pk_http.get(url).json()
   log.debug('(O) Response: {0}'.format(response))
   return response
@@ -1,38 +1,142 @@
+import re
+import json
+import heapq
 import logging
-import requests
+import calendar
+import threading
+import pk_http
+from concurrent.futures import ThreadPoolExecutor
 from ruamel import yaml
 import handle_k8s as k8s
-import shutil,os
+import shutil,os,time
 import pk_config
+import pk_metrics
+import pk_rules
+import pk_vector
+import pk_remote_write
+import evaluator
 
-alerts = {}
 dryrun_id = 'prometheus'
 
+DEFAULT_alerts_ttl = 300
+DEFAULT_alerts_max = 1000
+DEFAULT_batch_size = 20
+BATCH_label = 'pk_batch'
+VECTOR_PREFIX_RE = re.compile(r'\s*\{\s*"status"\s*:\s*"success"\s*,\s*"data"\s*:\s*\{\s*'
+                              r'"resultType"\s*:\s*"vector"\s*,\s*"result"\s*:\s*\[\s*')
+RFC3339_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})[Tt ](\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?([Zz]|[+-]\d{2}:\d{2})?$')
+alerts_received = pk_metrics.counter('pk_alerts_received_total',
+  'Alerts received from Alertmanager')
+alerts_coalesced = pk_metrics.counter('pk_alerts_coalesced_total',
+  'Firing alerts merged into an already stored alert')
+alerts_expired = pk_metrics.counter('pk_alerts_expired_total',
+  'Stored alerts dropped after their endsAt')
+alerts_dropped = pk_metrics.counter('pk_alerts_dropped_total',
+  'Stored alerts dropped because the store was full')
+query_seconds = pk_metrics.histogram('pk_prometheus_query_seconds',
+  'Latency of the Prometheus queries by query name', ('query',))
+errors_total = pk_metrics.counter('pk_errors_total',
+  'Errors by component', ('component',))
+
+# Policy stacks with exporters added to the prometheus config, and their sources
+exporters_applied = dict()
+exporters_lock = threading.RLock()
+cache_hits = pk_metrics.counter('pk_prometheus_cache_hits_total',
+  'Prometheus query results served from the session cache')
+cache_misses = pk_metrics.counter('pk_prometheus_cache_misses_total',
+  'Prometheus queries sent because they were missing from the session cache')
+batch_saved = pk_metrics.counter('pk_prometheus_batch_saved_total',
+  'Prometheus requests saved by combining queries into batches')
+batch_fallbacks = pk_metrics.counter('pk_prometheus_batch_fallbacks_total',
+  'Batches rejected by Prometheus and sent again as individual queries')
+
+json_decoder = json.JSONDecoder()
+
 def is_subdict(subdict=dict(),maindict=dict()):
   return all((k in maindict and maindict[k]==v) for k,v in subdict.items())
 
+def decode_first_series(text):
+  """ Decodes a successful vector response up to its first series only.
+
+  Returns None if the response does not start in the layout Prometheus
+  writes, the caller decodes it entirely then.
+  """
+  match = VECTOR_PREFIX_RE.match(text)
+  if not match:
+    return None
+  result = []
+  if text[match.end():match.end()+1] != ']':
+    try:
+      result.append(json_decoder.raw_decode(text,match.end())[0])
+    except ValueError:
+      return None
+  return dict(status='success',data=dict(resultType='vector',result=result))
+
+class RawResponse(object):
+  """ Body of a Prometheus query response, decoded only as far as it is needed.
+
+  A scalar query reads the first series only, so the thousands of series
+  of a large vector are not turned into dicts for it. The decoded forms are
+  kept, as the response is shared by the queries of the session. A vector
+  query with labels reads its columns straight from the text.
+  """
+  def __init__(self, content):
+    self.content = content
+    self.decoded = None
+    self.first = None
+
+  def vector(self, labels):
+    if self.decoded is not None:
+      return None
+    return pk_vector.scan(self.content.decode('utf-8'),labels)
+
+  def decode(self, first_only=False):
+    if self.decoded is not None:
+      return self.decoded
+    if first_only:
+      if self.first is None:
+        self.first = decode_first_series(self.content.decode('utf-8')) or False
+      if self.first:
+        return self.first
+    self.decoded = json.loads(self.content)
+    return self.decoded
+
+def decode_response(response):
+  return response.decode() if isinstance(response,RawResponse) else response
+
 def extract_value_from_prometheus_response(expression,response,filterdict=dict()):
   log=logging.getLogger('pk_prometheus')
+  if isinstance(response,RawResponse):
+    vector = response.vector(expression.get('labels')) if isinstance(expression,dict) else None
+    if vector is not None:
+      return vector
+    response = response.decode(first_only=is_scalar_query(expression) and not filterdict)
   if response.get('status') != 'success' or \
     response.get('data',dict()).get('result',None) is None or \
     not isinstance(response['data']['result'],list):
       raise Exception('Unrecognised prometheus response for expression "{0}": "{1}"'
                       .format(expression,str(response)))
+  if isinstance(expression,dict):
+    return pk_vector.parse(response['data'],expression.get('labels'))
   if response['data']['resultType']=='vector':
-    result = [ x for x in response['data']['result']
-             if x.get('metric',None) is not None and is_subdict(filterdict,x['metric']) ]
+    result = response['data']['result']
+    if filterdict:
+      result = [ x for x in result
+                 if x.get('metric',None) is not None and is_subdict(filterdict,x['metric']) ]
     if isinstance(expression,list):
-      log.debug('Multiple results in prometheus response for expression "{0}": "{1}"'
-                .format(expression,str(result)))
-      return [ x.get('metric',dict()).get(expression[1]) \
-               for x in result if x.get('metric',dict()).get(expression[1])]
-    if len(result)<1:
+      if log.isEnabledFor(logging.DEBUG):
+        log.debug('Multiple results in prometheus response for expression "{0}": "{1}"'
+                  .format(expression,str(result)))
+      return [ x['metric'][expression[1]] for x in result
+               if x.get('metric') and x['metric'].get(expression[1]) ]
+    first = next((x for x in result if x.get('metric',None) is not None),None)
+    if first is None:
       raise Exception('No results found in prometheus response for expression "{0}": "{1}"'
                       .format(expression,str(result)))
-    if not result[0].get('value'):
+    if not first.get('value'):
       raise Exception('Unrecognised result in prometheus response for expression "{0}": "{1}"'
-                      .format(expression,str(result[0])))
-    value=result[0]['value']
+                      .format(expression,str(first)))
+    value=first['value']
   else:
     value=response['data']['result']
   if not isinstance(value,list) or \
@@ -43,59 +147,298 @@ def extract_value_from_prometheus_response(expression,response,filterdict=dict()
   return value[1]
 
 def filter_data_queries_by_scaling_rule(queries,scaling_rule):
-  result=dict()
-  for param,query in queries.items():
-    if scaling_rule.find(param)!= -1:
-      result[param]=query
+  names = evaluator.rule_identifiers(scaling_rule)
+  return { param: query for param,query in queries.items() if param in names }
+
+def query_expression(query):
+  if isinstance(query,dict):
+    return query.get('query')
+  return query[0] if isinstance(query,list) else query
+
+def is_scalar_query(query):
+  return not isinstance(query,(list,dict))
+
+def is_node_query(param,identifiers):
+  return param.find('m_opt') != -1 or param in identifiers
+
+def is_service_query(param,identifiers):
+  return param in identifiers
+
+def is_dummy_query(param):
+  return param.startswith("m_opt_target_minth_") or \
+         param.startswith("m_opt_target_maxth_")
+
+def collect_session_expressions(policy,affected=None):
+  """ Returns the expressions of the queries of the nodes and services, or of the affected ones only. """
+  expressions = set()
+  index = pk_rules.index_of(policy)
+  any_node = any(affected is None or ('nodes',x.get('name')) in affected
+                 for x in policy.get('scaling',dict()).get('nodes') or [])
+  for param,query in policy.get('data',dict()).get('queries',dict()).items():
+    dependents = index.dependents.get(param,set())
+    if affected is not None:
+      dependents = dependents & affected
+    kinds = { kind for kind,_ in dependents }
+    if 'services' in kinds or \
+       (('nodes' in kinds or (any_node and param.find('m_opt') != -1)) and not is_dummy_query(param)):
+      expressions.add(query_expression(query))
+  return expressions
+
+class QuerySession(object):
+  """ Evaluation timestamp and result cache of the current session of a policy. """
+  def __init__(self):
+    self.time = None
+    self.cache = dict()
+    self.seconds = dict()
+    self.observed = set()
+    self.batched = 0
+    self.batches = 0
+
+  def observe(self, name, expression):
+    """ Records the latency of the query behind a name once per session. """
+    if name not in self.observed and expression in self.seconds:
+      self.observed.add(name)
+      query_seconds.observe(self.seconds[expression], query=name)
+
+def query_session():
+  return pk_config.context().state('prometheus_session', QuerySession)
+
+def session_begin(timestamp=None):
+  """ Pins the evaluation timestamp of the session and empties the result cache. """
+  session = query_session()
+  session.time = time.time() if timestamp is None else timestamp
+  session.cache = dict()
+  session.seconds = dict()
+  session.observed = set()
+  session.batched = 0
+  session.batches = 0
+  return session.time
+
+def count_cache(hit):
+  (cache_hits if hit else cache_misses).inc()
+  pk_config.count('prometheus_cache_hits' if hit else 'prometheus_cache_misses')
+
+def session_cache_stats():
+  """ Returns the query cache hits and misses of the current policy. """
+  ctx = pk_config.context()
+  return dict(hits=ctx.counter('prometheus_cache_hits'), misses=ctx.counter('prometheus_cache_misses'))
+
+def session_batch_stats():
+  session = query_session()
+  return dict(queries=session.batched, requests=session.batches,
+              saved=session.batched-session.batches)
+
+def query_prometheus(endpoint,expression):
+  log=logging.getLogger('pk_prometheus')
+  params = dict(query=expression)
+  session = query_session()
+  if session.time is not None:
+    params['time'] = session.time
+  start = time.time()
+  response = RawResponse(pk_http.get(endpoint+"/api/v1/query",params=params).content)
+  session.seconds[expression] = time.time() - start
+  if log.isEnabledFor(logging.DEBUG):
+    log.debug('Prometheus response query "{0}":{1}'.format(expression,response.content.decode('utf-8','replace')))
+  return response
+
+def query_prometheus_or_exception(endpoint,expression):
+  try:
+    return query_prometheus(endpoint,expression)
+  except Exception as e:
+    return e
+
+def unbatchable_expressions():
+  """ Expressions of the policy found to break a batch, they are always queried alone. """
+  return pk_config.context().state('prometheus_unbatchable', set)
+
+def scalar_session_expressions(policy):
+  """ Returns the expressions used only by scalar queries, whose result is its first sample. """
+  scalar, other = set(), set()
+  for query in policy.get('data',dict()).get('queries',dict()).values():
+    (scalar if is_scalar_query(query) else other).add(query_expression(query))
+  return scalar - other
+
+def is_batchable_expression(expression):
+  """ Rejects the expressions that cannot be wrapped into label_replace() safely. """
+  if not isinstance(expression,str) or '#' in expression or BATCH_label in expression:
+    return False
+  expression = expression.strip()
+  try:
+    float(expression)
+    return False
+  except ValueError:
+    pass
+  return expression != '' and not re.match(r'^(scalar|time)\s*\(',expression)
+
+def plan_batches(policy,expressions,size):
+  """ Splits the expressions into batches of up to size and the ones queried alone. """
+  candidates = scalar_session_expressions(policy) - unbatchable_expressions()
+  batchable = sorted(x for x in expressions if x in candidates and is_batchable_expression(x))
+  single = [ x for x in expressions if x not in set(batchable) ]
+  batches = [ batchable[i:i+size] for i in range(0,len(batchable),max(size,1)) ]
+  # A batch of one query saves nothing
+  if batches and len(batches[-1]) < 2:
+    single += batches.pop()
+  return batches, single
+
+def batch_expression(expressions):
+  """ Combines the expressions into one union, each part tagged by its index. """
+  return ' or '.join('label_replace({0}, "{1}", "{2}", "", "")'.format(x,BATCH_label,i)
+                     for i,x in enumerate(expressions))
+
+def split_batch_response(expressions,response):
+  """ Splits the response of a batch into the responses of its expressions. """
+  results = [ [] for x in expressions ]
+  for sample in response['data']['result']:
+    index = sample.get('metric',dict()).pop(BATCH_label,None)
+    if index is not None and index.isdigit() and int(index) < len(results):
+      results[int(index)].append(sample)
+  return [ dict(status='success',data=dict(resultType='vector',result=x)) for x in results ]
+
+def query_prometheus_batch(endpoint,expressions):
+  """ Sends the expressions as one query.
+
+  Returns the responses of the expressions, None if Prometheus rejected the
+  batch, or the exception for each of them if the request failed.
+  """
+  log=logging.getLogger('pk_prometheus')
+  params = dict(query=batch_expression(expressions))
+  session = query_session()
+  if session.time is not None:
+    params['time'] = session.time
+  start = time.time()
+  try:
+    response = pk_http.post(endpoint+"/api/v1/query",data=params).json()
+  except Exception as e:
+    return [e] * len(expressions)
+  seconds = time.time() - start
+  if response.get('status') != 'success' or response.get('data',dict()).get('resultType') != 'vector':
+    log.debug('(Q) Batch of {0} queries rejected by Prometheus: {1}'.format(len(expressions),response.get('error')))
+    return None
+  for expression in expressions:
+    session.seconds[expression] = seconds
+  if log.isEnabledFor(logging.DEBUG):
+    log.debug('Prometheus response batch query "{0}":{1}'.format(params['query'],response))
+  return split_batch_response(expressions,response)
+
+def query_batch_or_fallback(endpoint,expressions):
+  """ Queries a batch, or its expressions one by one if Prometheus rejects it.
+
+  The expressions which do not give a vector alone are remembered as
+  unbatchable. Returns the responses and whether the batch was used.
+  """
+  responses = query_prometheus_batch(endpoint,expressions)
+  if responses is not None:
+    return responses, True
+  batch_fallbacks.inc()
+  responses = [ query_prometheus_or_exception(endpoint,x) for x in expressions ]
+  for expression,response in zip(expressions,responses):
+    if isinstance(response,Exception):
+      continue
+    try:
+      decoded = decode_response(response)
+    except ValueError:
+      continue
+    if decoded.get('status') != 'success' or decoded.get('data',dict()).get('resultType') != 'vector':
+      unbatchable_expressions().add(expression)
+  return responses, False
+
+def prefetch_session_queries(endpoint,policy,affected=None):
+  """ Executes every distinct query needed by the scaling rules once, in parallel.
+
+  If affected is given, only the queries of these (kind, name) items are
+  executed, the ones of an alert-triggered session.
+
+  With prometheus_query_batching enabled, the scalar queries are combined
+  into batches of prometheus_query_batch_size queries. Queries with fresh
+  samples pushed through remote write are not sent. The responses (or
+  exceptions) are stored in the session cache.
+  """
+  log=logging.getLogger('pk_prometheus')
+  if pk_config.dryrun_get(dryrun_id):
+    return
+  session = query_session()
+  expressions = [ x for x in collect_session_expressions(policy,affected)
+                  if (x,session.time) not in session.cache and not cache_pushed_response(x) ]
+  if not expressions:
+    return
+  config = pk_config.config()
+  batches, single = [], expressions
+  if config.get('prometheus_query_batching',False):
+    batches, single = plan_batches(policy,expressions,
+                                   int(config.get('prometheus_query_batch_size',DEFAULT_batch_size)))
+  workers = min(len(single)+len(batches),int(config.get('prometheus_max_parallel_queries',8)))
+  log.debug('(Q) Prefetching {0} distinct queries in {1} batches and {2} single queries with {3} workers'
+            .format(len(expressions),len(batches),len(single),workers))
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    futures = [ pk_config.submit(executor,query_prometheus_or_exception,endpoint,x) for x in single ]
+    batch_futures = [ pk_config.submit(executor,query_batch_or_fallback,endpoint,x) for x in batches ]
+    for expression,future in zip(single,futures):
+      count_cache(False)
+      session.cache[(expression,session.time)] = future.result()
+    for batch,future in zip(batches,batch_futures):
+      responses, batched = future.result()
+      if batched:
+        session.batched += len(batch)
+        session.batches += 1
+        batch_saved.inc(len(batch)-1)
+      for expression,response in zip(batch,responses):
+        count_cache(False)
+        session.cache[(expression,session.time)] = response
+
+def cache_pushed_response(expression):
+  """ Stores the response built from remote write samples in the session cache, if there is one. """
+  session = query_session()
+  response = pk_remote_write.pushed_response(expression,session.time)
+  if response is None:
+    return False
+  session.cache[(expression,session.time)] = response
+  return True
+
+def fetch_prometheus_response(endpoint,expression):
+  session = query_session()
+  key = (expression,session.time)
+  if key in session.cache:
+    count_cache(True)
+  elif cache_pushed_response(expression):
+    pass
+  else:
+    count_cache(False)
+    session.cache[key] = query_prometheus_or_exception(endpoint,expression)
+  response = session.cache[key]
+  if isinstance(response,Exception):
+    raise response
+  return response
 
 def evaluate_data_queries_and_alerts_for_nodes(endpoint,policy,node):
   log=logging.getLogger('pk_prometheus')
   if pk_config.dryrun_get(dryrun_id):
     log.info('(Q)   DRYRUN enabled. Assigning queries as values to metrics...')
   queries, alerts = dict(), dict()
-  if 'data' not in policy:
-    policy['data']={}
-  if 'query_results' not in policy['data']:
-    policy['data']['query_results']=dict()
-  scaling_rule_str = node.get('scaling_rule','')
+  identifiers = pk_rules.node_identifiers(policy,node)
   for param,query in policy.get('data',dict()).get('queries',dict()).items():
     try:
-      if param.find('m_opt') != -1 or \
-         (scaling_rule_str is not None and \
-         scaling_rule_str.find(param) != -1):
-        if pk_config.dryrun_get(dryrun_id) or \
-           param.startswith("m_opt_target_minth_") or \
-           param.startswith("m_opt_target_maxth_"):
+      if is_node_query(param,identifiers):
+        if pk_config.dryrun_get(dryrun_id) or is_dummy_query(param):
           #TODO: handle dummy value more appropriately
-          policy['data']['query_results'][param]=query
           queries[param]=query
         else:
-          if isinstance(query,list):
-            response = requests.get(endpoint+"/api/v1/query?query="+query[0]).json()
-            log.debug('Prometheus response query "{0}":{1}'.format(query[0],response))
-            val = extract_value_from_prometheus_response(query,response,dict())
-            policy['data']['query_results'][param]=val
-            queries[param]=val
-          else:
-            response = requests.get(endpoint+"/api/v1/query?query="+query).json()
-            log.debug('Prometheus response query "{0}":{1}'.format(query,response))
-            val = extract_value_from_prometheus_response(query,response,dict())
-            policy['data']['query_results'][param]=float(val)
-            queries[param]=float(val)
+          response = fetch_prometheus_response(endpoint,query_expression(query))
+          query_session().observe(param,query_expression(query))
+          val = extract_value_from_prometheus_response(query,response,dict())
+          if is_scalar_query(query):
+            val = float(val)
+          queries[param]=val
     except Exception as e:
-      policy['data']['query_results'][param]=None
+      errors_total.inc(component='query')
       queries[param]=None
       log.warning('Evaluating expression for query "{0}" failed: {1}'.format(param,e))
-  policy['data']['alert_results']={}
+  firing = alerts_query()
   for item in policy.get('data',dict()).get('alerts',dict()):
     attrname = item['alert']
-    if scaling_rule_str is not None and scaling_rule_str.find(attrname) != -1:
-      if alerts_query(attrname) is not None:
-        policy['data']['alert_results'][attrname]=True
-        alerts[attrname]=True
-      else:
-        policy['data']['alert_results'][attrname]=False
-        alerts[attrname]=False
+    if attrname in identifiers:
+      # An alert without endsAt is stored with None until its ttl ends
+      alerts[attrname] = attrname in firing
   return queries, alerts
 
 def evaluate_data_queries_and_alerts_for_a_service(endpoint,policy,servicename):
@@ -103,48 +446,52 @@ def evaluate_data_queries_and_alerts_for_a_service(endpoint,policy,servicename):
   if pk_config.dryrun_get(dryrun_id):
     log.info('(Q)   DRYRUN enabled. Skipping...')
   queries, alerts = dict(), dict()
-  if 'query_results' not in policy['data']:
-    policy['data']['query_results']=dict()
-  all_services = policy.get('scaling',dict()).get('services',dict())
-  target_service = [ srv for srv in all_services if srv.get('name','')==servicename ]
-  scaling_rule_str = target_service[0].get('scaling_rule','') if target_service else ''
+  identifiers = pk_rules.service_identifiers(policy,servicename)
   for param,query in policy.get('data',dict()).get('queries',dict()).items():
     try:
-      if scaling_rule_str is not None and scaling_rule_str.find(param) != -1:
+      if is_service_query(param,identifiers):
         if pk_config.dryrun_get(dryrun_id):
-          policy['data']['query_results'][param]=query
           queries[param]=query
         else:
-          response = requests.get(endpoint+"/api/v1/query?query="+query).json()
-          log.debug('Prometheus response query "{0}":{1}'.format(query,response))
+          response = fetch_prometheus_response(endpoint,query_expression(query))
+          query_session().observe(param,query_expression(query))
           val = extract_value_from_prometheus_response(query,response,dict())
-          policy['data']['query_results'][param]=float(val)
-          queries[param]=float(val)
+          if is_scalar_query(query):
+            val = float(val)
+          queries[param]=val
     except Exception as e:
-      policy['data']['query_results'][param]=None
+      errors_total.inc(component='query')
       queries[param]=None
       log.warning('Evaluating expression for query "{0}" failed: {1}'.format(param,e))
-  policy['data']['alert_results']={}
+  firing = alerts_query()
   for item in policy.get('data',dict()).get('alerts',dict()):
     attrname = item['alert']
-    if scaling_rule_str is not None and scaling_rule_str.find(attrname) != -1:
-      if alerts_query(attrname) is not None:
-        policy['data']['alert_results'][attrname]=True
-        alerts[attrname]=True
-      else:
-        policy['data']['alert_results'][attrname]=False
-        alerts[attrname]=False
+    if attrname in identifiers:
+      # An alert without endsAt is stored with None until its ttl ends
+      alerts[attrname] = attrname in firing
   return queries, alerts
 
 def add_exporters_to_prometheus_config(policy, template_file, config_file):
+  """ Adds the exporters of the policy to the prometheus config.
+
+  The config is saved as template before the first policy adds its exporters,
+  and restored from it when the last one removes them.
+  """
+  log=logging.getLogger('pk_prometheus')
+  if pk_config.dryrun_get(dryrun_id):
+    log.info('(C)   DRYRUN enabled. Skipping...')
+    return
+  with exporters_lock:
+    if not exporters_applied:
+      shutil.copy(config_file, template_file)
+    exporters_applied[policy.get('stack','pk')] = policy.get('data',dict()).get('sources',dict())
+    apply_exporters_to_prometheus_config(policy, config_file)
+
+def apply_exporters_to_prometheus_config(policy, config_file):
   log=logging.getLogger('pk_prometheus')
   try:
     config_content = dict()
-    if pk_config.dryrun_get(dryrun_id):
-      log.info('(C)   DRYRUN enabled. Skipping...')
-      return
-    shutil.copy(config_file, template_file)
-    with open(template_file,'r') as f:
+    with open(config_file,'r') as f:
       config_content = yaml.round_trip_load(f)
     if 'scrape_configs' not in config_content:
       config_content['scrape_configs']=[]
@@ -205,12 +552,20 @@ def add_exporters_to_prometheus_config(policy, template_file, config_file):
 
   return
 
-def remove_exporters_from_prometheus_config(template_file, config_file):
+def remove_exporters_from_prometheus_config(template_file, config_file, stack=None):
+  """ Restores the config from the template, keeping the exporters of the other policies. """
   log=logging.getLogger('pk_prometheus')
   if pk_config.dryrun_get(dryrun_id):
     log.info('(C)   DRYRUN enabled. Skipping...')
     return
-  shutil.copyfile(template_file, config_file)
+  with exporters_lock:
+    if stack is None:
+      exporters_applied.clear()
+    else:
+      exporters_applied.pop(stack,None)
+    shutil.copyfile(template_file, config_file)
+    for sources in list(exporters_applied.values()):
+      apply_exporters_to_prometheus_config(dict(data=dict(sources=sources)), config_file)
 
 def notify_to_reload_config(endpoint):
   log=logging.getLogger('pk_prometheus')
@@ -218,7 +573,7 @@ def notify_to_reload_config(endpoint):
     log.info('(C)   DRYRUN enabled. Skipping...')
     return
   try:
-    requests.post(endpoint+"/-/reload")
+    pk_http.post(endpoint+"/-/reload")
     log.info('(C) Notification to reload config sent to Prometheus.')
   except Exception:
     log.exception('Sending config reload notification to Prometheus failed:')
@@ -259,31 +614,157 @@ def remove_alerts_under_prometheus(rules_directory,alerts,stack):
     log.exception('Removing alerts under Prometheus failed:')
   return
 
+class AlertStore(object):
+  """ Thread-safe store of the firing alerts.
+
+  Each alert expires at its endsAt (or after the default ttl if endsAt is
+  not set), found through a heap of expiry times. Repeated firings of an
+  alert are coalesced into one entry. Readers get an immutable snapshot,
+  rebuilt by the writers, so reading does not need the lock.
+  """
+  def __init__(self, ttl=DEFAULT_alerts_ttl, max_alerts=DEFAULT_alerts_max):
+    self.ttl, self.max_alerts = ttl, max_alerts
+    self.lock = threading.Lock()
+    self.entries = dict()
+    self.expiries = []
+    self.snapshot = dict()
+
+  def configure(self, config):
+    config = config or dict()
+    with self.lock:
+      self.ttl = float(config.get('alerts_ttl',self.ttl))
+      self.max_alerts = int(config.get('alerts_max',self.max_alerts))
+
+  def expiry_of(self, ends_at, now):
+    expires = parse_rfc3339(ends_at)
+    return expires if expires and expires > now else now + self.ttl
+
+  def publish(self):
+    self.snapshot = { name: entry['endsAt'] for name, entry in self.entries.items() }
+
+  def expire(self, now):
+    changed = False
+    while self.expiries and self.expiries[0][0] <= now:
+      expires, name = heapq.heappop(self.expiries)
+      entry = self.entries.get(name)
+      if entry and entry['expires'] == expires:
+        del self.entries[name]
+        alerts_expired.inc()
+        changed = True
+    return changed
+
+  def compact(self):
+    self.expiries = [ (x['expires'], name) for name, x in self.entries.items() ]
+    heapq.heapify(self.expiries)
+
+  def insert(self, name, ends_at, now):
+    expires = self.expiry_of(ends_at, now)
+    entry = self.entries.get(name)
+    if entry:
+      alerts_coalesced.inc()
+      entry['count'] += 1
+      entry['endsAt'] = ends_at
+      if expires > entry['expires']:
+        entry['expires'] = expires
+        heapq.heappush(self.expiries, (expires, name))
+    else:
+      while len(self.entries) >= self.max_alerts and self.expiries:
+        expires_first, dropped = heapq.heappop(self.expiries)
+        if self.entries.get(dropped, dict()).get('expires') == expires_first:
+          del self.entries[dropped]
+          alerts_dropped.inc()
+      self.entries[name] = dict(endsAt=ends_at, expires=expires, count=1, since=now)
+      heapq.heappush(self.expiries, (expires, name))
+    if len(self.expiries) > 2 * len(self.entries) + 64:
+      self.compact()
+    return entry is not None
+
+  def add_all(self, alerts, now=None):
+    """ Adds (name, endsAt) pairs, publishing the snapshot once. Returns the names coalesced. """
+    now = time.time() if now is None else now
+    coalesced = set()
+    with self.lock:
+      self.expire(now)
+      for name, ends_at in alerts:
+        if self.insert(name, ends_at, now):
+          coalesced.add(name)
+      self.publish()
+    return coalesced
+
+  def add(self, name, ends_at, now=None):
+    return name in self.add_all([(name, ends_at)], now)
+
+  def remove(self, name=None):
+    with self.lock:
+      if name is None:
+        self.entries.clear()
+        self.expiries = []
+      elif self.entries.pop(name, None) is None:
+        return
+      self.publish()
+
+  def query(self, now=None):
+    now = time.time() if now is None else now
+    snapshot = self.snapshot
+    try:
+      # Checked without the lock, the heap may be emptied meanwhile
+      due = self.expiries[0][0] <= now
+    except IndexError:
+      due = False
+    if due:
+      with self.lock:
+        if self.expire(now):
+          self.publish()
+        snapshot = self.snapshot
+    return snapshot
+
+def parse_rfc3339(value):
+  """ Converts an RFC3339 timestamp of Alertmanager (nanoseconds, Z or offset) to epoch seconds. """
+  m = RFC3339_RE.match(str(value or ''))
+  if not m:
+    return None
+  year, month, day, hour, minute, second, fraction, zone = m.groups()
+  if int(year) < 1970:
+    return None
+  stamp = calendar.timegm((int(year),int(month),int(day),int(hour),int(minute),int(second)))
+  if fraction:
+    stamp += float('0.'+fraction)
+  if zone and zone not in ('Z','z'):
+    offset = int(zone[1:3])*3600 + int(zone[4:6])*60
+    stamp -= offset if zone[0] == '+' else -offset
+  return stamp
+
+def alert_store():
+  return pk_config.context().state('alerts', AlertStore)
+
 def alerts_isany():
-  global alerts
-  return True if alerts else False
+  return True if alert_store().query() else False
 
 def alerts_remove(name = None):
-  global alerts
-  alerts.pop(name,None) if name else alerts.clear()
+  alert_store().remove(name)
 
 def alerts_add(alert):
-  global alerts
   stored_alerts = []
   log=logging.getLogger('pk_prometheus')
-  for a in alert.get('alerts'):
-    log.info('(A) New alert arrived: {0}\n'.format(a))
+  alerts = alert_store()
+  alerts.configure(pk_config.config())
+  firing = []
+  for a in alert.get('alerts') or []:
+    alerts_received.inc()
+    if log.isEnabledFor(logging.DEBUG):
+      log.debug('(A) New alert arrived: {0}'.format(a))
     name = a.get('labels',dict()).get('alertname')
-    if a.get('status') != 'firing':
+    if a.get('status') != 'firing' or not name:
       continue
-    if name in alerts:
-      log.warning('(A) Alert "{0}" is already among unhandled alerts!'.format(name))
-    alerts[name] = a.get('endsAt')
-    stored_alerts.append(name)
+    firing.append((name, a.get('endsAt')))
+    if name not in stored_alerts:
+      stored_alerts.append(name)
+  for name in alerts.add_all(firing):
+    log.debug('(A) Alert "{0}" is already among unhandled alerts, coalesced.'.format(name))
   return stored_alerts
 
 def alerts_query(name = None):
-  global alerts
+  snapshot = alert_store().query()
   if not name:
-    return alerts
-  return alerts[name] if name in alerts else None
+    return snapshot
+  return snapshot.get(name)
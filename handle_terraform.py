@@ -6,6 +6,7 @@ from itertools import zip_longest
 from kube_terraform import KubeTerraform
 
 import pk_config
+import pk_deadline
 
 dryrun_id = "terraform"
 
@@ -29,7 +30,7 @@ def scale_worker_node(config, scaling_info_list):
     """
     if pk_config.dryrun_get(dryrun_id):
         log.info("(S)   DRYRUN enabled. Skipping...")
-        return
+        return False
     node_variables = _read_vars_file()
     for info in scaling_info_list:
         replicas = info.get("replicas")
@@ -107,6 +108,9 @@ def get_terraform(config):
             return terraform
         except Exception as e:
             log.debug("Failed attempt {}/5 attaching to Terraform: {}".format(i, e))
+            if pk_deadline.expired(5):
+                log.debug("No time left in the session to retry attaching to Terraform")
+                break
             time.sleep(5)
     log.error("Failed to get Terraform pod")
 
@@ -0,0 +1,189 @@
+import sys
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+import pk_config
+import pk_metrics
+import pk_deadline
+
+DEFAULT_concurrency = dict(occopus=4, terraform=1, k8s=8)
+DEFAULT_timeout = 60
+DEFAULT_stage_timeout = 120
+
+actuation_calls = pk_metrics.counter('pk_actuation_calls_total',
+  'Scaling calls of the actuation stage by backend and result', ('backend','result'))
+actuation_seconds = pk_metrics.counter('pk_actuation_seconds_total',
+  'Time spent in scaling calls by backend', ('backend',))
+actuation_latency = pk_metrics.histogram('pk_actuation_call_seconds',
+  'Duration of the scaling calls by backend', ('backend',))
+actuation_noops = pk_metrics.counter('pk_actuation_noops_total',
+  'Scaling calls skipped by their handler as no-op (no change or dryrun)', ('backend',))
+errors_total = pk_metrics.counter('pk_errors_total',
+  'Errors by component', ('component',))
+timeouts_total = pk_metrics.counter('pk_timeouts_total',
+  'Timeouts by component', ('component',))
+
+# Shared by the sessions of all policies, so the limits hold across them
+semaphores = dict()
+# Scaling calls still running, by target, including the ones reported as timed out
+in_flight = dict()
+lock = threading.Lock()
+
+def semaphore_of(backend, limit):
+  """ Returns the semaphore limiting the parallel calls of a backend, a new one if the limit changed. """
+  limit = max(int(limit),1)
+  with lock:
+    entry = semaphores.get(backend)
+    if entry is None or entry[0] != limit:
+      entry = semaphores[backend] = (limit, threading.BoundedSemaphore(limit))
+    return entry[1]
+
+def claim(action):
+  """ Marks the target of the action in flight, returns the running action if it already is. """
+  with lock:
+    running = in_flight.get(action.target)
+    if running is None:
+      in_flight[action.target] = action
+    return running
+
+def release(action):
+  with lock:
+    if in_flight.get(action.target) is action:
+      del in_flight[action.target]
+
+class Action(object):
+  """ One scaling call planned during the session, on a target (e.g. a deployment or a node). """
+  def __init__(self, backend, description, func, *args, target=None):
+    self.backend, self.description = backend, description
+    self.target = (backend, target if target is not None else description)
+    self.func, self.args = func, args
+    self.started = None
+    self.abandoned = False
+    self.lock = threading.Lock()
+
+  def begin(self):
+    with self.lock:
+      if not self.abandoned:
+        self.started = time.time()
+      return not self.abandoned
+
+  def abandon(self):
+    """ Abandons the action unless it has started already. """
+    with self.lock:
+      if not self.started:
+        self.abandoned = True
+      return self.abandoned
+
+class ActuationStage(object):
+  """ Collects the scaling decisions of a session and applies them concurrently.
+
+  The number of parallel calls is limited per backend, across the sessions of
+  all policies. A call running longer than the timeout is reported as failed,
+  calls not started before the stage timeout are reported as skipped. A timed
+  out call keeps its target in flight until it returns, later calls on the
+  same target are skipped meanwhile. A handler returning False reports that
+  it skipped the scaling (e.g. no change or dryrun).
+  """
+  def __init__(self):
+    self.actions = []
+
+  def add(self, backend, description, func, *args, target=None):
+    self.actions.append(Action(backend, description, func, *args, target=target))
+
+  def add_node_scaling(self, config, handler_method, scaling_info_list):
+    module = sys.modules[handler_method.__module__]
+    backend = getattr(module, 'dryrun_id', module.__name__)
+    if not getattr(module, 'ACTUATION_SPLIT', False):
+      names = ','.join(x.get('node_name') for x in scaling_info_list)
+      self.add(backend, '{0} {1}'.format(handler_method.__name__,names),
+               handler_method, config, scaling_info_list, target=names)
+      return
+    for info in scaling_info_list:
+      replicas = info.get('replicas')
+      for replica in (replicas if isinstance(replicas,list) else [replicas]):
+        oneinfo = dict(info, replicas=[replica] if isinstance(replicas,list) else replica)
+        if isinstance(replicas,list):
+          # Dropping one node does not conflict with dropping the others
+          target = '{0}:{1}'.format(info.get('node_name'),replica)
+        else:
+          target = info.get('node_name')
+        self.add(backend, '{0} {1}:{2}'.format(handler_method.__name__,info.get('node_name'),replica),
+                 handler_method, config, [oneinfo], target=target)
+
+  def execute(self, action, semaphore):
+    try:
+      with semaphore:
+        if not action.begin():
+          return None
+        try:
+          return action.func(*action.args)
+        finally:
+          actuation_seconds.inc(time.time()-action.started, backend=action.backend)
+          actuation_latency.observe(time.time()-action.started, backend=action.backend)
+    finally:
+      release(action)
+
+  def run(self):
+    log = logging.getLogger('pk')
+    report = dict(applied=[], skipped=[], failed=[])
+    if not self.actions:
+      return report
+    config = (pk_config.config() or dict()).get('actuation') or dict()
+    concurrency = dict(DEFAULT_concurrency, **config.get('concurrency',dict()))
+    deadline = pk_deadline.get()
+    if deadline is not None:
+      deadline.enter_reserve()
+    try:
+      timeout = pk_deadline.clip(float(config.get('timeout',DEFAULT_timeout)))
+      stage_timeout = pk_deadline.clip(float(config.get('stage_timeout',DEFAULT_stage_timeout)))
+    except pk_deadline.DeadlineExceeded:
+      for action in self.actions:
+        pk_deadline.shed('scaling', '"{0}"'.format(action.description))
+        report['skipped'].append('{0}: session deadline exceeded'.format(action.description))
+      return report
+    actions = []
+    for action in self.actions:
+      if claim(action) is not None:
+        report['skipped'].append('{0}: a previous call on the target is still in flight'.format(action.description))
+        actuation_calls.inc(backend=action.backend, result='in_flight')
+        log.warning('(S) Scaling call "{0}" skipped, a previous call is still in flight'.format(action.description))
+      else:
+        actions.append(action)
+    if not actions:
+      return report
+    executor = ThreadPoolExecutor(max_workers=len(actions))
+    futures = { pk_config.submit(executor, self.execute, x,
+                                 semaphore_of(x.backend, concurrency.get(x.backend,1))): x for x in actions }
+    start, pending = time.time(), set(futures)
+    while pending:
+      done, pending = wait(pending, timeout=0.1)
+      for future in done:
+        action = futures[future]
+        try:
+          result = 'skipped' if future.result() is False else 'applied'
+          report[result].append(action.description)
+          if result == 'skipped':
+            actuation_noops.inc(backend=action.backend)
+        except Exception as e:
+          result = 'failed'
+          errors_total.inc(component='actuation')
+          report['failed'].append('{0}: {1}'.format(action.description,e))
+          log.warning('(S) Scaling call "{0}" failed: {1}'.format(action.description,e))
+        actuation_calls.inc(backend=action.backend, result=result)
+      now = time.time()
+      for future in list(pending):
+        action = futures[future]
+        if action.started and now - action.started > timeout:
+          report['failed'].append('{0}: timed out after {1} seconds'.format(action.description,timeout))
+          log.warning('(S) Scaling call "{0}" timed out'.format(action.description))
+          actuation_calls.inc(backend=action.backend, result='timeout')
+          timeouts_total.inc(component='actuation')
+          pending.discard(future)
+        elif not action.started and now - start > stage_timeout and action.abandon():
+          release(action)
+          report['skipped'].append('{0}: not started within {1} seconds'.format(action.description,stage_timeout))
+          actuation_calls.inc(backend=action.backend, result='abandoned')
+          pending.discard(future)
+    executor.shutdown(wait=False)
+    return report
@@ -1,10 +1,66 @@
+import threading
+import contextvars
 
 var_config = None
-var_policy = None
-var_finish_scaling = False
-var_dryrun = []
 var_dryrun_components = ['occopus', 'terraform', 'k8s','prometheus','optimizer']
 
+class PolicyContext(object):
+  """ State of one policy run by the keeper.
+
+  Handlers keep their per-policy state here through state(), so several
+  policies can run in the same process without sharing it.
+  """
+  def __init__(self, name=None):
+    self.name = name
+    self.policy = None
+    self.finish_scaling = False
+    self.dryrun = []
+    # Re-entrant, as the state factories may count or reach other state
+    self.lock = threading.RLock()
+    self.states = dict()
+    self.counters = dict()
+
+  def state(self, key, factory):
+    with self.lock:
+      if key not in self.states:
+        self.states[key] = factory()
+      return self.states[key]
+
+  def count(self, name, value=1):
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+
+  def counter(self, name):
+    return self.counters.get(name, 0)
+
+  def derived(self, key, source, factory, rebuild=False):
+    """ Returns the state built by factory() from source, built again once source is replaced. """
+    with self.lock:
+      entry = self.states.get(key)
+      if rebuild or entry is None or entry[0] is not source:
+        entry = self.states[key] = (source, factory())
+      return entry[1]
+
+default_context = PolicyContext()
+current_context = contextvars.ContextVar('pk_policy_context', default=default_context)
+
+def context():
+  return current_context.get()
+
+def run_in_context(ctx, func, *args, **kwargs):
+  def run():
+    current_context.set(ctx)
+    return func(*args, **kwargs)
+  return contextvars.copy_context().run(run)
+
+def submit(executor, func, *args, **kwargs):
+  """ Submits func to the executor to run in the context of the caller. """
+  return executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
+
+def count(name, value=1):
+  """ Adds to a counter of the current policy, the metrics count for all of them. """
+  context().count(name, value)
+
 def config(nc = None):
   global var_config
   if nc is not None:
@@ -12,40 +68,37 @@ def config(nc = None):
   return var_config
 
 def finish_scaling(fs = None):
-  global var_finish_scaling
+  ctx = context()
   if fs is not None:
-    var_finish_scaling = fs
-  return var_finish_scaling
+    ctx.finish_scaling = fs
+  return ctx.finish_scaling
 
 def policy(pol = None):
-  global var_policy
+  ctx = context()
   if pol is not None:
-    var_policy = pol
-  return var_policy
+    ctx.policy = pol
+  return ctx.policy
 
 def dryrun_set(component=None,value=False):
-  global var_dryrun
+  ctx = context()
   if component is None:
-    var_dryrun=var_dryrun_components.copy() if value else list()
+    ctx.dryrun=var_dryrun_components.copy() if value else list()
   else:
     if component in var_dryrun_components:
       if value:
-        if component not in var_dryrun:
-          var_dryrun.append(component)
+        if component not in ctx.dryrun:
+          ctx.dryrun.append(component)
       else:
-        if component in var_dryrun:
-          var_dryrun.remove(component)
+        if component in ctx.dryrun:
+          ctx.dryrun.remove(component)
     else:
       raise Exception('ERROR: Invalid component name in dryrun_get() method!')
   return
 
 def dryrun_get(component=None):
-  global var_dryrun
+  ctx = context()
   if component is None:
-    return var_dryrun
+    return ctx.dryrun
   if component=='' or component not in var_dryrun_components:
     raise Exception('ERROR: Invalid component name in dryrun_get() method!')
-  return True if component in var_dryrun else False
-
-  
-
+  return True if component in ctx.dryrun else False
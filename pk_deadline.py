@@ -0,0 +1,131 @@
+import time
+import logging
+import threading
+import contextvars
+import pk_metrics
+
+DEFAULT_reserve = 3
+
+shed_total = pk_metrics.counter('pk_session_shed_total',
+  'Work left out of sessions because their time budget ran out', ('kind',))
+budget_exceeded = pk_metrics.counter('pk_session_budget_exceeded_total',
+  'Calls refused or cut short by the deadline of the session')
+
+class DeadlineExceeded(Exception):
+  pass
+
+class Deadline(object):
+  """ Time budget of one session.
+
+  The evaluation of the nodes and services must finish by the deadline,
+  the reserve is kept for applying the decisions made until then. A budget
+  of None never expires.
+  """
+  def __init__(self, budget=None, reserve=DEFAULT_reserve):
+    self.start = time.time()
+    self.budget = budget
+    self.reserve = min(float(reserve), float(budget)) if budget else 0.0
+    self.at = self.start + float(budget) - self.reserve if budget else float('inf')
+    self.reserved = False
+    self.closed = False
+    self.shed = []
+    self.lock = threading.Lock()
+
+  def remaining(self):
+    if self.closed:
+      return float('-inf')
+    return self.at - time.time()
+
+  def expired(self, margin=0):
+    return self.remaining() <= margin
+
+  def optional_expired(self):
+    """ Optional work stops once less than the reserve is left before the deadline,
+    but not before half of the time until the deadline has passed. """
+    return self.expired(min(self.reserve, (self.at - self.start) / 2.0))
+
+  def enter_reserve(self):
+    """ Moves the deadline to the end of the budget, granting at least the reserve. """
+    if self.budget and not self.reserved:
+      self.reserved = True
+      self.at = max(self.start + float(self.budget), time.time() + self.reserve)
+
+  def add_shed(self, kind, description):
+    log = logging.getLogger('pk')
+    log.warning('(T) Out of time, {0} {1} is shed from the session'.format(kind,description))
+    shed_total.inc(kind=kind)
+    with self.lock:
+      self.shed.append('{0} {1}'.format(kind,description))
+
+current = contextvars.ContextVar('pk_session_deadline', default=None)
+# Set once the stage running the call gave up on it
+cancelled = contextvars.ContextVar('pk_call_cancelled', default=None)
+
+def begin(budget=None, reserve=DEFAULT_reserve):
+  """ Starts the deadline of a session in the current context. """
+  deadline = Deadline(budget, reserve)
+  return deadline, current.set(deadline)
+
+def end(token):
+  """ Ends the deadline of the session, calls still running from it find it exceeded. """
+  deadline = current.get()
+  if deadline is not None:
+    deadline.closed = True
+  current.reset(token)
+
+def run_cancellable(event, func, *args):
+  """ Runs func, the session deadline counts as exceeded for it once event is set. """
+  token = cancelled.set(event)
+  try:
+    return func(*args)
+  finally:
+    cancelled.reset(token)
+
+def is_cancelled():
+  event = cancelled.get()
+  return event is not None and event.is_set()
+
+def check():
+  """ Raises DeadlineExceeded if the call was cancelled or its session has ended. """
+  deadline = current.get()
+  if is_cancelled() or (deadline is not None and deadline.closed):
+    raise DeadlineExceeded('call cancelled after the stage or the session ended')
+
+def get():
+  return current.get()
+
+def remaining():
+  if is_cancelled():
+    return float('-inf')
+  deadline = current.get()
+  return deadline.remaining() if deadline is not None else float('inf')
+
+def expired(margin=0):
+  return remaining() <= margin
+
+def optional_expired():
+  """ Optional work is shed first, see Deadline.optional_expired(). """
+  deadline = current.get()
+  return is_cancelled() or (deadline is not None and deadline.optional_expired())
+
+def shed(kind, description):
+  deadline = current.get()
+  if deadline is not None:
+    deadline.add_shed(kind, description)
+
+def clip(timeout):
+  """ Limits a timeout (seconds or a tuple of them) to the remaining time of the session.
+
+  Raises DeadlineExceeded if the session has no time left.
+  """
+  left = remaining()
+  if left == float('inf'):
+    return timeout
+  if left <= 0:
+    budget_exceeded.inc()
+    raise DeadlineExceeded('session deadline exceeded')
+  if timeout is None:
+    return left
+  if isinstance(timeout, tuple):
+    return tuple(min(float(x), left) if x is not None else left for x in timeout)
+  return min(float(timeout), left)
@@ -0,0 +1,121 @@
+import ast
+import threading
+import numpy
+import evaluator
+import pk_config
+
+DEFAULT_length = 120
+FUNCTIONS = ('history','history_times')
+
+class Series(object):
+  """ Ring buffer of the last values of a query with their timestamps.
+
+  The buffers are twice the length and every sample is written at both
+  positions, so the last n samples are always one contiguous slice.
+  """
+  def __init__(self, length):
+    self.length = length
+    self.times = numpy.zeros(2*length)
+    self.values = numpy.zeros(2*length)
+    self.count = 0
+    self.last = -1
+
+  def append(self, timestamp, value):
+    if self.count and self.times[self.last] == timestamp:
+      position = self.last
+    else:
+      position = self.count % self.length
+      self.count += 1
+    self.times[position] = self.times[position+self.length] = timestamp
+    self.values[position] = self.values[position+self.length] = value
+    self.last = position
+
+  def window(self, n=None):
+    n = min(self.count, self.length, n if n is not None else self.length)
+    end = self.last + self.length + 1
+    return self.times[end-n:end].copy(), self.values[end-n:end].copy()
+
+class HistoryView(object):
+  """ The history() or history_times() function of a scaling rule.
+
+  Holds copies of the windows the rule asks for, so only these are passed
+  to the evaluator worker. Returns read-only arrays, oldest sample first.
+  """
+  def __init__(self, windows, times=False):
+    self.windows, self.times = windows, times
+
+  def __call__(self, name, n=None):
+    window = self.windows.get(name)
+    if window is None:
+      return numpy.zeros(0)
+    array = window[0 if self.times else 1]
+    array.flags.writeable = False
+    return array[-int(n):] if n else array[:]
+
+def requirements(code):
+  """ Returns the queries whose history the rule uses and the number of samples it needs.
+
+  Only calls with a string literal as name are recognised, None stands for
+  the full length when the number of samples is not a literal.
+  """
+  tree = evaluator.compile_rule(code)
+  wanted = dict()
+  if isinstance(tree, SyntaxError):
+    return wanted
+  for node in ast.walk(tree):
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and \
+       node.func.id in FUNCTIONS and node.args and \
+       isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str):
+      name = node.args[0].value
+      arg = node.args[1] if len(node.args) > 1 else \
+            next((x.value for x in node.keywords if x.arg == 'n'), None)
+      n = arg.value if isinstance(arg, ast.Constant) and isinstance(arg.value, int) else None
+      if name in wanted and (wanted[name] is None or n is None):
+        wanted[name] = None
+      else:
+        wanted[name] = max(wanted.get(name, 0), n) if n is not None else None
+  return wanted
+
+class History(object):
+  """ Histories of the queries used through history() by the rules of a policy. """
+  def __init__(self, policy, length=DEFAULT_length):
+    self.length = max(int(length), 0)
+    self.lock = threading.Lock()
+    self.series = dict()
+    self.rules = dict()
+    self.wanted = set()
+    scaling = policy.get('scaling') or dict()
+    for kind in ('nodes','services'):
+      for item in scaling.get(kind) or []:
+        code = item.get('scaling_rule') or ''
+        self.rules[code] = requirements(code)
+        self.wanted.update(self.rules[code])
+
+  def record(self, values, timestamp):
+    """ Adds the numeric values of the wanted queries, once per timestamp. """
+    if not self.length:
+      return
+    with self.lock:
+      for name in self.wanted.intersection(values):
+        value = values[name]
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+          continue
+        if name not in self.series:
+          self.series[name] = Series(self.length)
+        self.series[name].append(timestamp, float(value))
+
+  def inputs(self, code):
+    """ Returns the history functions for a rule with the windows it needs. """
+    wanted = self.rules.get(code)
+    if wanted is None:
+      wanted = self.rules[code] = requirements(code)
+    with self.lock:
+      windows = { name: self.series[name].window(n) for name, n in wanted.items()
+                  if name in self.series }
+    return dict(history=HistoryView(windows), history_times=HistoryView(windows, times=True))
+
+def build_history(policy, length=DEFAULT_length):
+  return pk_config.context().derived('history', policy, lambda: History(policy, length), rebuild=True)
+
+def history_of(policy):
+  return pk_config.context().derived('history', policy, lambda: History(policy))
@@ -0,0 +1,106 @@
+import os
+import time
+import threading
+import requests
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import pk_config
+import pk_metrics
+import pk_deadline
+
+DEFAULT_connect_timeout = 3.05
+DEFAULT_read_timeout = 10
+DEFAULT_retries = 2
+DEFAULT_backoff_factor = 0.3
+DEFAULT_pool_maxsize = 10
+
+sessions = dict()
+lock = threading.Lock()
+
+requests_total = pk_metrics.counter('pk_http_requests_total',
+  'Outbound HTTP requests', ('endpoint',))
+request_errors = pk_metrics.counter('pk_http_request_errors_total',
+  'Outbound HTTP requests failed with an exception or a 5xx status', ('endpoint',))
+request_seconds = pk_metrics.counter('pk_http_request_seconds_total',
+  'Time spent in outbound HTTP requests', ('endpoint',))
+timeouts_total = pk_metrics.counter('pk_timeouts_total',
+  'Timeouts by component', ('component',))
+
+def http_config():
+  config = pk_config.config() or dict()
+  return config.get('http') or dict()
+
+def endpoint_of(url):
+  parts = urlsplit(url)
+  return '{0}://{1}'.format(parts.scheme,parts.netloc)
+
+def session(endpoint):
+  """ Returns the keep-alive session with its own connection pool for an endpoint. """
+  with lock:
+    if endpoint not in sessions:
+      cfg = http_config()
+      retry = Retry(total=int(cfg.get('retries',DEFAULT_retries)),
+                    backoff_factor=float(cfg.get('backoff_factor',DEFAULT_backoff_factor)),
+                    status_forcelist=(502,503,504),
+                    raise_on_status=False)
+      adapter = HTTPAdapter(pool_connections=1,
+                            pool_maxsize=int(cfg.get('pool_maxsize',DEFAULT_pool_maxsize)),
+                            max_retries=retry)
+      s = requests.Session()
+      s.mount('http://',adapter)
+      s.mount('https://',adapter)
+      sessions[endpoint] = s
+    return sessions[endpoint]
+
+def reset():
+  with lock:
+    for s in sessions.values():
+      s.close()
+    sessions.clear()
+
+def reset_in_child():
+  """ Drops the pooled connections inherited by a forked process, their sockets belong to the parent. """
+  global lock
+  lock = threading.Lock()
+  sessions.clear()
+
+os.register_at_fork(after_in_child=reset_in_child)
+
+def request(method,url,**kwargs):
+  endpoint = endpoint_of(url)
+  cfg = http_config()
+  timeout = kwargs.get('timeout',(float(cfg.get('connect_timeout',DEFAULT_connect_timeout)),
+                                  float(cfg.get('read_timeout',DEFAULT_read_timeout))))
+  kwargs['timeout'] = pk_deadline.clip(timeout)
+  start = time.time()
+  try:
+    response = session(endpoint).request(method,url,**kwargs)
+  except requests.exceptions.Timeout as e:
+    request_errors.inc(endpoint=endpoint)
+    timeouts_total.inc(component='http')
+    if kwargs['timeout'] != timeout:
+      pk_deadline.budget_exceeded.inc()
+      raise pk_deadline.DeadlineExceeded('session deadline exceeded during {0} {1}: {2}'.format(method,url,e))
+    raise
+  except Exception:
+    request_errors.inc(endpoint=endpoint)
+    raise
+  finally:
+    requests_total.inc(endpoint=endpoint)
+    request_seconds.inc(time.time()-start,endpoint=endpoint)
+  if response.status_code >= 500:
+    request_errors.inc(endpoint=endpoint)
+  return response
+
+def get(url,**kwargs):
+  return request('GET',url,**kwargs)
+
+def post(url,**kwargs):
+  return request('POST',url,**kwargs)
+
+def stats():
+  return { endpoint: dict(requests=requests_total.get(endpoint=endpoint),
+                          errors=request_errors.get(endpoint=endpoint),
+                          seconds=request_seconds.get(endpoint=endpoint))
+           for (endpoint,) in list(requests_total.values) }
@@ -0,0 +1,57 @@
+import time
+import pk_metrics
+
+COLLECT = 'collect'
+EVALUATE = 'evaluate'
+
+provider_calls = pk_metrics.counter('pk_input_provider_calls_total',
+  'Input providers computed for a scaling rule', ('provider',))
+provider_skipped = pk_metrics.counter('pk_input_provider_skipped_total',
+  'Input providers skipped because the scaling rule does not use them', ('provider',))
+provider_seconds = pk_metrics.counter('pk_input_provider_seconds_total',
+  'Time spent computing input providers', ('provider',))
+
+providers = []
+
+class Provider(object):
+  """ Computes system inputs of a rule, only if the rule uses one of its trigger names. """
+  def __init__(self, name, kind, func, triggers=None, phase=COLLECT):
+    self.name, self.kind, self.func, self.phase = name, kind, func, phase
+    self.triggers = frozenset(triggers or (name,))
+
+  def wanted(self, identifiers):
+    return not self.triggers.isdisjoint(identifiers)
+
+def provider(name, kind, triggers=None, phase=COLLECT):
+  """ Registers the decorated function as input provider for nodes or services.
+
+  The function is called with the policy, the node or service and the inputs
+  collected so far, and returns a dict of inputs.
+  """
+  def register(func):
+    providers.append(Provider(name, kind, func, triggers, phase))
+    return func
+  return register
+
+def provide(kind, identifiers, policy, item, inputs, phase=COLLECT):
+  """ Adds the inputs of the wanted providers to inputs. """
+  for p in providers:
+    if p.kind != kind or p.phase != phase:
+      continue
+    label = '{0}:{1}'.format(kind,p.name)
+    if not p.wanted(identifiers):
+      provider_skipped.inc(provider=label)
+      continue
+    start = time.time()
+    try:
+      inputs.update(p.func(policy, item, inputs))
+    finally:
+      provider_calls.inc(provider=label)
+      provider_seconds.inc(time.time()-start, provider=label)
+  return inputs
+
+def stats():
+  return { provider: dict(calls=provider_calls.get(provider=provider),
+                          skipped=provider_skipped.get(provider=provider),
+                          seconds=provider_seconds.get(provider=provider))
+           for provider in sorted({ '{0}:{1}'.format(p.kind,p.name) for p in providers }) }
@@ -0,0 +1,141 @@
+import time
+import functools
+import threading
+import contextlib
+
+lock = threading.Lock()
+registry = dict()
+
+class Counter(object):
+  """ Monotonically increasing value, optionally split by labels. """
+  kind = 'counter'
+
+  def __init__(self, name, description='', labelnames=()):
+    self.name, self.description = name, description
+    self.labelnames = tuple(labelnames)
+    self.values = dict()
+
+  def key(self, labels):
+    return tuple(str(labels.get(x,'')) for x in self.labelnames)
+
+  def inc(self, value=1, **labels):
+    key = self.key(labels)
+    with lock:
+      self.values[key] = self.values.get(key,0) + value
+
+  def get(self, **labels):
+    return self.values.get(self.key(labels),0)
+
+  def samples(self):
+    with lock:
+      values = dict(self.values)
+    if not values and not self.labelnames:
+      values[()] = 0
+    return [ (self.name, list(zip(self.labelnames,key)), value)
+             for key, value in sorted(values.items()) ]
+
+def counter(name, description='', labelnames=()):
+  with lock:
+    if name not in registry:
+      registry[name] = Counter(name, description, labelnames)
+  return registry[name]
+
+class Gauge(Counter):
+  """ Value that can go up and down, optionally split by labels. """
+  kind = 'gauge'
+
+  def set(self, value, **labels):
+    key = self.key(labels)
+    with lock:
+      self.values[key] = value
+
+class Histogram(Counter):
+  """ Distribution of observed values in cumulative buckets, optionally split by labels. """
+  kind = 'histogram'
+  DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 15, 30, 60)
+
+  def __init__(self, name, description='', labelnames=(), buckets=DEFAULT_BUCKETS):
+    super(Histogram, self).__init__(name, description, labelnames)
+    self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+  def observe(self, value, **labels):
+    key = self.key(labels)
+    with lock:
+      entry = self.values.setdefault(key, dict(counts=[0]*len(self.buckets), sum=0.0, count=0))
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          entry['counts'][i] += 1
+      entry['sum'] += value
+      entry['count'] += 1
+
+  def get(self, **labels):
+    return self.values.get(self.key(labels), dict(counts=[0]*len(self.buckets), sum=0.0, count=0))
+
+  @contextlib.contextmanager
+  def timer(self, **labels):
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.observe(time.time()-start, **labels)
+
+  def samples(self):
+    with lock:
+      values = { k: dict(v, counts=list(v['counts'])) for k, v in self.values.items() }
+    samples = []
+    for key, entry in sorted(values.items()):
+      labels = list(zip(self.labelnames,key))
+      for bound, count in zip(self.buckets, entry['counts']):
+        samples.append((self.name+'_bucket', labels+[('le',bound)], count))
+      samples.append((self.name+'_sum', labels, entry['sum']))
+      samples.append((self.name+'_count', labels, entry['count']))
+    return samples
+
+def gauge(name, description='', labelnames=()):
+  with lock:
+    if name not in registry:
+      registry[name] = Gauge(name, description, labelnames)
+  return registry[name]
+
+def histogram(name, description='', labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+  with lock:
+    if name not in registry:
+      registry[name] = Histogram(name, description, labelnames, buckets)
+  return registry[name]
+
+def timed(metric, **labels):
+  """ Decorator observing the duration of each call in a histogram. """
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      with metric.timer(**labels):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
+
+def format_value(value):
+  if isinstance(value, float):
+    if value == float('inf'):
+      return '+Inf'
+    if value == float('-inf'):
+      return '-Inf'
+    return repr(value)
+  return str(value)
+
+def escape(text, quote=True):
+  text = str(text).replace('\\','\\\\').replace('\n','\\n')
+  return text.replace('"','\\"') if quote else text
+
+def exposition():
+  """ Returns all metrics of the registry in the Prometheus text format. """
+  with lock:
+    metrics = sorted(registry.values(), key=lambda x: x.name)
+  lines = []
+  for metric in metrics:
+    lines.append('# HELP {0} {1}'.format(metric.name,escape(metric.description,quote=False)))
+    lines.append('# TYPE {0} {1}'.format(metric.name,metric.kind))
+    for name, labels, value in metric.samples():
+      if labels:
+        name += '{' + ','.join('{0}="{1}"'.format(k,escape(format_value(v))) for k,v in labels) + '}'
+      lines.append('{0} {1}'.format(name,format_value(value)))
+  return '\n'.join(lines) + '\n'
@@ -0,0 +1,180 @@
+import io
+import time
+import pstats
+import logging
+import cProfile
+import threading
+import tracemalloc
+
+DEFAULT_sessions = 1
+DEFAULT_top = 25
+DEFAULT_frames = 10
+
+lock = threading.Lock()
+# The profiling run in progress, None when profiling is off
+active = None
+# The last finished or stopped profiling run
+last = None
+
+def take_snapshot():
+  """ Takes a tracemalloc snapshot without the allocations of the profiling itself. """
+  return tracemalloc.take_snapshot().filter_traces([
+    tracemalloc.Filter(False, x) for x in (tracemalloc.__file__, cProfile.__file__,
+                                           pstats.__file__, __file__) ])
+
+class RawStats(object):
+  """ Stats received from an evaluator worker, in the form pstats.Stats() loads. """
+  def __init__(self, stats):
+    self.stats = stats
+
+  def create_stats(self):
+    pass
+
+class Profiling(object):
+  """ Profiles the next sessions and aggregates their stats.
+
+  Each session is profiled with cProfile in the thread running it, the
+  evaluations are profiled inside the evaluator workers. With memory
+  enabled, a tracemalloc snapshot is taken after each session and the top
+  allocation differences to the previous one are kept.
+  """
+  def __init__(self, sessions=DEFAULT_sessions, memory=False, top=DEFAULT_top):
+    self.sessions = max(int(sessions),1)
+    self.memory, self.top = memory, int(top)
+    self.pending = self.sessions
+    self.running = 0
+    self.profiled = []
+    self.stats = None
+    self.evaluator_stats = None
+    self.evaluations = 0
+    self.evaluator_seconds = 0.0
+    self.snapshot = None
+    self.memory_diffs = []
+    self.started = time.time()
+    self.finished = None
+    self.tracing = False
+    if memory and not tracemalloc.is_tracing():
+      tracemalloc.start(DEFAULT_frames)
+      self.tracing = True
+    if memory:
+      self.snapshot = take_snapshot()
+
+  def session_begin(self):
+    with lock:
+      if self.pending <= 0:
+        return None
+      self.pending -= 1
+      self.running += 1
+    profile = cProfile.Profile()
+    profile.enable()
+    return (profile, time.time())
+
+  def session_end(self, handle, name):
+    profile, start = handle
+    profile.disable()
+    seconds = time.time() - start
+    snapshot = take_snapshot() if self.memory and tracemalloc.is_tracing() else None
+    with lock:
+      self.running -= 1
+      self.profiled.append(dict(policy=name, seconds=seconds))
+      if self.stats is None:
+        self.stats = pstats.Stats(profile)
+      else:
+        self.stats.add(profile)
+      if snapshot is not None:
+        diff = snapshot.compare_to(self.snapshot, 'lineno')[:self.top]
+        self.memory_diffs.append(dict(policy=name, top=[ str(x) for x in diff ]))
+        self.snapshot = snapshot
+      done = self.pending <= 0 and self.running == 0
+    if done:
+      finish(self)
+
+  def add_evaluation(self, stats, seconds):
+    with lock:
+      self.evaluations += 1
+      self.evaluator_seconds += seconds
+      if self.evaluator_stats is None:
+        self.evaluator_stats = pstats.Stats(RawStats(stats))
+      else:
+        self.evaluator_stats.add(RawStats(stats))
+
+  def close(self):
+    if self.finished is None:
+      self.finished = time.time()
+    self.snapshot = None
+    if self.tracing:
+      tracemalloc.stop()
+      self.tracing = False
+
+  def format_stats(self, stats, sort, limit):
+    if stats is None:
+      return ''
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.sort_stats(sort).print_stats(limit)
+    return stream.getvalue()
+
+  def report(self, sort='cumulative', limit=DEFAULT_top):
+    with lock:
+      return dict(state='running' if self.finished is None else 'finished',
+                  sessions=self.sessions,
+                  profiled=list(self.profiled),
+                  started=self.started,
+                  finished=self.finished,
+                  stats=self.format_stats(self.stats, sort, limit),
+                  evaluator=dict(evaluations=self.evaluations,
+                                 cpu_seconds=self.evaluator_seconds,
+                                 stats=self.format_stats(self.evaluator_stats, sort, limit)),
+                  memory=list(self.memory_diffs) if self.memory else None)
+
+def finish(profiling):
+  global active, last
+  log = logging.getLogger('pk')
+  with lock:
+    if active is profiling:
+      active = None
+    last = profiling
+  profiling.close()
+  log.info('(T) Profiling of {0} session(s) finished'.format(len(profiling.profiled)))
+
+def start(sessions=DEFAULT_sessions, memory=False, top=DEFAULT_top):
+  """ Turns on profiling for the next sessions, replacing a profiling in progress. """
+  global active
+  log = logging.getLogger('pk')
+  if active is not None:
+    finish(active)
+  profiling = Profiling(sessions, memory, top)
+  with lock:
+    active = profiling
+  log.info('(T) Profiling of the next {0} session(s) starts'.format(profiling.sessions))
+  return profiling
+
+def stop():
+  """ Turns off profiling and returns the profiling run stopped, if any. """
+  profiling = active
+  if profiling is not None:
+    finish(profiling)
+  return last
+
+def current():
+  return active if active is not None else last
+
+def session_begin():
+  """ Starts profiling a session if requested, returns the handle for session_end(). """
+  profiling = active
+  if profiling is None:
+    return None
+  handle = profiling.session_begin()
+  return (profiling, handle) if handle is not None else None
+
+def session_end(handle, name=None):
+  if handle is not None:
+    handle[0].session_end(handle[1], name)
+
+def profiling_evaluations():
+  return active is not None
+
+def add_evaluation(stats, seconds):
+  profiling = active
+  if profiling is not None:
+    profiling.add_evaluation(stats, seconds)
@@ -0,0 +1,277 @@
+import re
+import time
+import struct
+import logging
+import threading
+import collections
+import pk_config
+import pk_metrics
+
+DEFAULT_staleness = 30
+DEFAULT_max_series = 10000
+# Value of the staleness markers Prometheus writes when a series disappears
+STALE_NAN = 0x7ff0000000000002
+
+SELECTOR_RE = re.compile(r'^\s*([a-zA-Z_:][a-zA-Z0-9_:]*)\s*(?:\{(.*)\})?\s*$', re.S)
+MATCHER_RE = re.compile(r'\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*=\s*"([^"\\]*)"\s*(?:,|$)')
+
+samples_received = pk_metrics.counter('pk_remote_write_samples_total',
+  'Samples received through remote write')
+samples_stored = pk_metrics.counter('pk_remote_write_samples_stored_total',
+  'Received samples stored because a policy queries their series')
+series_evicted = pk_metrics.counter('pk_remote_write_series_evicted_total',
+  'Series dropped from the remote write store because it was full')
+queries_served = pk_metrics.counter('pk_remote_write_queries_served_total',
+  'Prometheus queries answered from remote write samples')
+series_stored = pk_metrics.gauge('pk_remote_write_series',
+  'Series kept in the remote write store')
+
+class DecodeError(Exception):
+  pass
+
+def snappy_decompress(data):
+  """ Decompresses a snappy block (not the framing format) as sent by remote write. """
+  length, pos = read_varint(data, 0)
+  out = bytearray()
+  end = len(data)
+  while pos < end:
+    tag = data[pos]
+    pos += 1
+    kind = tag & 3
+    if kind == 0:
+      size = tag >> 2
+      if size >= 60:
+        extra = size - 59
+        size = int.from_bytes(data[pos:pos+extra], 'little')
+        pos += extra
+      size += 1
+      if pos + size > end:
+        raise DecodeError('snappy literal out of bounds')
+      out += data[pos:pos+size]
+      pos += size
+      continue
+    if kind == 1:
+      size = 4 + ((tag >> 2) & 7)
+      offset = ((tag >> 5) << 8) | data[pos]
+      pos += 1
+    elif kind == 2:
+      size = (tag >> 2) + 1
+      offset = int.from_bytes(data[pos:pos+2], 'little')
+      pos += 2
+    else:
+      size = (tag >> 2) + 1
+      offset = int.from_bytes(data[pos:pos+4], 'little')
+      pos += 4
+    if offset == 0 or offset > len(out):
+      raise DecodeError('snappy copy offset out of bounds')
+    start = len(out) - offset
+    if offset >= size:
+      out += out[start:start+size]
+    else:
+      # Overlapping copy repeats the last offset bytes
+      for i in range(size):
+        out.append(out[start+i])
+  if len(out) != length:
+    raise DecodeError('snappy length mismatch: {0} instead of {1}'.format(len(out), length))
+  return bytes(out)
+
+def read_varint(data, pos):
+  result, shift = 0, 0
+  while True:
+    if pos >= len(data):
+      raise DecodeError('truncated varint')
+    byte = data[pos]
+    pos += 1
+    result |= (byte & 0x7f) << shift
+    if not byte & 0x80:
+      return result, pos
+    shift += 7
+    if shift > 63:
+      raise DecodeError('varint too long')
+
+def protobuf_fields(data):
+  """ Yields the (field number, wire type, value) of a protobuf message. """
+  pos, end = 0, len(data)
+  while pos < end:
+    key, pos = read_varint(data, pos)
+    field, wire = key >> 3, key & 7
+    if wire == 0:
+      value, pos = read_varint(data, pos)
+    elif wire == 1:
+      value, pos = data[pos:pos+8], pos + 8
+    elif wire == 2:
+      size, pos = read_varint(data, pos)
+      value, pos = data[pos:pos+size], pos + size
+    elif wire == 5:
+      value, pos = data[pos:pos+4], pos + 4
+    else:
+      raise DecodeError('unsupported protobuf wire type {0}'.format(wire))
+    if pos > end:
+      raise DecodeError('truncated protobuf field {0}'.format(field))
+    yield field, wire, value
+
+def decode_write_request(data):
+  """ Decodes a prometheus.WriteRequest into a list of (labels, samples).
+
+  The samples are (timestamp in ms, raw little-endian double) tuples,
+  exemplars, histograms and metadata are skipped.
+  """
+  timeseries = []
+  for field, wire, value in protobuf_fields(data):
+    if field != 1 or wire != 2:
+      continue
+    labels, samples = dict(), []
+    for tfield, twire, tvalue in protobuf_fields(value):
+      if tfield == 1 and twire == 2:
+        label = { f: v for f, w, v in protobuf_fields(tvalue) if w == 2 }
+        labels[label.get(1, b'').decode()] = label.get(2, b'').decode()
+      elif tfield == 2 and twire == 2:
+        number, timestamp = bytes(8), 0
+        for sfield, swire, svalue in protobuf_fields(tvalue):
+          if sfield == 1 and swire == 1:
+            number = svalue
+          elif sfield == 2 and swire == 0:
+            timestamp = svalue - (1 << 64) if svalue >= (1 << 63) else svalue
+        samples.append((timestamp, number))
+    timeseries.append((labels, samples))
+  return timeseries
+
+def parse_selector(expression):
+  """ Returns the metric name and the equality matchers of a plain selector, None otherwise. """
+  if not isinstance(expression, str):
+    return None
+  match = SELECTOR_RE.match(expression)
+  if not match:
+    return None
+  name, body = match.group(1), (match.group(2) or '').strip()
+  matchers = dict()
+  pos = 0
+  while pos < len(body):
+    matcher = MATCHER_RE.match(body, pos)
+    if not matcher:
+      return None
+    matchers[matcher.group(1)] = matcher.group(2)
+    pos = matcher.end()
+  return name, matchers
+
+class Store(object):
+  """ Latest pushed sample of the series whose metric a policy queries.
+
+  Holds at most max_series series, the least recently updated ones are
+  evicted first. Only plain selectors are answered from the store, and only
+  while their samples are not older than the staleness.
+  """
+  def __init__(self, max_series=DEFAULT_max_series, staleness=DEFAULT_staleness):
+    self.max_series, self.staleness = max_series, staleness
+    self.lock = threading.Lock()
+    self.series = collections.OrderedDict()
+    self.by_name = dict()
+    self.wanted = dict()
+    self.names = set()
+
+  def configure(self, max_series, staleness):
+    self.max_series, self.staleness = max(int(max_series), 0), float(staleness)
+
+  def register(self, stack, queries):
+    """ Sets the metric names the plain selector queries of a policy read. """
+    selectors = [ parse_selector(x) for x in queries ]
+    with self.lock:
+      self.wanted[stack] = { x[0] for x in selectors if x is not None }
+      self.update_names()
+
+  def unregister(self, stack):
+    with self.lock:
+      self.wanted.pop(stack, None)
+      self.update_names()
+
+  def update_names(self):
+    self.names = set().union(*self.wanted.values())
+    for key in [ x for x in self.series if x[0] not in self.names ]:
+      self.remove(key)
+
+  def remove(self, key):
+    self.series.pop(key, None)
+    keys = self.by_name.get(key[0])
+    if keys is not None:
+      keys.discard(key)
+      if not keys:
+        del self.by_name[key[0]]
+
+  def ingest(self, timeseries):
+    """ Stores the last sample of the wanted series, returns the number of samples stored. """
+    stored = 0
+    with self.lock:
+      for labels, samples in timeseries:
+        samples_received.inc(len(samples))
+        name = labels.get('__name__')
+        if name not in self.names or not samples:
+          continue
+        timestamp, raw = max(samples, key=lambda x: x[0])
+        key = (name, tuple(sorted(labels.items())))
+        if int.from_bytes(raw, 'little') == STALE_NAN:
+          self.remove(key)
+          continue
+        previous = self.series.get(key)
+        if previous is not None and previous[1] > timestamp:
+          continue
+        self.series[key] = (labels, timestamp, struct.unpack('<d', raw)[0])
+        self.series.move_to_end(key)
+        self.by_name.setdefault(name, set()).add(key)
+        stored += 1
+        while len(self.series) > self.max_series:
+          self.remove(next(iter(self.series)))
+          series_evicted.inc()
+      series_stored.set(len(self.series))
+    samples_stored.inc(stored)
+    return stored
+
+  def response(self, expression, now):
+    """ Returns a Prometheus query response built from fresh pushed samples, None if there are none. """
+    selector = parse_selector(expression)
+    if selector is None or selector[0] not in self.names:
+      return None
+    name, matchers = selector
+    oldest = (now - self.staleness) * 1000
+    with self.lock:
+      result = [ dict(metric={ k: v for k, v in labels.items() if k != '__name__' },
+                      value=[timestamp / 1000.0, pk_metrics.format_value(value)])
+                 for labels, timestamp, value in
+                 (self.series[x] for x in self.by_name.get(name, ()))
+                 if timestamp >= oldest and
+                    all(labels.get(k, '') == v for k, v in matchers.items()) ]
+    if not result:
+      return None
+    queries_served.inc()
+    return dict(status='success', data=dict(resultType='vector', result=result))
+
+store = Store()
+
+def configure():
+  config = pk_config.config().get('remote_write') or dict()
+  store.configure(config.get('max_series', DEFAULT_max_series),
+                  config.get('staleness', DEFAULT_staleness))
+
+def receive(body, encoding='snappy'):
+  """ Handles the body of a remote write request, returns the number of samples stored. """
+  log = logging.getLogger('pk_remote_write')
+  try:
+    data = snappy_decompress(body) if encoding == 'snappy' else body
+    timeseries = decode_write_request(data)
+  except (IndexError, ValueError, UnicodeDecodeError) as e:
+    raise DecodeError(str(e))
+  stored = store.ingest(timeseries)
+  log.debug('(Q) Remote write: {0} series received, {1} samples stored'
+            .format(len(timeseries), stored))
+  return stored
+
+def register_policy(stack, expressions):
+  configure()
+  store.register(stack, expressions)
+
+def unregister_policy(stack):
+  store.unregister(stack)
+
+def pushed_response(expression, now=None):
+  if not store.names:
+    return None
+  return store.response(expression, time.time() if now is None else now)
@@ -1,12 +1,12 @@
 import logging
-from flask import Flask, request, jsonify
-import threading
+import pstats
+from flask import Flask, Response, request, jsonify
 import policy_keeper
 from ruamel import yaml
 import pk_config
-import handle_prometheus as prom
-
-policy_thread = None
+import pk_metrics
+import pk_profiler
+import pk_remote_write
 
 app = Flask(__name__)
 
@@ -41,11 +41,10 @@ def unhandled_exception(error):
 
 @app.route('/policy/eval', methods=['POST'])
 def eval_policy():
-  global policy_thread
   data_yaml = request.stream.read()
   if not data_yaml:
     raise RequestException(400, 'Empty POST data')
-  if policy_thread:
+  if policy_keeper.registry.is_running():
     raise RequestException(400, 'Policy processing is already running')
   else:
     log.info('Received data: {0}'.format(data_yaml))
@@ -58,11 +57,10 @@ def eval_policy():
 
 @app.route('/policy/set', methods=['POST'])
 def set_policy():
-  global policy_thread
   policy_yaml = request.stream.read()
   if not policy_yaml:
     raise RequestException(400, 'Empty POST data')
-  if policy_thread:
+  if policy_keeper.registry.is_running():
     raise RequestException(400, 'Policy processing is already running')
   else:
     log.info('Received policy: {0}'.format(policy_yaml))
@@ -71,43 +69,108 @@ def set_policy():
 
 @app.route('/policy/start', methods=['POST'])
 def start_policy():
-  global policy_thread
   policy_yaml = request.stream.read()
   if not policy_yaml: 
     if pk_config.policy():
       policy_yaml = pk_config.policy()
     else:
       raise RequestException(400, 'Empty POST data for /policy/start')
-  if policy_thread:
+  if policy_keeper.registry.is_running():
     raise RequestException(400, 'Policy processing is already running')
   else:
     log.info('Received policy: {0}'.format(policy_yaml))
-    pk_config.finish_scaling(False)
-    policy_thread = threading.Thread(target=policy_keeper.perform_policy_keeping,args=(policy_yaml,))
-    policy_thread.start() 
+    policy_keeper.registry.start(policy_yaml)
   return jsonify(dict(response='OK'))
 
 @app.route('/policy/stop', methods=['POST'])
 def stop_policy():
-  global policy_thread
-  if policy_thread:
-    pk_config.finish_scaling(True)
-    policy_thread.join()
-    policy_thread = None
+  policy_keeper.registry.stop_all()
+  return jsonify(dict(response='OK'))
+
+@app.route('/policies', methods=['GET'])
+def list_policies():
+  return jsonify(dict(policies=policy_keeper.registry.list()))
+
+@app.route('/policies/<stack>/start', methods=['POST'])
+def start_stack_policy(stack):
+  policy_yaml = request.stream.read()
+  if not policy_yaml:
+    raise RequestException(400, 'Empty POST data for /policies/{0}/start'.format(stack))
+  policy = yaml.safe_load(policy_yaml)
+  if not isinstance(policy, dict):
+    raise RequestException(400, 'Invalid policy for /policies/{0}/start'.format(stack))
+  if policy.get('stack', stack) != stack:
+    raise RequestException(400, 'Policy is defined for stack "{0}"'.format(policy.get('stack')))
+  log.info('Received policy for stack "{0}": {1}'.format(stack,policy_yaml))
+  try:
+    policy_keeper.registry.start(policy_yaml, stack)
+  except KeyError:
+    raise RequestException(400, 'Policy processing is already running for stack "{0}"'.format(stack))
+  return jsonify(dict(response='OK'))
+
+@app.route('/policies/<stack>/stop', methods=['POST'])
+def stop_stack_policy(stack):
+  if not policy_keeper.registry.stop(stack):
+    raise RequestException(404, 'No policy is running for stack "{0}"'.format(stack))
   return jsonify(dict(response='OK'))
       
 @app.route('/alerts/fire', methods=['POST'])
 def alerts_fire():
   alert = yaml.safe_load(request.stream)
-  a = prom.alerts_add(alert)
-  log.info('(A) Alert(s) fired: {0}'.format(a))
+  routed = policy_keeper.registry.fire_alerts(alert)
+  log.info('(A) Alert(s) fired: {0}'.format(routed))
   return ''
 
 @app.route('/alerts/reset', methods=['POST'])
 def alerts_init():
   alert = yaml.safe_load(request.stream)
   log.info('(A) Resetting alerts based on external request.')
-  prom.alerts_remove(None)
+  policy_keeper.registry.reset_alerts()
+  return jsonify(dict(response='OK'))
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+  return Response(pk_metrics.exposition(),
+                  content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/v1/write', methods=['POST'])
+def remote_write():
+  encoding = request.headers.get('Content-Encoding','snappy').lower()
+  if encoding not in ('snappy','identity'):
+    raise RequestException(415, 'Unsupported Content-Encoding "{0}"'.format(encoding))
+  try:
+    pk_remote_write.receive(request.get_data(), encoding)
+  except pk_remote_write.DecodeError as e:
+    raise RequestException(400, 'Invalid remote write request: {0}'.format(e))
+  return Response(status=204)
+
+@app.route('/profile/start', methods=['POST'])
+def profile_start():
+  try:
+    sessions = int(request.args.get('sessions', pk_profiler.DEFAULT_sessions))
+    top = int(request.args.get('top', pk_profiler.DEFAULT_top))
+  except ValueError:
+    raise RequestException(400, 'Invalid number in /profile/start parameters')
+  memory = request.args.get('memory', 'false').lower() in ('1','true','yes')
+  pk_profiler.start(sessions, memory, top)
   return jsonify(dict(response='OK'))
 
+def profile_response(profiling):
+  if profiling is None:
+    raise RequestException(404, 'No profiling was requested')
+  sort = request.args.get('sort','cumulative')
+  if sort not in pstats.Stats.sort_arg_dict_default:
+    raise RequestException(400, 'Invalid sort key "{0}"'.format(sort))
+  try:
+    limit = int(request.args.get('limit', pk_profiler.DEFAULT_top))
+  except ValueError:
+    raise RequestException(400, 'Invalid limit in profile parameters')
+  return jsonify(profiling.report(sort, limit))
+
+@app.route('/profile/stop', methods=['POST'])
+def profile_stop():
+  return profile_response(pk_profiler.stop())
 
+@app.route('/profile', methods=['GET'])
+def profile_report():
+  return profile_response(pk_profiler.current())
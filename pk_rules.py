@@ -0,0 +1,47 @@
+import evaluator
+import pk_config
+import pk_history
+
+class RuleIndex(object):
+  """ Names used by the scaling rules of a policy.
+
+  Maps each node and service, as a (kind, name) key, to the names its rule
+  uses, and each name to the nodes and services depending on it.
+  """
+  def __init__(self, policy):
+    self.identifiers = dict()
+    self.dependents = dict()
+    scaling = policy.get('scaling') or dict()
+    for kind in ('nodes','services'):
+      for item in scaling.get(kind) or []:
+        key = (kind, item.get('name'))
+        code = item.get('scaling_rule') or ''
+        # Queries read only through history('NAME', n) are used as well
+        names = evaluator.rule_identifiers(code) | frozenset(pk_history.requirements(code))
+        self.identifiers[key] = names
+        for name in names:
+          self.dependents.setdefault(name,set()).add(key)
+
+  def names(self, kind, name):
+    return self.identifiers.get((kind,name),frozenset())
+
+  def uses(self, kind, name, identifier):
+    return identifier in self.identifiers.get((kind,name),())
+
+  def dependents_of(self, identifiers):
+    result = set()
+    for identifier in identifiers:
+      result.update(self.dependents.get(identifier,()))
+    return result
+
+def build_index(policy):
+  return pk_config.context().derived('rule_index', policy, lambda: RuleIndex(policy), rebuild=True)
+
+def index_of(policy):
+  return pk_config.context().derived('rule_index', policy, lambda: RuleIndex(policy))
+
+def node_identifiers(policy, node):
+  return index_of(policy).names('nodes',node.get('name'))
+
+def service_identifiers(policy, servicename):
+  return index_of(policy).names('services',servicename)
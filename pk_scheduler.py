@@ -0,0 +1,207 @@
+import math
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pk_config
+import pk_metrics
+
+DEFAULT_interval = 15
+DEFAULT_fast_interval = 5
+DEFAULT_fast_duration = 60
+DEFAULT_alert_debounce = 1.0
+DEFAULT_max_workers = 8
+# Allowed earliness of a session when deciding whether an item is due
+DEFAULT_due_tolerance = 1.0
+
+scheduler_lag = pk_metrics.histogram('pk_scheduler_lag_seconds',
+  'Delay between the scheduled tick and the start of the session', ('job',))
+scheduler_overruns = pk_metrics.counter('pk_scheduler_overruns_total',
+  'Ticks skipped because the previous session was still running', ('job',))
+scheduler_interval = pk_metrics.gauge('pk_scheduler_interval_seconds',
+  'Current session interval', ('job',))
+alert_latency = pk_metrics.histogram('pk_alert_to_actuation_seconds',
+  'Time from the arrival of an alert to the end of the session it triggered', ('job',))
+errors_total = pk_metrics.counter('pk_errors_total',
+  'Errors by component', ('component',))
+
+active = []
+
+class Job(object):
+  """ A periodic session with its own tick, fast mode and policy context. """
+  def __init__(self, name, session, interval, fast_interval, fast_duration, context=None):
+    self.name, self.session = name, session
+    self.context = context if context is not None else pk_config.context()
+    self.running = False
+    self.idle = threading.Event()
+    self.idle.set()
+    self.interval, self.fast_interval = interval, fast_interval
+    self.fast_duration = fast_duration
+    self.fast_until = 0
+    self.next_tick = time.time()
+    self.triggered = set()
+    self.triggered_since = None
+    self.trigger_at = None
+
+  def current_interval(self, now):
+    return self.fast_interval if now < self.fast_until else self.interval
+
+class Scheduler(object):
+  """ Runs sessions on ticks aligned to the wall clock.
+
+  The period does not drift with the session duration: the next session
+  starts at the next multiple of the interval. Ticks passed while a session
+  was running are skipped and counted as overruns. After boost() the
+  sessions run with the fast interval for a while.
+
+  trigger() runs an extra session limited to the given alerts right away.
+  Alerts arriving within the debounce window are handled by one session.
+
+  The sessions of the jobs run on a thread pool in the context of their
+  policy, a job never runs twice at the same time.
+  """
+  def __init__(self, interval=DEFAULT_interval, fast_interval=DEFAULT_fast_interval,
+               fast_duration=DEFAULT_fast_duration, alert_debounce=DEFAULT_alert_debounce,
+               max_workers=DEFAULT_max_workers):
+    self.interval = float(interval)
+    self.fast_interval = float(min(fast_interval, interval))
+    self.fast_duration = float(fast_duration)
+    self.alert_debounce = float(alert_debounce)
+    self.max_workers = max(int(max_workers), 1)
+    self.jobs = []
+    self.lock = threading.Lock()
+    self.wakeup = threading.Event()
+
+  @classmethod
+  def from_config(cls, config):
+    config = (config or dict()).get('scheduler') or dict()
+    return cls(config.get('interval',DEFAULT_interval),
+               config.get('fast_interval',DEFAULT_fast_interval),
+               config.get('fast_duration',DEFAULT_fast_duration),
+               config.get('alert_debounce',DEFAULT_alert_debounce),
+               config.get('max_workers',DEFAULT_max_workers))
+
+  def add_job(self, name, session, context=None):
+    job = Job(name, session, self.interval, self.fast_interval, self.fast_duration, context)
+    with self.lock:
+      self.jobs.append(job)
+    scheduler_interval.set(job.interval, job=name)
+    self.wakeup.set()
+    return job
+
+  def remove_job(self, job, wait=True):
+    """ Removes the job, waiting for its running session to finish. """
+    with self.lock:
+      if job in self.jobs:
+        self.jobs.remove(job)
+    if wait:
+      job.idle.wait()
+
+  def boost(self, name=None):
+    now = time.time()
+    for job in list(self.jobs):
+      if name is None or job.name == name:
+        job.fast_until = now + job.fast_duration
+        job.next_tick = min(job.next_tick, self.aligned_tick(now, job.fast_interval))
+        scheduler_interval.set(job.fast_interval, job=job.name)
+    self.wakeup.set()
+
+  def trigger(self, alerts, name=None):
+    now = time.time()
+    with self.lock:
+      for job in self.jobs:
+        if name is None or job.name == name:
+          job.triggered.update(alerts)
+          if job.trigger_at is None:
+            job.triggered_since = now
+            job.trigger_at = now + self.alert_debounce
+    self.wakeup.set()
+
+  @staticmethod
+  def aligned_tick(now, interval):
+    return (math.floor(now / interval) + 1) * interval
+
+  def run_job(self, job):
+    log = logging.getLogger('pk')
+    now = time.time()
+    scheduler_lag.observe(max(now - job.next_tick, 0), job=job.name)
+    try:
+      job.session()
+    except Exception:
+      errors_total.inc(component='session')
+      log.exception('Exception occured during policy execution:')
+    now = time.time()
+    interval = job.current_interval(now)
+    scheduler_interval.set(interval, job=job.name)
+    next_tick = self.aligned_tick(now, interval)
+    skipped = max(math.floor((next_tick - job.next_tick) / interval) - 1, 0)
+    if skipped:
+      scheduler_overruns.inc(skipped, job=job.name)
+      log.warning('(T) Session of "{0}" overran, {1} tick(s) skipped'.format(job.name,skipped))
+    job.next_tick = next_tick
+
+  def run_triggered_job(self, job):
+    log = logging.getLogger('pk')
+    with self.lock:
+      alerts, since = job.triggered, job.triggered_since
+      job.triggered, job.triggered_since, job.trigger_at = set(), None, None
+    log.info('(T) Session of "{0}" triggered by alert(s): {1}'.format(job.name,sorted(alerts)))
+    try:
+      job.session(alerts=alerts)
+    except Exception:
+      errors_total.inc(component='session')
+      log.exception('Exception occured during policy execution:')
+    alert_latency.observe(time.time() - since, job=job.name)
+
+  def execute(self, job, func):
+    try:
+      pk_config.run_in_context(job.context, func, job)
+    finally:
+      job.running = False
+      job.idle.set()
+      self.wakeup.set()
+
+  def dispatch(self, executor, job, func):
+    job.running = True
+    job.idle.clear()
+    executor.submit(self.execute, job, func)
+
+  def run(self, should_stop=pk_config.finish_scaling):
+    active.append(self)
+    executor = ThreadPoolExecutor(max_workers=self.max_workers)
+    try:
+      while not should_stop():
+        now = time.time()
+        with self.lock:
+          jobs = [ x for x in self.jobs if not x.running ]
+        for job in jobs:
+          if job.trigger_at is not None and job.trigger_at <= now:
+            self.dispatch(executor, job, self.run_triggered_job)
+          elif job.next_tick <= now:
+            self.dispatch(executor, job, self.run_job)
+        with self.lock:
+          jobs = [ x for x in self.jobs if not x.running ]
+        deadlines = [ x.next_tick for x in jobs ] + \
+                    [ x.trigger_at for x in jobs if x.trigger_at is not None ]
+        delay = min(deadlines) - time.time() if deadlines else 1.0
+        self.wakeup.wait(max(min(delay, 1.0), 0))
+        self.wakeup.clear()
+    finally:
+      executor.shutdown(wait=True)
+      active.remove(self)
+
+def boost(name=None):
+  for scheduler in list(active):
+    scheduler.boost(name)
+
+def trigger(alerts, name=None):
+  for scheduler in list(active):
+    scheduler.trigger(alerts, name)
+
+def is_due(item, now, tolerance=DEFAULT_due_tolerance):
+  """ Checks the evaluation_interval of a node or service against its last evaluation. """
+  interval = item.get('evaluation_interval')
+  last = item.get('evaluated_at')
+  if not interval or last is None:
+    return True
+  return now - last >= float(interval) - tolerance
@@ -0,0 +1,90 @@
+import re
+import numpy
+
+VECTOR_RE = re.compile(r'\s*\{\s*"status"\s*:\s*"success"\s*,\s*"data"\s*:\s*\{\s*'
+                       r'"resultType"\s*:\s*"vector"\s*,\s*"result"\s*:\s*\[')
+SAMPLE_RE = re.compile(r'"value":\s*\[([^,\]]+),\s*"([^"]*)"')
+
+class Vector(object):
+  """ Result of a vector query: the samples as aligned numpy arrays.
+
+  values and timestamps are float arrays, labels maps each label name to a
+  string array of the same length. The label columns are also attributes,
+  e.g. CPU.instance[CPU.values.argmin()] in a scaling rule.
+  """
+  def __init__(self, values, timestamps, labels):
+    self.values, self.timestamps, self.labels = values, timestamps, labels
+
+  def __getattr__(self, name):
+    if name.startswith('_') or name not in self.__dict__.get('labels', ()):
+      raise AttributeError(name)
+    return self.labels[name]
+
+  def __len__(self):
+    return len(self.values)
+
+  def __repr__(self):
+    return 'Vector({0} series, labels: {1})'.format(len(self.values), ','.join(sorted(self.labels)))
+
+  def label(self, name):
+    """ Returns the column of a label, empty strings where a series does not have it. """
+    return self.labels.get(name, numpy.full(len(self.values), '', dtype=str))
+
+def parse(data, labels=None):
+  """ Builds a Vector from the data of a Prometheus instant query response.
+
+  With labels given only these columns are kept, otherwise every label seen
+  in the result. The samples are read in one pass straight into columns.
+  """
+  result = data['result']
+  if data.get('resultType') == 'scalar':
+    result = [ dict(metric=dict(), value=result) ]
+  elif data.get('resultType') != 'vector':
+    raise Exception('Unsupported result type "{0}" for a vector query'.format(data.get('resultType')))
+  count = len(result)
+  values = numpy.empty(count)
+  timestamps = numpy.empty(count)
+  columns = { name: [''] * count for name in labels or () }
+  for i, sample in enumerate(result):
+    timestamps[i], values[i] = sample['value']
+    metric = sample.get('metric') or ()
+    if labels:
+      for name in labels:
+        if name in metric:
+          columns[name][i] = metric[name]
+    else:
+      for name in metric:
+        if name not in columns:
+          columns[name] = [''] * count
+        columns[name][i] = metric[name]
+  return Vector(values, timestamps,
+                { name: numpy.array(column, dtype=str) for name, column in columns.items() })
+
+def label_re(name):
+  return re.compile('"' + re.escape(name) + r'":\s*"([^"\\]*)"')
+
+def scan(text, labels):
+  """ Builds a Vector from the text of a Prometheus vector query response.
+
+  The samples and the given label columns are each read by a single regex
+  pass over the text into arrays, no dict is built per sample. Returns None
+  when the text cannot be read this way: not a vector, no labels given, a
+  label missing from some series or a value with escapes. The caller then
+  decodes the response and uses parse.
+  """
+  if not labels or not VECTOR_RE.match(text):
+    return None
+  count = text.count('"metric":')
+  samples = SAMPLE_RE.findall(text)
+  if len(samples) != count:
+    return None
+  columns = dict()
+  for name in labels:
+    column = label_re(name).findall(text)
+    if len(column) != count:
+      return None
+    columns[name] = numpy.array(column, dtype=str)
+  if not count:
+    return Vector(numpy.empty(0), numpy.empty(0), columns)
+  timestamps, values = numpy.array(samples, dtype=float).T
+  return Vector(values, timestamps, columns)
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 import time, sys
+import asyncio
+import threading
 import requests
 from ruamel import yaml
 import json
@@ -16,10 +18,28 @@ import evaluator
 import argparse
 import pk_rest
 import pk_config
+import pk_http
+import pk_actuator
+import pk_scheduler
+import pk_rules
+import pk_inputs
+import pk_metrics
+import pk_deadline
+import pk_profiler
+import pk_history
+import pk_remote_write
 from pk_helper import *
 
 log = None
 
+DEFAULT_stage_timeouts = dict(prepare=30, inputs=30, queries=30, evaluation=60, actuation=150)
+session_stage_seconds = pk_metrics.histogram('pk_session_stage_seconds',
+  'Wall time of the stages of the asynchronous session', ('stage',))
+session_seconds = pk_metrics.histogram('pk_session_seconds',
+  'Duration of the sessions by policy stack', ('stack',))
+session_phase_seconds = pk_metrics.histogram('pk_session_phase_seconds',
+  'Duration of the session phases, per node or service for inputs, queries and evaluation', ('phase',))
+
 def resolve_queries(policy_yaml):
   stack = dict()
   stack['stack'] = yaml.safe_load(policy_yaml).get('stack','undefined_stack_name')
@@ -39,7 +59,7 @@ def get_full_service_name(policy, service_name):
     full_service_name='{0}'.format(service_name)
   return full_service_name
 
-def perform_service_scaling(policy,service_name):
+def perform_service_scaling(policy,service_name,actuation):
   for srv in policy['scaling']['services']:
     if 'm_container_count' in srv.get('outputs',dict()) and srv['name']==service_name:
         log.debug('(S) Scaling values for service "{0}": min:{1} max:{2} calculated:{3}'
@@ -47,7 +67,9 @@ def perform_service_scaling(policy,service_name):
         containercount = max(min(int(srv['outputs']['m_container_count']),int(srv['max_instances'])),int(srv['min_instances']))
         service_name = get_full_service_name(policy, srv['name'])
         config = pk_config.config()
-        k8s.scale_k8s_deploy(config['k8s_endpoint'],service_name,containercount)
+        actuation.add(k8s.dryrun_id,'scale_k8s_deploy {0}:{1}'.format(service_name,containercount),
+                      k8s.scale_k8s_deploy,config['k8s_endpoint'],service_name,containercount,
+                      target=service_name)
 
 def get_node_scaling(node):
   m_node_count = node.get('outputs',dict()).get('m_node_count')
@@ -78,20 +100,21 @@ def get_node_scaling(node):
     return cloud.scale_worker_node, scaling_info
   return None, None
 
-def perform_policy_evaluation_on_a_k8s_deploy(policy,service_name):
+def perform_policy_evaluation_on_a_k8s_deploy(policy,service_name,query_results,alert_results):
    outvars = ['m_container_count','m_userdata']
    for srv in policy['scaling']['services']:
      if srv['name'] != service_name:
        continue
      inpvars = srv['inputs']
      inpvars['m_userdata'] = policy['scaling'].get('userdata',None)
-     for attrname, attrvalue in policy.get('data',dict()).get('query_results',dict()).items():
+     for attrname, attrvalue in query_results.items():
        inpvars[attrname]=attrvalue
-     for attrname, attrvalue in policy.get('data',dict()).get('alert_results',dict()).items():
+     for attrname, attrvalue in alert_results.items():
        inpvars[attrname]=attrvalue
      for attrname, attrvalue in policy.get('data',dict()).get('constants',dict()).items():
        inpvars[attrname]=attrvalue
-     inpvars['requests']=requests
+     pk_inputs.provide('services', pk_rules.service_identifiers(policy,service_name),
+                       policy, srv, inpvars, pk_inputs.EVALUATE)
      if srv.get('scaling_rule','')!='':
        result = evaluator.evaluate(srv.get('scaling_rule',''), inpvars, outvars)
        if 'outputs' not in srv:
@@ -101,24 +124,25 @@ def perform_policy_evaluation_on_a_k8s_deploy(policy,service_name):
      log.info('(P)   => m_container_count: {0}'.format(int(srv.get('outputs',dict()).get('m_container_count',0))))
    return
 
-def perform_policy_evaluation_on_worker_nodes(policy, node):
+def perform_policy_evaluation_on_worker_nodes(policy, node, query_results, alert_results):
    inpvars = node['inputs']
    outvars = ['m_node_count','m_userdata','m_nodes_todrop']
    inpvars['m_userdata'] = policy['scaling'].get('userdata',None)
-   for attrname, attrvalue in policy.get('data',dict()).get('query_results',dict()).items():
+   for attrname, attrvalue in query_results.items():
      inpvars[attrname]=attrvalue
-   for attrname, attrvalue in policy.get('data',dict()).get('alert_results',dict()).items():
+   for attrname, attrvalue in alert_results.items():
      inpvars[attrname]=attrvalue
    for attrname, attrvalue in policy.get('data',dict()).get('constants',dict()).items():
      inpvars[attrname]=attrvalue
-   inpvars['m_opt_advice']=optim.calling_rest_api_advice
-   inpvars['requests']=requests
+   pk_inputs.provide('nodes', pk_rules.node_identifiers(policy,node),
+                     policy, node, inpvars, pk_inputs.EVALUATE)
    if node.get('scaling_rule','')!='':
      result = evaluator.evaluate(node.get('scaling_rule',''), inpvars, outvars)
      if 'outputs' not in node:
        node['outputs']={}
 
-     nodes_to_drop_list=result.get('m_nodes_todrop',[])
+     nodes_to_drop_list=result.get('m_nodes_todrop')
+     nodes_to_drop_list=[ str(x) for x in nodes_to_drop_list ] if nodes_to_drop_list is not None else []
      if nodes_to_drop_list:
        node['outputs']['m_nodes_todrop']=nodes_to_drop_list
        node['outputs']['m_node_count']=node['inputs']['m_node_count']
@@ -158,6 +182,14 @@ def set_k8s_instance_number(policy,service_name,instances):
       theservice['outputs']['m_container_count']=instances
   return
 
+def compile_scaling_rules(policy):
+  scaling = policy.get('scaling',dict())
+  for item in (scaling.get('nodes') or []) + (scaling.get('services') or []):
+    if item.get('scaling_rule'):
+      tree = evaluator.compile_rule(item['scaling_rule'])
+      if isinstance(tree, SyntaxError):
+        log.warning('(C)   => scaling rule of "{0}" cannot be parsed: {1}'.format(item.get('name'),tree))
+
 def prepare_session(policy_yaml):
   global log
   log = logging.getLogger('pk')
@@ -175,6 +207,15 @@ def prepare_session(policy_yaml):
       if comp in pk_config.var_dryrun_components:
         pk_config.dryrun_set(comp,True)
   log.info('(C) Enable dryrun for the following components: {0}'.format(pk_config.dryrun_get()))
+  #Compile scaling rules
+  log.info('(C) Compiling scaling rules starts')
+  compile_scaling_rules(policy)
+  index = pk_rules.build_index(policy)
+  log.info('(C) Indexed {0} names used by the scaling rules'.format(len(index.dependents)))
+  history = pk_history.build_history(policy, config.get('history_length', pk_history.DEFAULT_length))
+  log.info('(C) Keeping the history of {0} queries'.format(len(history.wanted)))
+  pk_remote_write.register_policy(policy.get('stack','pk'),
+    [ prom.query_expression(x) for x in policy.get('data',dict()).get('queries',dict()).values() ])
   #Initialize Prometheus
   log.info('(C) Add exporters to prometheus configuration file starts')
   config_tpl = config['prometheus_config_template']
@@ -198,6 +239,7 @@ def prepare_session(policy_yaml):
     set_worker_node_instance_number(onenode,instances)
   #Initialise service through K8S
   log.info('(C) Querying number of service replicas from K8s starts')
+  k8s.refresh_deployments_snapshot(config['k8s_endpoint'])
   for theservice in policy.get('scaling',dict()).get('services',[]):
     service_name = theservice.get('name','')
     full_service_name = get_full_service_name(policy, service_name)
@@ -213,93 +255,104 @@ def prepare_session(policy_yaml):
 
 def add_query_results_and_alerts_to_nodes(policy, results, node):
   queries, alerts = dict(), dict()
-  policy['data']['query_results']={}
-  policy['data']['alert_results']={}
-  scaling_rule_str = node.get('scaling_rule','')
+  identifiers = pk_rules.node_identifiers(policy,node)
   for attrname, attrvalue in results.get('data',dict()).get('queries',dict()).items():
-    if scaling_rule_str is not None and scaling_rule_str.find(attrname) != -1:
+    if attrname in identifiers:
       queries[attrname]=attrvalue
-      policy['data']['query_results'][attrname]=attrvalue
   fired_alerts = dict()
   for item in results.get('data',dict()).get('alerts',dict()):
     fired_alerts[item['alert']]=True
   for item in policy.get('data',dict()).get('alerts',dict()):
     attrname = item['alert']
-    if scaling_rule_str is not None and scaling_rule_str.find(attrname) != -1:
-      if attrname in fired_alerts:
-        policy['data']['alert_results'][attrname]=True
-        alerts[attrname]=True
-      else:
-        policy['data']['alert_results'][attrname]=False
-        alerts[attrname]=False
+    if attrname in identifiers:
+      alerts[attrname] = attrname in fired_alerts
   return queries, alerts
 
 def add_query_results_and_alerts_to_service(policy, results, servicename):
   queries, alerts = dict(), dict()
-  policy['data']['query_results']={}
-  policy['data']['alert_results']={}
-  all_services = policy.get('scaling',dict()).get('services',dict())
-  target_service = [ srv for srv in all_services if srv.get('name','')==servicename ]
-  scaling_rule_str = target_service[0].get('scaling_rule','') if target_service else ''
+  identifiers = pk_rules.service_identifiers(policy,servicename)
   for attrname,attrvalue in results.get('data',dict()).get('queries',dict()).items():
-    if scaling_rule_str is not None and scaling_rule_str.find(attrname) != -1:
+    if attrname in identifiers:
       queries[attrname]=attrvalue
-      policy['data']['query_results'][attrname]=attrvalue
   fired_alerts = dict()
   for item in results.get('data',dict()).get('alerts',dict()):
     fired_alerts[item['alert']]=True
   for item in policy.get('data',dict()).get('alerts',dict()):
     attrname = item['alert']
-    if scaling_rule_str is not None and scaling_rule_str.find(attrname) != -1:
-      if attrname in fired_alerts:
-        policy['data']['alert_results'][attrname]=True
-        alerts[attrname]=True
-      else:
-        policy['data']['alert_results'][attrname]=False
-        alerts[attrname]=False
+    if attrname in identifiers:
+      alerts[attrname] = attrname in fired_alerts
   return queries, alerts
 
-def collect_inputs_for_nodes(policy, node):
-  inputs={}
+@pk_inputs.provider('m_nodes', 'nodes', triggers=('m_nodes','m_time_when_node_count_changed',
+                                     'm_time_since_node_count_changed','m_opt_advice'))
+def provide_nodes_of_node(policy, node, inputs):
   config = pk_config.config()
-  inputs['m_nodes']=k8s.query_list_of_nodes(config['k8s_endpoint'], node['name'])
-  inputs['m_node_count'],_,_ = limit_instances(
-    node.get('outputs',dict()).get('m_node_count'),
-    node.get('min_instances'),
-    node.get('max_instances'))
-  inputs['m_nodes_todrop']=[]
+  provided = dict()
+  provided['m_nodes']=k8s.query_list_of_nodes(config['k8s_endpoint'], node['name'])
 
   prev_node_count = node.get('inputs',dict()).get('m_node_count',None)
   prev_nodes = node.get('inputs',dict()).get('m_nodes',None)
   if prev_node_count and prev_nodes:
     if prev_node_count == len(prev_nodes):
-      if inputs['m_node_count']==len(inputs['m_nodes']):
-        inputs['m_time_when_node_count_changed'] = node.get('inputs',dict()).get('m_time_when_node_count_changed',0)
+      if inputs['m_node_count']==len(provided['m_nodes']):
+        provided['m_time_when_node_count_changed'] = node.get('inputs',dict()).get('m_time_when_node_count_changed',0)
       else:
-        inputs['m_time_when_node_count_changed'] = 0
+        provided['m_time_when_node_count_changed'] = 0
     else:
-      if inputs['m_node_count']==len(inputs['m_nodes']):
-        inputs['m_time_when_node_count_changed'] = int(time.time())
+      if inputs['m_node_count']==len(provided['m_nodes']):
+        provided['m_time_when_node_count_changed'] = int(time.time())
       else:
-        inputs['m_time_when_node_count_changed'] = 0
+        provided['m_time_when_node_count_changed'] = 0
   else:
-    inputs['m_time_when_node_count_changed'] = int(time.time())
-  if inputs['m_time_when_node_count_changed'] == 0:
-    inputs['m_time_since_node_count_changed'] = 0
+    provided['m_time_when_node_count_changed'] = int(time.time())
+  if provided['m_time_when_node_count_changed'] == 0:
+    provided['m_time_since_node_count_changed'] = 0
   else:
-    inputs['m_time_since_node_count_changed'] = int(time.time())-inputs['m_time_when_node_count_changed']
+    provided['m_time_since_node_count_changed'] = int(time.time())-provided['m_time_when_node_count_changed']
+  return provided
+
+@pk_inputs.provider('m_opt_advice', 'nodes', phase=pk_inputs.EVALUATE)
+def provide_optimizer_advice(policy, node, inputs):
+  return dict(m_opt_advice=optim.advice_function())
+
+@pk_inputs.provider('requests', 'nodes', phase=pk_inputs.EVALUATE)
+@pk_inputs.provider('requests', 'services', phase=pk_inputs.EVALUATE)
+def provide_requests(policy, item, inputs):
+  return dict(requests=requests)
+
+@pk_inputs.provider('history', 'nodes', triggers=pk_history.FUNCTIONS, phase=pk_inputs.EVALUATE)
+@pk_inputs.provider('history', 'services', triggers=pk_history.FUNCTIONS, phase=pk_inputs.EVALUATE)
+def provide_history(policy, item, inputs):
+  return pk_history.history_of(policy).inputs(item.get('scaling_rule') or '')
+
+@pk_inputs.provider('m_nodes', 'services')
+def provide_nodes_of_service(policy, theservice, inputs):
+  config = pk_config.config()
+  m_nodes = []
+  for node in policy.get('scaling',dict()).get('nodes',[]):
+    if not theservice.get('hosts') or node['name'] in theservice.get('hosts', []):
+      m_nodes+=k8s.query_list_of_nodes(config['k8s_endpoint'], node['name'])
+  return dict(m_nodes=m_nodes)
 
+@pk_metrics.timed(session_phase_seconds, phase='inputs')
+def collect_inputs_for_nodes(policy, node):
+  inputs={}
+  inputs['m_node_count'],_,_ = limit_instances(
+    node.get('outputs',dict()).get('m_node_count'),
+    node.get('min_instances'),
+    node.get('max_instances'))
+  inputs['m_nodes_todrop']=[]
+  pk_inputs.provide('nodes', pk_rules.node_identifiers(policy,node), policy, node, inputs)
   inputs['m_userdata']=policy.get('scaling',dict()).get('userdata',None)
   return inputs
 
 def set_policy_inputs_for_nodes(policy,inputs,node):
   node['inputs']=inputs
 
+@pk_metrics.timed(session_phase_seconds, phase='inputs')
 def collect_inputs_for_containers(policy,service_name):
   inputs={}
-  config = pk_config.config()
   nodes = policy.get('scaling',dict()).get('nodes',[])
-  inputs['m_nodes'] = []
   mnc, mini, maxi = 0, 0, 0
   
   for theservice in policy.get('scaling',dict()).get('services',[]):
@@ -307,10 +360,11 @@ def collect_inputs_for_containers(policy,service_name):
     if service_name == theservice.get('name',''):
       for node in nodes:
         if not theservice.get('hosts') or node['name'] in theservice.get('hosts', []):
-          inputs['m_nodes']+=k8s.query_list_of_nodes(config['k8s_endpoint'], node['name'])
           mnc,mini,maxi = limit_instances(node.get('outputs',dict()).get('m_node_count'),
                                           node.get('min_instances'),
                                           node.get('max_instances'))
+      pk_inputs.provide('services', pk_rules.service_identifiers(policy,service_name),
+                        policy, theservice, inputs)
       inputs['m_node_count'] = mnc
       mcc = theservice.get('outputs',dict()).get('m_container_count',None)
       inputs['m_container_count'] = max(min(int(mcc),int(theservice['max_instances'])),int(theservice['min_instances']))\
@@ -323,112 +377,406 @@ def set_policy_inputs_for_containers(policy,service_name,inputs):
     if service_name == theservice.get('name',''):
       theservice['inputs']=inputs
 
-def perform_one_session(policy, results = None):
+def session_items(policy, kind, session_time, affected):
+  """ Returns the nodes or services to evaluate in the session and marks them evaluated. """
+  items = []
+  for item in policy.get('scaling',dict()).get(kind,[]):
+    name = item.get('name')
+    if affected is not None:
+      if (kind,name) not in affected:
+        continue
+    elif not pk_scheduler.is_due(item, session_time):
+      log.info('(T) Skipping {0} "{1}", its evaluation interval has not elapsed'.format(kind[:-1],name))
+      continue
+    item['evaluated_at'] = session_time
+    items.append(item)
+  return items
+
+def session_counters():
+  """ Returns the counters of the policy logged per session, to be subtracted at the end. """
+  return dict(rules=evaluator.rule_cache_stats(), queries=prom.session_cache_stats(),
+              scaling=k8s.scale_stats())
+
+def counters_since(counters, before):
+  return { name: { k: v - before[name][k] for k, v in values.items() }
+           for name, values in counters.items() }
+
+def log_session_stats(before):
+  counters = counters_since(session_counters(), before)
+  log.info('(P) Rule cache: {hits} hits, {misses} misses, {parse_time:.6f}s parsing'
+           .format(**counters['rules']))
+  log.info('(Q) Query cache: {hits} hits, {misses} misses'
+           .format(**counters['queries']))
+  batching = prom.session_batch_stats()
+  if batching['requests']:
+    log.info('(Q) Query batching: {queries} queries in {requests} requests, {saved} round-trips saved'
+             .format(**batching))
+  log.info('(S) K8s scaling: {writes} writes, {skipped} skipped as unchanged'
+           .format(**counters['scaling']))
+  for provider, stats in pk_inputs.stats().items():
+    log.debug('(I) Input provider {0}: {calls} calls, {skipped} skipped, {seconds:.3f}s'.format(provider,**stats))
+  for endpoint, stats in pk_http.stats().items():
+    log.debug('(H) {0}: {requests} requests, {errors} errors, {seconds:.3f}s'.format(endpoint,**stats))
+
+def log_actuation_report(report):
+  log.info('(S) Actuation: {0} applied, {1} skipped, {2} failed'
+           .format(len(report['applied']),len(report['skipped']),len(report['failed'])))
+  for state in ['applied','skipped','failed']:
+    for item in report[state]:
+      log.debug('(S)   => {0}: {1}'.format(state,item))
+
+def perform_one_session(policy, results = None, fired_alerts = None):
+  """ Performs one session of the policy.
+
+  If fired_alerts is given, only the nodes and services whose scaling rule refers
+  to one of these alerts are evaluated, regardless of their evaluation interval.
+  The session runs as asynchronous pipeline if session_engine is set to async.
+
+  If session_budget is set, the session has a deadline passed down to the
+  queries, the evaluations and the scaling calls. When it runs out, work is
+  shed in this order: the optimizer samples, once less than the reserve (at
+  most half of the evaluation time) is left; then the services and the nodes
+  not evaluated yet, which keep their last decision and are due again in the
+  next session; finally the scaling calls not started within the reserve. The
+  shed items are listed in the result of the session.
+  """
   global log
   log = logging.getLogger('pk')
   config = pk_config.config()
   log.info('--- session starts ---')
-  log.info('(M) Maintaining worker nodes starts')
+  start = time.time()
+  counters = session_counters()
+  profile = pk_profiler.session_begin()
+  deadline, token = pk_deadline.begin(config.get('session_budget'),
+                      config.get('session_budget_reserve',pk_deadline.DEFAULT_reserve))
+  try:
+    if config.get('session_engine','sync') == 'async':
+      result = asyncio.run(perform_one_session_async(policy, results, fired_alerts))
+    else:
+      result = perform_one_session_sync(policy, results, fired_alerts)
+  finally:
+    pk_deadline.end(token)
+    session_seconds.observe(time.time()-start, stack=pk_config.context().name or policy.get('stack',''))
+    pk_profiler.session_end(profile, pk_config.context().name or policy.get('stack',''))
+  result['shed'] = list(deadline.shed)
+  if deadline.shed:
+    log.warning('(T) Shed from the session: {0}'.format(', '.join(deadline.shed)))
+  log_session_stats(counters)
+  log.info('--- session finished ---')
+  return result
+
+def shed_item(kind, item):
+  """ Leaves the item out of the session. It keeps its last decision and is due again in the next session. """
+  item.pop('evaluated_at', None)
+  pk_deadline.shed(kind[:-1], '"{0}"'.format(item.get('name')))
+
+@pk_metrics.timed(session_phase_seconds, phase='queries')
+def collect_item_queries(policy, results, kind, item):
+  config = pk_config.config()
+  name = item.get('name')
+  if kind == 'nodes':
+    if results:
+      queries, alerts = add_query_results_and_alerts_to_nodes(policy, results, item)
+    else:
+      queries, alerts = prom.evaluate_data_queries_and_alerts_for_nodes(config['prometheus_endpoint'],policy,item)
+  else:
+    if results:
+      queries, alerts = add_query_results_and_alerts_to_service(policy, results, name)
+    else:
+      queries, alerts = prom.evaluate_data_queries_and_alerts_for_a_service(config['prometheus_endpoint'],policy,name)
+  pk_deadline.check()
+  pk_history.history_of(policy).record(queries, prom.query_session().time)
+  for attrname, attrvalue in queries.items():
+    log.info('(Q)   => {0} "{1}": "{2}" is "{3}".'.format(kind[:-1],name,attrname,attrvalue))
+  for attrname, attrvalue in alerts.items():
+    log.info('(A)   => {0} "{1}": "{2}" is "{3}".'.format(kind[:-1],name,attrname,attrvalue))
+  return queries, alerts
+
+@pk_metrics.timed(session_phase_seconds, phase='evaluation')
+def evaluate_node(policy, onenode, queries, alerts):
+  node_name = onenode.get('name')
+  if pk_rules.index_of(policy).uses('nodes',node_name,'m_opt_advice'):
+    if pk_deadline.optional_expired():
+      pk_deadline.shed('optimizer sample', 'of node "{0}"'.format(node_name))
+    else:
+      log.info('(O) Sending sample of node {0} for the optimizer starts'.format(node_name))
+      optim.calling_rest_api_sample(optim.generate_sample(queries,onenode['inputs']))
+  log.info('(P) Policy evaluation for node {0} starts'.format(node_name))
+  perform_policy_evaluation_on_worker_nodes(policy, onenode, queries, alerts)
+  pk_deadline.check()
+  for attrname in alerts:
+    prom.alerts_remove(attrname)
+  return get_node_scaling(onenode)
+
+@pk_metrics.timed(session_phase_seconds, phase='evaluation')
+def evaluate_service(policy, oneservice, queries, alerts, actuation):
+  service_name = oneservice.get('name')
+  log.info('(P) Policy evaluation for service "{0}" starts'.format(service_name))
+  perform_policy_evaluation_on_a_k8s_deploy(policy, service_name, queries, alerts)
+  pk_deadline.check()
+  perform_service_scaling(policy, service_name, actuation)
+  for attrname in alerts:
+    prom.alerts_remove(attrname)
+  return True
+
+@pk_metrics.timed(session_phase_seconds, phase='maintenance')
+def maintain_worker_nodes(config):
   k8s.down_nodes_maintenance(config['k8s_endpoint'],config['docker_node_unreachable_timeout'])
+
+@pk_metrics.timed(session_phase_seconds, phase='queries')
+def prefetch_queries(config, policy, affected=None):
+  prom.prefetch_session_queries(config['prometheus_endpoint'],policy,affected)
+
+def needs_deployments(policy, affected):
+  """ Tells whether services are evaluated in the session, all of them or the affected ones. """
+  return any(affected is None or ('services',x.get('name')) in affected
+             for x in policy.get('scaling',dict()).get('services') or [])
+
+@pk_metrics.timed(session_phase_seconds, phase='actuation')
+def run_actuation(actuation):
+  return actuation.run()
+
+def perform_node_session(policy, results, onenode):
+  node_name = onenode.get('name')
+  log.info('(I) Collecting inputs for node {} starts'.format(node_name))
+  inputs = collect_inputs_for_nodes(policy, onenode)
+  set_policy_inputs_for_nodes(policy,inputs,onenode)
+  for x in list(inputs.keys()):
+    log.info('(I)   => "{0}": {1}'.format(x,inputs[x]))
+  log.info('(Q) Evaluating queries and alerts for node {} starts'.format(node_name))
+  queries, alerts = collect_item_queries(policy, results, 'nodes', onenode)
+  return evaluate_node(policy, onenode, queries, alerts)
+
+def perform_service_session(policy, results, oneservice, actuation):
+  service_name = oneservice.get('name')
+  log.info('(I) Collecting inputs for service "{0}" starts'.format(service_name))
+  inputs = collect_inputs_for_containers(policy,service_name)
+  set_policy_inputs_for_containers(policy,service_name,inputs)
+  for x in list(inputs.keys()):
+    log.info('(I)   => "{0}": {1}'.format(x,inputs[x]))
+  log.info('(Q) Evaluating queries and alerts for service "{0}" starts'.format(service_name))
+  queries, alerts = collect_item_queries(policy, results, 'services', oneservice)
+  evaluate_service(policy, oneservice, queries, alerts, actuation)
+  log.info('(S) Scaling of service "{0}" is planned'.format(service_name))
+
+def perform_one_session_sync(policy, results = None, fired_alerts = None):
+  config = pk_config.config()
+  session_time = prom.session_begin()
+  index = pk_rules.index_of(policy)
+  affected = index.dependents_of(fired_alerts) if fired_alerts is not None else None
+  if fired_alerts is None:
+    log.info('(M) Maintaining worker nodes starts')
+    maintain_worker_nodes(config)
+  if needs_deployments(policy, affected):
+    k8s.refresh_deployments_snapshot(config['k8s_endpoint'])
   nodes_to_scale = dict()
+  actuation = pk_actuator.ActuationStage()
+  if not results:
+    log.info('(Q) Prefetching queries for the {0} starts'
+             .format('nodes and services' if affected is None else 'affected nodes and services'))
+    prefetch_queries(config, policy, affected)
 
   # Nodes loop
-  for onenode in policy.get('scaling',dict()).get('nodes',[]):
-    node_name = onenode.get('name')
-    log.info('(I) Collecting inputs for node {} starts'.format(node_name))
-    inputs = collect_inputs_for_nodes(policy, onenode)
-    set_policy_inputs_for_nodes(policy,inputs,onenode)
-    for x in list(inputs.keys()):
-      log.info('(I)   => "{0}": {1}'.format(x,inputs[x]))
-    log.info('(Q) Evaluating queries and alerts for node {} starts'.format(node_name))
-    if results:
-      queries, alerts = add_query_results_and_alerts_to_nodes(policy, results, onenode)
-    else:
-      queries, alerts = prom.evaluate_data_queries_and_alerts_for_nodes(config['prometheus_endpoint'],policy, onenode)
-    for attrname, attrvalue in queries.items():
-      log.info('(Q)   => "{0}" is "{1}".'.format(attrname,attrvalue))
-    for attrname, attrvalue in alerts.items():
-      log.info('(A)   => "{0}" is "{1}".'.format(attrname,attrvalue))
-
-    if 'm_opt_advice' in onenode.get('scaling_rule',''):
-      log.info('(O) Creating sample for the optimizer starts')
-      sample = optim.generate_sample(queries,inputs)
-      log.info('(O) Sending sample for the optimizer starts')
-      optim.calling_rest_api_sample(sample)
-
-    log.info('(P) Policy evaluation for nodes starts')
-    perform_policy_evaluation_on_worker_nodes(policy, onenode)
-    log.info('(S) Scaling of nodes starts')
+  for onenode in session_items(policy, 'nodes', session_time, affected):
+    if pk_deadline.expired():
+      shed_item('nodes', onenode)
+      continue
+    try:
+      scaling_method, scaling_info = perform_node_session(policy, results, onenode)
+    except pk_deadline.DeadlineExceeded:
+      shed_item('nodes', onenode)
+      continue
+    log.info('(S) Scaling of nodes is planned')
 
     # First, collect orchestrator handler method and info for each node
-    scaling_method, scaling_info = get_node_scaling(onenode)
     if scaling_method and scaling_info:
       nodes_to_scale.setdefault(scaling_method, []).append(scaling_info)
-    for attrname, attrvalue in alerts.items():
-      prom.alerts_remove(attrname)
 
-  # Then, scale nodes using the correct orchestrator and scaling info    
+  # Then, plan scaling nodes using the correct orchestrator and scaling info
   for handler_method, scaling_info in nodes_to_scale.items():
-    handler_method(config, scaling_info)
+    actuation.add_node_scaling(config, handler_method, scaling_info)
 
   # Containers loop
-  for oneservice in policy.get('scaling',dict()).get('services',[]):
-    service_name=oneservice.get('name')
-    log.info('(I) Collecting inputs for service "{0}" starts'.format(service_name))
-    inputs = collect_inputs_for_containers(policy,service_name)
-    set_policy_inputs_for_containers(policy,service_name,inputs)
-    for x in list(inputs.keys()):
-      log.info('(I)   => "{0}": {1}'.format(x,inputs[x]))
-    log.info('(Q) Evaluating queries and alerts for service "{0}" starts'.format(service_name))
-    if results:
-      queries, alerts = add_query_results_and_alerts_to_service(policy, results, service_name)
+  for oneservice in session_items(policy, 'services', session_time, affected):
+    if pk_deadline.expired():
+      shed_item('services', oneservice)
+      continue
+    try:
+      perform_service_session(policy, results, oneservice, actuation)
+    except pk_deadline.DeadlineExceeded:
+      shed_item('services', oneservice)
+
+  log.info('(S) Actuation of the planned scalings starts')
+  report = run_actuation(actuation)
+  log_actuation_report(report)
+  return dict(actuation=report)
+
+def stage_timeout(timeouts, stage):
+  """ Returns the timeout of a stage, limited to the time left in the session. """
+  return min(float(timeouts[stage]), max(pk_deadline.remaining(), 0))
+
+async def run_stage(stages, name, calls, timeout, on_shed=None):
+  """ Runs the blocking calls of a stage concurrently in threads.
+
+  Returns the results in the order of the calls, None for a call that failed
+  or did not finish within the timeout. on_shed is called with the position
+  of the calls cut off by the timeout or by the session deadline. The threads
+  of timed out calls cannot be stopped, the deadline counts as exceeded for
+  them instead, so they give up at their next query, evaluation or scaling.
+  """
+  start = time.time()
+  events = [ threading.Event() for x in calls ]
+  tasks = [ asyncio.ensure_future(asyncio.to_thread(pk_deadline.run_cancellable, event, func, *args))
+            for event, (func, *args) in zip(events, calls) ]
+  done, pending = await asyncio.wait(tasks, timeout=timeout) if tasks else (set(), set())
+  for event, task in zip(events, tasks):
+    if task in pending:
+      event.set()
+      task.cancel()
+  if pending:
+    log.warning('(T) Stage "{0}": {1} call(s) did not finish within {2:.1f} seconds'.format(name,len(pending),timeout))
+  results = []
+  for i, task in enumerate(tasks):
+    if task in done and task.exception() is None:
+      results.append(task.result())
+      continue
+    if task in done and not isinstance(task.exception(), pk_deadline.DeadlineExceeded):
+      log.error('(T) Stage "{0}": call failed: {1}'.format(name,task.exception()))
+    elif on_shed:
+      on_shed(i)
+    results.append(None)
+  stages[name] = time.time() - start
+  session_stage_seconds.observe(stages[name], stage=name)
+  return results
+
+def run_serially(func, argslist, on_shed=None):
+  """ Runs the calls one after the other, None for a call that failed or was shed. """
+  results = []
+  for i, args in enumerate(argslist):
+    try:
+      if pk_deadline.expired():
+        raise pk_deadline.DeadlineExceeded('session deadline exceeded')
+      results.append(func(*args))
+      continue
+    except pk_deadline.DeadlineExceeded:
+      if on_shed:
+        on_shed(i)
+    except Exception as e:
+      log.error('(T) Serial call failed: {0}'.format(e))
+    results.append(None)
+  return results
+
+async def perform_one_session_async(policy, results = None, fired_alerts = None):
+  """ Performs one session of the policy as a pipeline of stages.
+
+  Within a stage, the inputs, the queries and the evaluation of all nodes
+  (then of all services) run concurrently, each stage with a timeout from
+  session_stage_timeouts. Services are evaluated after the nodes, as their
+  inputs depend on the node counts. The evaluation is serialised when a rule
+  uses m_userdata, as it is passed from rule to rule.
+  """
+  config = pk_config.config()
+  timeouts = dict(DEFAULT_stage_timeouts, **(config.get('session_stage_timeouts') or dict()))
+  stages = dict()
+  session_time = prom.session_begin()
+  index = pk_rules.index_of(policy)
+  affected = index.dependents_of(fired_alerts) if fired_alerts is not None else None
+  serial = bool(index.dependents.get('m_userdata'))
+  actuation = pk_actuator.ActuationStage()
+
+  calls = []
+  if fired_alerts is None:
+    calls.append((maintain_worker_nodes,config))
+  if needs_deployments(policy, affected):
+    calls.append((k8s.refresh_deployments_snapshot,config['k8s_endpoint']))
+  if not results:
+    calls.append((prefetch_queries,config,policy,affected))
+  await run_stage(stages, 'prepare', calls, stage_timeout(timeouts,'prepare'))
+
+  for kind in ('nodes','services'):
+    items = session_items(policy, kind, session_time, affected)
+    if pk_deadline.expired():
+      for item in items:
+        shed_item(kind, item)
+      continue
+    if not items:
+      continue
+    collect = collect_inputs_for_nodes if kind == 'nodes' else \
+              (lambda policy, item: collect_inputs_for_containers(policy, item.get('name')))
+    inputs = await run_stage(stages, kind[:-1]+'_inputs',
+                             [ (collect, policy, x) for x in items ], stage_timeout(timeouts,'inputs'),
+                             lambda i: shed_item(kind, items[i]))
+    for item, item_inputs in zip(items, inputs):
+      if item_inputs is not None:
+        item['inputs'] = item_inputs
+        for x in list(item_inputs.keys()):
+          log.info('(I)   => {0} "{1}": "{2}": {3}'.format(kind[:-1],item.get('name'),x,item_inputs[x]))
+    items = [ x for x, y in zip(items, inputs) if y is not None ]
+    data = await run_stage(stages, kind[:-1]+'_queries',
+                           [ (collect_item_queries, policy, results, kind, x) for x in items ],
+                           stage_timeout(timeouts,'queries'), lambda i: shed_item(kind, items[i]))
+    items, argslist = [ x for x, y in zip(items, data) if y is not None ], \
+                      [ (policy, x, y[0], y[1]) for x, y in zip(items, data) if y is not None ]
+    if kind == 'nodes':
+      func = evaluate_node
     else:
-      queries, alerts = prom.evaluate_data_queries_and_alerts_for_a_service(
-                             config['prometheus_endpoint'],policy,service_name)
-    for attrname, attrvalue in queries.items():
-      log.info('(Q)   => "{0}" is "{1}".'.format(attrname,attrvalue))
-    for attrname, attrvalue in alerts.items():
-      log.info('(A)   => "{0}" is "{1}".'.format(attrname,attrvalue))
-    log.info('(P) Policy evaluation for service "{0}" starts'.format(service_name))
-    perform_policy_evaluation_on_a_k8s_deploy(policy,service_name)
-    log.info('(S) Scaling of service "{0}" starts'.format(service_name))
-    perform_service_scaling(policy,service_name)
-    for attrname, attrvalue in alerts.items():
-      prom.alerts_remove(attrname)
-
-  log.info('--- session finished ---')
-  return
+      func = evaluate_service
+      argslist = [ x + (actuation,) for x in argslist ]
+    if serial:
+      calls = [ (run_serially, func, argslist, lambda i: shed_item(kind, items[i])) ] if argslist else []
+      outcome = await run_stage(stages, kind[:-1]+'_evaluation', calls, stage_timeout(timeouts,'evaluation'),
+                                lambda i: [ shed_item(kind, x) for x in items ])
+      outcome = outcome[0] if outcome and outcome[0] is not None else []
+    else:
+      outcome = await run_stage(stages, kind[:-1]+'_evaluation',
+                                [ (func,)+args for args in argslist ], stage_timeout(timeouts,'evaluation'),
+                                lambda i: shed_item(kind, items[i]))
+    if kind == 'nodes':
+      nodes_to_scale = dict()
+      for scaling in outcome:
+        if scaling and scaling[0] and scaling[1]:
+          nodes_to_scale.setdefault(scaling[0], []).append(scaling[1])
+      for handler_method, scaling_info in nodes_to_scale.items():
+        actuation.add_node_scaling(config, handler_method, scaling_info)
+
+  log.info('(S) Actuation of the planned scalings starts')
+  deadline = pk_deadline.get()
+  if deadline is not None:
+    deadline.enter_reserve()
+  report = await run_stage(stages, 'actuation', [ (run_actuation,actuation) ], stage_timeout(timeouts,'actuation'))
+  report = report[0] or dict(applied=[], skipped=[], failed=[])
+  log_actuation_report(report)
+  log.info('(T) Session stages: {0}'.format(', '.join('{0} {1:.3f}s'.format(x,y) for x,y in stages.items())))
+  return dict(actuation=report, stages=stages)
 
 def start(policy_yaml):
   global log
   log = logging.getLogger('pk')
   evaluator.init_queue_reading()
   policy = prepare_session(policy_yaml)
-  while not pk_config.finish_scaling():
-    try:
-      perform_one_session(policy)
-    except Exception as e:
-      log.exception('Exception occured during policy execution:')
-    for x in range(15):
-      if pk_config.finish_scaling():
-        break
-      time.sleep(1)
+  scheduler = pk_scheduler.Scheduler.from_config(pk_config.config())
+  scheduler.add_job(policy.get('stack','pk'),
+                    lambda alerts=None: perform_one_session(policy, fired_alerts=alerts))
+  scheduler.run(pk_config.finish_scaling)
 
-def stop(policy_yaml):
+def stop(policy_yaml, stop_evaluator=True):
   global log
   log = logging.getLogger('pk')
   config = pk_config.config()
   policy = yaml.safe_load(policy_yaml)
+  pk_remote_write.unregister_policy(policy.get('stack','pk'))
   log.info('(C) Remove exporters from prometheus configuration file starts')
   prom.remove_exporters_from_prometheus_config(config['prometheus_config_template'],
-                                               config['prometheus_config_target'])
+                                               config['prometheus_config_target'],
+                                               policy.get('stack','pk'))
   log.info('(C) Remove alerts from prometheus, deleting rule files starts')
   prom.remove_alerts_under_prometheus(config['prometheus_rules_directory'],
                                       policy.get('data',dict()).get('alerts',dict()),
                                       policy.get('stack','pk'))
   log.info('(C) Notify prometheus to reload config starts')
   prom.notify_to_reload_config(config['prometheus_endpoint'])
-  evaluator.stop_queue_reading()
+  if stop_evaluator:
+    evaluator.stop_queue_reading()
 
 def perform_policy_keeping(policy_yaml):
   try:
@@ -437,6 +785,128 @@ def perform_policy_keeping(policy_yaml):
     log.exception('Internal exception during policy execution:')
   stop(policy_yaml)
 
+class RunningPolicy(object):
+  """ A policy of the registry with its own context. """
+  def __init__(self, stack, policy_yaml):
+    self.stack, self.policy_yaml = stack, policy_yaml
+    self.context = pk_config.PolicyContext(stack)
+    self.context.policy = policy_yaml
+    self.policy = None
+    self.job = None
+    self.thread = None
+    self.status = 'starting'
+    self.error = None
+    self.started = time.time()
+
+  def alert_names(self):
+    return { x.get('alert') for x in (self.policy or dict()).get('data',dict()).get('alerts') or [] }
+
+  def describe(self):
+    return dict(stack=self.stack, status=self.status, error=self.error,
+                started=self.started, alerts=sorted(self.alert_names()))
+
+class PolicyRegistry(object):
+  """ Policies keyed by their stack, running concurrently on a shared scheduler.
+
+  Each policy is prepared and evaluated in its own context, the HTTP
+  sessions, the k8s caches and the evaluator pool are shared.
+  """
+  def __init__(self):
+    self.lock = threading.RLock()
+    self.policies = dict()
+    self.scheduler = None
+
+  def get_scheduler(self):
+    with self.lock:
+      if self.scheduler is None:
+        self.scheduler = pk_scheduler.Scheduler.from_config(pk_config.config())
+        threading.Thread(target=self.scheduler.run, args=(lambda: False,),
+                         name='pk-scheduler', daemon=True).start()
+      return self.scheduler
+
+  def start(self, policy_yaml, stack=None):
+    policy = yaml.safe_load(policy_yaml) or dict()
+    stack = stack or policy.get('stack','pk')
+    with self.lock:
+      if stack in self.policies:
+        raise KeyError('Policy "{0}" is already running'.format(stack))
+      entry = RunningPolicy(stack, policy_yaml)
+      self.policies[stack] = entry
+    entry.thread = threading.Thread(target=pk_config.run_in_context,
+                                    args=(entry.context, self.prepare, entry),
+                                    name='pk-prepare-'+stack)
+    entry.thread.start()
+    return entry
+
+  def prepare(self, entry):
+    log = logging.getLogger('pk')
+    try:
+      evaluator.init_queue_reading()
+      entry.policy = prepare_session(entry.policy_yaml)
+    except Exception as e:
+      log.exception('Preparing policy "{0}" failed:'.format(entry.stack))
+      entry.status, entry.error = 'failed', str(e)
+      return
+    with self.lock:
+      if entry.context.finish_scaling:
+        return
+      entry.job = self.get_scheduler().add_job(entry.stack,
+                    lambda alerts=None: perform_one_session(entry.policy, fired_alerts=alerts),
+                    entry.context)
+      entry.status = 'running'
+
+  def stop(self, stack):
+    with self.lock:
+      entry = self.policies.pop(stack, None)
+    if entry is None:
+      return False
+    entry.status = 'stopping'
+    entry.context.finish_scaling = True
+    entry.thread.join()
+    if entry.job:
+      self.scheduler.remove_job(entry.job)
+    with self.lock:
+      last = not self.policies
+    pk_config.run_in_context(entry.context, stop, entry.policy_yaml, last)
+    return True
+
+  def stop_all(self):
+    for stack in list(self.policies):
+      self.stop(stack)
+
+  def list(self):
+    with self.lock:
+      return [ x.describe() for x in self.policies.values() ]
+
+  def is_running(self):
+    return bool(self.policies)
+
+  def fire_alerts(self, alert):
+    """ Stores the firing alerts at the policies defining them and triggers their sessions. """
+    routed = dict()
+    with self.lock:
+      entries = [ x for x in self.policies.values() if x.status == 'running' ]
+    for entry in entries:
+      names = entry.alert_names()
+      alerts = [ x for x in alert.get('alerts') or []
+                 if x.get('labels',dict()).get('alertname') in names ]
+      if not alerts:
+        continue
+      stored = pk_config.run_in_context(entry.context, prom.alerts_add, dict(alert, alerts=alerts))
+      if stored:
+        routed[entry.stack] = stored
+        self.scheduler.boost(entry.stack)
+        self.scheduler.trigger(stored, entry.stack)
+    return routed
+
+  def reset_alerts(self):
+    with self.lock:
+      entries = list(self.policies.values())
+    for entry in entries:
+      pk_config.run_in_context(entry.context, prom.alerts_remove, None)
+
+registry = PolicyRegistry()
+
 def pkmain():
   global log
   parser = argparse.ArgumentParser(description='MiCADO component to realise scaling policies')
@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+# handle_k8s reads the kubeconfig when imported, no cluster is contacted
+from fake_services import KUBECONFIG
+with tempfile.NamedTemporaryFile('w', suffix='.kubeconfig', delete=False) as f:
+  f.write(KUBECONFIG.format('http://127.0.0.1:1'))
+os.environ.setdefault('KUBECONFIG', f.name)
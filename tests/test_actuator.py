@@ -0,0 +1,75 @@
+import time
+import threading
+import pytest
+import pk_config
+import pk_actuator
+
+@pytest.fixture(autouse=True)
+def config():
+  pk_config.config(dict(actuation=dict(concurrency=dict(k8s=2), timeout=0.2, stage_timeout=5)))
+  yield
+  pk_actuator.in_flight.clear()
+
+def test_reports_applied_skipped_and_failed():
+  def fail():
+    raise Exception('boom')
+  stage = pk_actuator.ActuationStage()
+  stage.add('k8s', 'a', lambda: None)
+  stage.add('k8s', 'b', lambda: False)
+  stage.add('k8s', 'c', fail)
+  report = stage.run()
+  assert report['applied'] == ['a']
+  assert report['skipped'] == ['b']
+  assert report['failed'] == ['c: boom']
+  assert not pk_actuator.in_flight
+
+def test_concurrency_is_limited_across_stages():
+  running, peak, lock = [0], [0], threading.Lock()
+  def call():
+    with lock:
+      running[0] += 1
+      peak[0] = max(peak[0], running[0])
+    time.sleep(0.05)
+    with lock:
+      running[0] -= 1
+  stages = [ pk_actuator.ActuationStage() for i in range(3) ]
+  for i, stage in enumerate(stages):
+    for j in range(2):
+      stage.add('k8s', 'scale {0}:{1}'.format(i, j), call, target='{0}-{1}'.format(i, j))
+  threads = [ threading.Thread(target=x.run) for x in stages ]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert peak[0] == 2
+
+def test_timed_out_call_keeps_its_target_in_flight():
+  release = threading.Event()
+  calls = []
+  stage = pk_actuator.ActuationStage()
+  stage.add('k8s', 'scale web:3', lambda: release.wait(5), target='web')
+  assert stage.run()['failed'] == ['scale web:3: timed out after 0.2 seconds']
+  stage = pk_actuator.ActuationStage()
+  stage.add('k8s', 'scale web:4', lambda: calls.append(4), target='web')
+  stage.add('k8s', 'scale api:2', lambda: calls.append(2), target='api')
+  report = stage.run()
+  assert report['skipped'] == ['scale web:4: a previous call on the target is still in flight']
+  assert report['applied'] == ['scale api:2']
+  release.set()
+  for i in range(50):
+    if not pk_actuator.in_flight:
+      break
+    time.sleep(0.02)
+  stage = pk_actuator.ActuationStage()
+  stage.add('k8s', 'scale web:4', lambda: calls.append(4), target='web')
+  assert stage.run()['applied'] == ['scale web:4']
+  assert calls == [2, 4]
+
+def test_node_scaling_targets():
+  import handle_occopus
+  stage = pk_actuator.ActuationStage()
+  stage.add_node_scaling(dict(), handle_occopus.drop_worker_node,
+                         [dict(node_name='worker', replicas=['n1', 'n2'])])
+  stage.add_node_scaling(dict(), handle_occopus.scale_worker_node, [dict(node_name='worker', replicas=3)])
+  assert [ x.target for x in stage.actions ] == \
+         [('occopus', 'worker:n1'), ('occopus', 'worker:n2'), ('occopus', 'worker')]
@@ -0,0 +1,80 @@
+import time
+import pytest
+import pk_config
+import handle_prometheus as prom
+
+ENDS_AT = '2030-01-01T00:00:10.5Z'
+ENDS_AT_EPOCH = 1893456010.5
+
+@pytest.fixture
+def store():
+  return prom.AlertStore(ttl=60, max_alerts=3)
+
+@pytest.fixture
+def context_alerts():
+  pk_config.config(dict(alerts_ttl=60))
+  prom.alerts_remove()
+  yield prom.alert_store()
+  prom.alerts_remove()
+
+def test_parse_rfc3339():
+  assert prom.parse_rfc3339(ENDS_AT) == ENDS_AT_EPOCH
+  assert prom.parse_rfc3339('2030-01-01T02:00:10.5+02:00') == ENDS_AT_EPOCH
+  assert prom.parse_rfc3339('0001-01-01T00:00:00Z') is None
+  assert prom.parse_rfc3339(None) is None
+
+def test_expires_at_ends_at(store):
+  store.add('hot', ENDS_AT, now=ENDS_AT_EPOCH - 100)
+  assert store.query(now=ENDS_AT_EPOCH - 1) == dict(hot=ENDS_AT)
+  assert store.query(now=ENDS_AT_EPOCH) == dict()
+
+def test_expires_after_ttl_without_ends_at(store):
+  store.add('hot', None, now=1000)
+  assert 'hot' in store.query(now=1059)
+  assert store.query(now=1060) == dict()
+
+def test_coalesces_repeated_firings(store):
+  assert not store.add('hot', None, now=1000)
+  assert store.add('hot', None, now=1030)
+  assert store.entries['hot']['count'] == 2
+  # The later firing extends the expiry
+  assert 'hot' in store.query(now=1080)
+  assert store.query(now=1090) == dict()
+
+def test_add_all_publishes_once(store, monkeypatch):
+  published = []
+  publish = store.publish
+  monkeypatch.setattr(store, 'publish', lambda: published.append(1) or publish())
+  coalesced = store.add_all([('a', None), ('b', None), ('a', None)], now=1000)
+  assert coalesced == {'a'}
+  assert published == [1]
+  assert sorted(store.query(now=1000)) == ['a', 'b']
+
+def test_drops_the_earliest_expiring_when_full(store):
+  store.add('a', None, now=1000)
+  store.add('b', None, now=1010)
+  store.add('c', None, now=1020)
+  store.add('d', None, now=1030)
+  assert sorted(store.query(now=1030)) == ['b', 'c', 'd']
+
+def test_remove(store):
+  store.add_all([('a', None), ('b', None)], now=1000)
+  store.remove('a')
+  assert list(store.query(now=1000)) == ['b']
+  store.remove()
+  assert store.query(now=1000) == dict()
+  assert store.query(now=2000) == dict()
+
+def test_alert_without_ends_at_fires_until_ttl(context_alerts, monkeypatch):
+  policy = dict(stack='st', data=dict(queries=dict(), alerts=[dict(alert='hot', expr='x > 1')]),
+                scaling=dict(services=[dict(name='web', scaling_rule='if hot:\n  m_container_count = 2\n')]))
+  now = time.time()
+  monkeypatch.setattr(time, 'time', lambda: now)
+  prom.alerts_add(dict(alerts=[dict(status='firing', labels=dict(alertname='hot'))]))
+  assert prom.evaluate_data_queries_and_alerts_for_a_service('', policy, 'web')[1] == dict(hot=True)
+  monkeypatch.setattr(time, 'time', lambda: now + 59)
+  assert prom.evaluate_data_queries_and_alerts_for_a_service('', policy, 'web')[1] == dict(hot=True)
+  monkeypatch.setattr(time, 'time', lambda: now + 60)
+  assert prom.evaluate_data_queries_and_alerts_for_a_service('', policy, 'web')[1] == dict(hot=False)
+  # Results are only returned, concurrent evaluations do not share them through the policy
+  assert set(policy['data']) == {'queries', 'alerts'}
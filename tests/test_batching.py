@@ -0,0 +1,62 @@
+import pk_config
+import handle_prometheus as prom
+
+POLICY = dict(data=dict(queries=dict(
+  A='avg(a)', B='avg(b)', C='avg(c)', D='sum(d)', PODS=['up', 'pod'], VEC=dict(query='rate(x[1m])', labels=['pod']),
+  SHARED='avg(s)', SHARED_LIST=['avg(s)', 'pod'], CONST='42', NOW='time()')))
+
+def in_context(func, *args):
+  return pk_config.run_in_context(pk_config.PolicyContext('st'), func, *args)
+
+def test_batchable_expressions():
+  assert prom.is_batchable_expression('avg(cpu)')
+  for expression in ('42', ' 1.5 ', '', 'time()', 'scalar(up)', 'up # comment',
+                     'label_replace(up, "pk_batch", "0", "", "")', ['up', 'pod']):
+    assert not prom.is_batchable_expression(expression)
+
+def test_only_scalar_queries_are_batched():
+  expressions = [ prom.query_expression(x) for x in POLICY['data']['queries'].values() ]
+  batches, single = in_context(prom.plan_batches, POLICY, expressions, 10)
+  assert batches == [['avg(a)', 'avg(b)', 'avg(c)', 'sum(d)']]
+  assert sorted(single) == sorted(['up', 'rate(x[1m])', 'avg(s)', 'avg(s)', '42', 'time()'])
+
+def test_batches_are_split_by_size():
+  expressions = ['avg(a)', 'avg(b)', 'avg(c)', 'sum(d)']
+  assert in_context(prom.plan_batches, POLICY, expressions, 2) == ([['avg(a)', 'avg(b)'], ['avg(c)', 'sum(d)']], [])
+  # The last batch of a single query is sent alone
+  assert in_context(prom.plan_batches, POLICY, expressions[:3], 2) == ([['avg(a)', 'avg(b)']], ['avg(c)'])
+  assert in_context(prom.plan_batches, POLICY, expressions[:1], 2) == ([], ['avg(a)'])
+
+def test_unbatchable_expressions_are_queried_alone():
+  def plan():
+    prom.unbatchable_expressions().add('avg(b)')
+    return prom.plan_batches(POLICY, ['avg(a)', 'avg(b)', 'avg(c)'], 10)
+  assert in_context(plan) == ([['avg(a)', 'avg(c)']], ['avg(b)'])
+
+def test_batch_expression():
+  assert prom.batch_expression(['avg(a)', 'sum(d)']) == \
+    'label_replace(avg(a), "pk_batch", "0", "", "") or label_replace(sum(d), "pk_batch", "1", "", "")'
+
+def test_split_batch_response():
+  response = dict(status='success', data=dict(resultType='vector', result=[
+    dict(metric=dict(pk_batch='1', job='x'), value=[1.0, '2']),
+    dict(metric=dict(pk_batch='0'), value=[1.0, '1']),
+    dict(metric=dict(pk_batch='7'), value=[1.0, '9']),
+    dict(metric=dict(job='untagged'), value=[1.0, '9'])]))
+  first, second, third = prom.split_batch_response(['avg(a)', 'sum(d)', 'avg(c)'], response)
+  assert first['data']['result'] == [ dict(metric=dict(), value=[1.0, '1']) ]
+  assert second['data']['result'] == [ dict(metric=dict(job='x'), value=[1.0, '2']) ]
+  assert third == dict(status='success', data=dict(resultType='vector', result=[]))
+  assert prom.extract_value_from_prometheus_response('sum(d)', second) == '2'
+
+def test_rejected_batch_falls_back_and_remembers_the_culprit(monkeypatch):
+  monkeypatch.setattr(prom, 'query_prometheus_batch', lambda endpoint, expressions: None)
+  def single(endpoint, expression):
+    if expression == 'avg(b)':
+      return dict(status='success', data=dict(resultType='scalar', result=[1, '3']))
+    return dict(status='success', data=dict(resultType='vector', result=[ dict(metric=dict(), value=[1.0, '1']) ]))
+  monkeypatch.setattr(prom, 'query_prometheus_or_exception', single)
+  def run():
+    responses, batched = prom.query_batch_or_fallback('http://prometheus', ['avg(a)', 'avg(b)'])
+    return len(responses), batched, set(prom.unbatchable_expressions())
+  assert in_context(run) == (2, False, {'avg(b)'})
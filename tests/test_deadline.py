@@ -0,0 +1,62 @@
+import time
+import asyncio
+import logging
+import threading
+import pytest
+import pk_deadline
+import policy_keeper
+
+def test_budget_and_reserve():
+  deadline = pk_deadline.Deadline(10, reserve=3)
+  assert 6.9 < deadline.remaining() <= 7
+  deadline.enter_reserve()
+  assert 9.9 < deadline.remaining() <= 10
+
+def test_optional_work_is_not_shed_at_the_start_of_short_budgets():
+  assert not pk_deadline.Deadline(4, reserve=3).optional_expired()
+  deadline = pk_deadline.Deadline(4, reserve=3)
+  deadline.start -= 0.6
+  deadline.at -= 0.6
+  assert deadline.optional_expired()
+
+def test_calls_find_the_ended_session_exceeded():
+  deadline, token = pk_deadline.begin()
+  assert pk_deadline.clip(5) == 5
+  pk_deadline.end(token)
+  assert pk_deadline.remaining() == float('inf')
+  token = pk_deadline.current.set(deadline)
+  try:
+    assert pk_deadline.expired()
+    with pytest.raises(pk_deadline.DeadlineExceeded):
+      pk_deadline.clip(5)
+    with pytest.raises(pk_deadline.DeadlineExceeded):
+      pk_deadline.check()
+  finally:
+    pk_deadline.current.reset(token)
+
+def test_cancelled_call():
+  event = threading.Event()
+  def call():
+    pk_deadline.check()
+    event.set()
+    return pk_deadline.expired(), pk_deadline.optional_expired()
+  assert pk_deadline.run_cancellable(event, call) == (True, True)
+  assert not pk_deadline.is_cancelled()
+
+def test_timed_out_stage_call_is_cancelled():
+  policy_keeper.log = logging.getLogger('pk')
+  finished, outcome = threading.Event(), []
+  def slow():
+    time.sleep(0.3)
+    try:
+      pk_deadline.check()
+      outcome.append('acted')
+    except pk_deadline.DeadlineExceeded:
+      outcome.append('gave up')
+    finished.set()
+  shed, stages = [], dict()
+  results = asyncio.run(policy_keeper.run_stage(stages, 'test', [ (slow,), (lambda: 1,) ], 0.1, shed.append))
+  assert results == [None, 1]
+  assert shed == [0]
+  assert finished.wait(2)
+  assert outcome == ['gave up']
@@ -0,0 +1,54 @@
+import pytest
+import pk_config
+import pk_history
+
+def test_series_keeps_the_last_samples_in_order():
+  series = pk_history.Series(3)
+  for i in range(5):
+    series.append(float(i), i * 10.0)
+  times, values = series.window()
+  assert list(times) == [2.0, 3.0, 4.0]
+  assert list(values) == [20.0, 30.0, 40.0]
+  assert list(series.window(2)[1]) == [30.0, 40.0]
+
+def test_series_window_before_wrapping():
+  series = pk_history.Series(4)
+  series.append(1.0, 5.0)
+  series.append(2.0, 6.0)
+  assert list(series.window()[1]) == [5.0, 6.0]
+  assert list(series.window(10)[1]) == [5.0, 6.0]
+
+def test_series_overwrites_the_same_timestamp():
+  series = pk_history.Series(3)
+  series.append(1.0, 5.0)
+  series.append(1.0, 7.0)
+  assert list(series.window()[1]) == [7.0]
+
+def test_requirements():
+  assert pk_history.requirements("x = history('A', 5)\ny = history('A', 3)") == dict(A=5)
+  assert pk_history.requirements("x = history('A', n)\ny = history('A', 3)") == dict(A=None)
+  assert pk_history.requirements("x = history_times('B', n=4)") == dict(B=4)
+  assert pk_history.requirements("x = history(name, 4)") == dict()
+  assert pk_history.requirements("x = (") == dict()
+
+def test_history_records_numbers_of_wanted_queries():
+  policy = dict(scaling=dict(services=[dict(name='web', scaling_rule="m = history('CPU', 2)\n")]))
+  history = pk_history.History(policy, length=4)
+  for t in range(3):
+    history.record(dict(CPU=float(t), MEM=1.0), t)
+  history.record(dict(CPU='n/a'), 3)
+  assert set(history.series) == {'CPU'}
+  inputs = history.inputs("m = history('CPU', 2)\n")
+  values = inputs['history']('CPU')
+  assert list(values) == [1.0, 2.0]
+  assert list(inputs['history_times']('CPU')) == [1.0, 2.0]
+  assert len(inputs['history']('MEM')) == 0
+  with pytest.raises(ValueError):
+    values[0] = 0.0
+
+def test_history_is_kept_in_the_policy_context():
+  policy = dict(scaling=dict())
+  context = pk_config.PolicyContext('st')
+  history = pk_config.run_in_context(context, pk_history.build_history, policy, 10)
+  assert '_history' not in policy
+  assert pk_config.run_in_context(context, pk_history.history_of, policy) is history
@@ -0,0 +1,35 @@
+import threading
+import pk_config
+import handle_k8s as k8s
+import handle_prometheus as prom
+import evaluator
+
+def test_counters_are_kept_per_policy():
+  first, second = pk_config.PolicyContext('first'), pk_config.PolicyContext('second')
+  pk_config.run_in_context(first, prom.count_cache, True)
+  pk_config.run_in_context(first, prom.count_cache, False)
+  pk_config.run_in_context(second, prom.count_cache, True)
+  pk_config.run_in_context(second, evaluator.account_rule_cache, False, 0.5)
+  assert pk_config.run_in_context(first, prom.session_cache_stats) == dict(hits=1, misses=1)
+  assert pk_config.run_in_context(second, prom.session_cache_stats) == dict(hits=1, misses=0)
+  assert pk_config.run_in_context(first, evaluator.rule_cache_stats) == dict(hits=0, misses=0, parse_time=0)
+  assert pk_config.run_in_context(second, evaluator.rule_cache_stats) == dict(hits=0, misses=1, parse_time=0.5)
+  assert pk_config.run_in_context(second, k8s.scale_stats) == dict(writes=0, skipped=0)
+
+def test_down_nodes_are_removed_once_for_all_policies(monkeypatch):
+  pk_config.config(dict())
+  down = [ dict(ID='n1', Addr='10.0.0.1') ]
+  removed = []
+  monkeypatch.setattr(k8s, 'query_list_of_nodes', lambda endpoint, status: [ dict(x) for x in down ])
+  monkeypatch.setattr(k8s, 'remove_node', lambda endpoint, id: removed.append(id))
+  monkeypatch.setattr(k8s, 'down_nodes_stored', dict())
+  k8s.down_nodes_maintenance('', 60)
+  k8s.stored_down_nodes()['n1']['micado_timestamp'] -= 120
+  threads = [ threading.Thread(target=pk_config.run_in_context,
+                               args=(pk_config.PolicyContext(str(i)), k8s.down_nodes_maintenance, '', 60))
+              for i in range(4) ]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert removed == ['n1']
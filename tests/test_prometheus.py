@@ -0,0 +1,27 @@
+import pk_config
+import handle_prometheus as prom
+import policy_keeper
+
+POLICY = dict(
+  data=dict(queries=dict(CPU='avg(cpu)', MEM='avg(mem)', LOAD='avg(load)', m_opt_cpu='opt(cpu)')),
+  scaling=dict(
+    nodes=[dict(name='worker', scaling_rule='m_node_count = 2 if LOAD > 1 else 1\n')],
+    services=[dict(name='web', scaling_rule='if hot:\n  m_container_count = CPU\n'),
+              dict(name='db', scaling_rule='m_container_count = MEM\n')]))
+
+def in_context(func, *args):
+  return pk_config.run_in_context(pk_config.PolicyContext('st'), func, *args)
+
+def test_session_expressions_of_all_items():
+  assert in_context(prom.collect_session_expressions, POLICY) == {'avg(cpu)', 'avg(mem)', 'avg(load)', 'opt(cpu)'}
+
+def test_session_expressions_of_the_affected_items():
+  assert in_context(prom.collect_session_expressions, POLICY, {('services', 'web')}) == {'avg(cpu)'}
+  assert in_context(prom.collect_session_expressions, POLICY, {('nodes', 'worker')}) == {'avg(load)', 'opt(cpu)'}
+  assert in_context(prom.collect_session_expressions, POLICY, set()) == set()
+
+def test_deployments_are_needed_for_affected_services_only():
+  assert policy_keeper.needs_deployments(POLICY, None)
+  assert policy_keeper.needs_deployments(POLICY, {('services', 'db')})
+  assert not policy_keeper.needs_deployments(POLICY, {('nodes', 'worker')})
+  assert not policy_keeper.needs_deployments(dict(scaling=dict(nodes=[])), None)
@@ -0,0 +1,82 @@
+import struct
+import pytest
+import pk_remote_write
+from remote_write_pusher import encode_write_request, snappy_compress
+
+NOW = 1700000000.0
+
+def series(name, value, instance='a', timestamp=NOW, **labels):
+  return (dict(labels, __name__=name, instance=instance), [(int(timestamp * 1000), value)])
+
+def stale_nan():
+  return struct.unpack('<d', pk_remote_write.STALE_NAN.to_bytes(8, 'little'))[0]
+
+def store_of(names=('cpu',), max_series=100, staleness=30):
+  store = pk_remote_write.Store(max_series, staleness)
+  store.register('st', list(names))
+  return store
+
+def values(response):
+  return { x['metric']['instance']: float(x['value'][1]) for x in response['data']['result'] }
+
+def test_snappy_of_the_pusher():
+  data = bytes(range(256)) * 700
+  assert pk_remote_write.snappy_decompress(snappy_compress(data)) == data
+
+def test_snappy_copies():
+  # 'abcd' as a literal, then an overlapping copy of 8 bytes at offset 4
+  assert pk_remote_write.snappy_decompress(bytes([12, 3 << 2]) + b'abcd' + bytes([(4 << 2) | 1, 4])) == b'abcd' * 3
+  with pytest.raises(pk_remote_write.DecodeError):
+    pk_remote_write.snappy_decompress(bytes([8, 3 << 2]) + b'abcd' + bytes([(4 << 2) | 1, 9]))
+  with pytest.raises(pk_remote_write.DecodeError):
+    pk_remote_write.snappy_decompress(bytes([9, 3 << 2]) + b'abcd')
+
+def test_decode_write_request_of_the_pusher():
+  timeseries = [ (dict(__name__='cpu', instance='a'), [(1000, 1.5), (2000, 2.5)]),
+                 (dict(__name__='mem', job='x'), [(-5, 0.0)]) ]
+  decoded = pk_remote_write.decode_write_request(encode_write_request(timeseries))
+  assert [ (labels, [ (t, struct.unpack('<d', v)[0]) for t, v in samples ]) for labels, samples in decoded ] == timeseries
+
+def test_store_keeps_the_latest_sample_of_wanted_series():
+  store = store_of()
+  timeseries = [ series('cpu', 1.0), series('cpu', 2.0, timestamp=NOW - 5), series('mem', 3.0) ]
+  assert store.ingest(pk_remote_write.decode_write_request(encode_write_request(timeseries))) == 1
+  assert values(store.response('cpu', NOW)) == {'a': 1.0}
+  assert store.response('mem', NOW) is None
+
+def test_store_selectors_and_staleness():
+  store = store_of()
+  store.ingest(pk_remote_write.decode_write_request(encode_write_request(
+    [ series('cpu', 1.0, 'a', job='web'), series('cpu', 2.0, 'b', job='db', timestamp=NOW - 60) ])))
+  assert values(store.response('cpu', NOW)) == {'a': 1.0}
+  assert values(store.response('cpu{job="db"}', NOW - 50)) == {'b': 2.0}
+  assert store.response('cpu{job="db"}', NOW) is None
+  assert store.response('avg(cpu)', NOW) is None
+
+def test_stale_marker_removes_the_series():
+  store = store_of()
+  store.ingest(pk_remote_write.decode_write_request(encode_write_request([ series('cpu', 1.0) ])))
+  store.ingest(pk_remote_write.decode_write_request(encode_write_request([ series('cpu', stale_nan(), timestamp=NOW + 1) ])))
+  assert store.response('cpu', NOW) is None
+  assert not store.series and not store.by_name
+
+def test_store_evicts_the_least_recently_updated_series():
+  store = store_of(max_series=2)
+  for instance in ('a', 'b', 'c'):
+    store.ingest(pk_remote_write.decode_write_request(encode_write_request([ series('cpu', 1.0, instance) ])))
+  assert set(values(store.response('cpu', NOW))) == {'b', 'c'}
+  store.ingest(pk_remote_write.decode_write_request(encode_write_request([ series('cpu', 2.0, 'b', timestamp=NOW + 1) ])))
+  store.ingest(pk_remote_write.decode_write_request(encode_write_request([ series('cpu', 1.0, 'd') ])))
+  assert values(store.response('cpu', NOW)) == {'b': 2.0, 'd': 1.0}
+
+def test_unregistered_metrics_are_dropped():
+  store = store_of(('cpu', 'mem'))
+  store.ingest(pk_remote_write.decode_write_request(encode_write_request([ series('cpu', 1.0), series('mem', 2.0) ])))
+  store.register('st', ['mem{job="x"}'])
+  assert store.response('cpu', NOW) is None
+  assert [ x[0] for x in store.series ] == ['mem']
+
+def test_receive_rejects_broken_bodies():
+  for body in (b'\x05\x00', snappy_compress(b'\x0a\x05\x0a'), b'\xff'):
+    with pytest.raises(pk_remote_write.DecodeError):
+      pk_remote_write.receive(body)
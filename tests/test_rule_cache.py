@@ -0,0 +1,31 @@
+import evaluator
+
+def test_hit_after_miss():
+  cache = evaluator.RuleCache()
+  tree, hit, parse_time = cache.compile('x = 1')
+  assert not hit
+  assert cache.compile('x = 1') == (tree, True, 0.0)
+
+def test_syntax_error_is_cached():
+  cache = evaluator.RuleCache()
+  tree, hit, parse_time = cache.compile('x = (')
+  assert isinstance(tree, SyntaxError)
+  assert cache.compile('x = (')[1]
+
+def test_least_recently_used_rules_are_dropped():
+  cache = evaluator.RuleCache(max_rules=2)
+  cache.compile('a = 1')
+  cache.compile('b = 1')
+  cache.compile('a = 1')
+  cache.compile('c = 1')
+  assert len(cache.trees) == 2
+  assert cache.compile('a = 1')[1]
+  assert not cache.compile('b = 1')[1]
+
+def test_configure_trims():
+  cache = evaluator.RuleCache()
+  for i in range(5):
+    cache.compile('x = {0}'.format(i))
+  cache.configure(3)
+  assert len(cache.trees) == 3
+  assert cache.compile('x = 4')[1]
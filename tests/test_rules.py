@@ -0,0 +1,38 @@
+import pk_config
+import pk_rules
+
+POLICY = dict(scaling=dict(
+  nodes=[dict(name='worker', scaling_rule='m_node_count = 2 if CPU > LIMIT else 1\n')],
+  services=[dict(name='web', scaling_rule='if hot:\n  m_container_count = m_container_count + 1\n'),
+            dict(name='api', scaling_rule="m_container_count = history('CPU', 5).mean()\n"),
+            dict(name='broken', scaling_rule='m_container_count = (\n')]))
+
+def test_names_of_the_rules():
+  index = pk_rules.RuleIndex(POLICY)
+  assert index.names('nodes', 'worker') == {'m_node_count', 'CPU', 'LIMIT'}
+  assert index.uses('services', 'web', 'hot')
+  assert not index.uses('services', 'web', 'CPU')
+  assert index.names('services', 'missing') == frozenset()
+
+def test_queries_read_through_history_are_names():
+  index = pk_rules.RuleIndex(POLICY)
+  assert {'history', 'CPU'} <= index.names('services', 'api')
+
+def test_unparsable_rule_uses_every_identifier():
+  index = pk_rules.RuleIndex(POLICY)
+  assert index.names('services', 'broken') == {'m_container_count'}
+
+def test_dependents_of():
+  index = pk_rules.RuleIndex(POLICY)
+  assert index.dependents_of(['hot']) == {('services', 'web')}
+  assert index.dependents_of(['CPU', 'hot']) == {('nodes', 'worker'), ('services', 'web'), ('services', 'api')}
+  assert index.dependents_of(['unknown']) == set()
+
+def test_index_is_kept_in_the_policy_context():
+  policy = dict(POLICY)
+  context = pk_config.PolicyContext('st')
+  index = pk_config.run_in_context(context, pk_rules.build_index, policy)
+  assert '_rule_index' not in policy
+  assert pk_config.run_in_context(context, pk_rules.index_of, policy) is index
+  # A reloaded policy gets its own index
+  assert pk_config.run_in_context(context, pk_rules.index_of, dict(POLICY)) is not index
@@ -0,0 +1,42 @@
+import json
+import numpy
+import pk_vector
+import handle_prometheus as prom
+
+def response(result, separators=(',', ':')):
+  return json.dumps(dict(status='success', data=dict(resultType='vector', result=result)),
+                    separators=separators)
+
+RESULT = [ dict(metric=dict(__name__='up', pod='pod-{0}'.format(i), instance='10.0.0.{0}:9100'.format(i)),
+                value=[1700000000.5 + i, str(i * 1.5)]) for i in range(5) ]
+
+def test_scan_matches_parse():
+  for separators in ((',', ':'), (', ', ': ')):
+    text = response(RESULT, separators)
+    scanned = pk_vector.scan(text, ['pod', 'instance'])
+    parsed = pk_vector.parse(json.loads(text)['data'], ['pod', 'instance'])
+    assert numpy.array_equal(scanned.values, parsed.values)
+    assert numpy.array_equal(scanned.timestamps, parsed.timestamps)
+    assert list(scanned.pod) == list(parsed.pod)
+    assert list(scanned.instance) == list(parsed.instance)
+
+def test_scan_of_special_values_and_empty_result():
+  text = response([ dict(metric=dict(pod='a'), value=[1, 'NaN']), dict(metric=dict(pod='b'), value=[1, '+Inf']) ])
+  vector = pk_vector.scan(text, ['pod'])
+  assert numpy.isnan(vector.values[0]) and numpy.isinf(vector.values[1])
+  assert len(pk_vector.scan(response([]), ['pod'])) == 0
+
+def test_scan_leaves_other_responses_to_parse():
+  assert pk_vector.scan(response(RESULT), None) is None
+  assert pk_vector.scan(response(RESULT + [ dict(metric=dict(), value=[1, '2']) ]), ['pod']) is None
+  assert pk_vector.scan(response([ dict(metric=dict(pod='a"b'), value=[1, '2']) ]), ['pod']) is None
+  assert pk_vector.scan(json.dumps(dict(status='success', data=dict(resultType='scalar', result=[1, '2']))),
+                        ['pod']) is None
+
+def test_vector_query_of_raw_response():
+  query = dict(query='up', labels=['pod'])
+  for result in (RESULT, RESULT + [ dict(metric=dict(pod='a"b'), value=[1, '2']) ]):
+    text = response(result)
+    vector = prom.extract_value_from_prometheus_response(query, prom.RawResponse(text.encode()))
+    assert list(vector.pod) == [ x['metric'].get('pod', '') for x in result ]
+    assert list(vector.values) == [ float(x['value'][1]) for x in result ]